@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks, run as `myss bench crypto` or `myss bench dns`.
+
+crypto, each method is measured in two modes, with chunks of several sizes:
+    stream, `Encryptor` en/decrypts a tcp stream chunk by chunk
+    packet, `encrypt_all` en/decrypts each chunk as a udp packet
+dns, `DNSParser.parse_response` is timed over a corpus of responses.
+result is written to stdout as json.
+"""
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import json
+import logging
+import os
+import platform
+import socket
+import struct
+import sys
+import time
+
+from ss import encrypt
+from ss.core import asyncdns
+from ss.crypto import backend
+
+SIZES = (64, 256, 1024, 4096, 16384, 65536)
+DURATION = 0.2      # seconds of encryption, and of decryption, per case
+BATCH = 16          # chunks encrypted before they are decrypted
+PASSWORD = b'benchmark'
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def measure(encrypt_func, decrypt_func, size, duration=DURATION):
+    """return (calls, encryption seconds, decryption seconds)"""
+    plain = os.urandom(size)
+    calls = 0
+    enc_time = dec_time = 0.0
+    while enc_time < duration or dec_time < duration:
+        start = timer()
+        results = [encrypt_func(plain) for _ in range(BATCH)]
+        middle = timer()
+        for data in results:
+            decrypted = decrypt_func(data)
+        end = timer()
+        if decrypted != plain:
+            raise Exception('decrypted data is different from plain text')
+        enc_time += middle - start
+        dec_time += end - middle
+        calls += BATCH
+    return calls, enc_time, dec_time
+
+
+def _as_bytes(data):
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+
+def stream_funcs(method):
+    encryptor = encrypt.Encryptor(PASSWORD, method)
+    decryptor = encrypt.Encryptor(PASSWORD, method)
+    return (lambda data: _as_bytes(encryptor.encrypt(data)),
+            lambda data: _as_bytes(decryptor.decrypt(data)))
+
+
+def packet_funcs(method):
+    return (lambda data: encrypt.encrypt_all(PASSWORD, method, 1, data),
+            lambda data: encrypt.encrypt_all(PASSWORD, method, 0, data))
+
+
+MODES = (('stream', stream_funcs), ('packet', packet_funcs))
+
+
+def backend_name(method):
+    entry = encrypt.method_supported[method]
+    for name, provider in backend.providers(method).items():
+        if provider == entry:
+            return name
+
+
+def bench_method(method, sizes, duration=DURATION):
+    results = []
+    name = backend_name(method)
+    for mode, funcs in MODES:
+        for size in sizes:
+            encrypt_func, decrypt_func = funcs(method)
+            calls, enc_time, dec_time = measure(encrypt_func, decrypt_func,
+                                                size, duration)
+            results.append({
+                "method": method,
+                "backend": name,
+                "mode": mode,
+                "size": size,
+                "calls": calls,
+                "encrypt_mbps": round(size * calls / enc_time / 1e6, 2),
+                "decrypt_mbps": round(size * calls / dec_time / 1e6, 2),
+                "encrypt_latency_us": round(enc_time / calls * 1e6, 3),
+                "decrypt_latency_us": round(dec_time / calls * 1e6, 3),
+            })
+    return results
+
+
+def bench_crypto(methods=None, sizes=SIZES, duration=DURATION,
+                 crypto_backend=None):
+    """return a dict of host information and results of all cases"""
+    results = []
+    errors = {}
+    for method in methods or sorted(encrypt.method_supported):
+        try:
+            # pick the backend as the server does, 'auto' or None measures
+            # the fastest one, not whichever happens to be the default
+            encrypt.init_backend(method, crypto_backend)
+            logging.info('bench: %s' % method)
+            results.extend(bench_method(method, sizes, duration))
+        except Exception as e:
+            # e.g. library is missing, or cipher is disabled in it
+            logging.warning('bench: skip %s, %s' % (method, e))
+            errors[method] = str(e)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "time": int(time.time()),
+        "duration": duration,
+        "results": results,
+        "errors": errors,
+    }
+
+
+def dns_corpus():
+    """responses of common shapes, when no captured one is given"""
+    A, AAAA, CNAME, NS, SOA, OPT = (
+        asyncdns.DNSParser.QTYPE_A, asyncdns.DNSParser.QTYPE_AAAA,
+        asyncdns.DNSParser.QTYPE_CNAME, asyncdns.DNSParser.QTYPE_NS,
+        asyncdns.DNSParser.QTYPE_SOA, asyncdns.DNSParser.QTYPE_OPT)
+    name = asyncdns.encode_name
+    make = asyncdns.make_response
+    v4 = lambda i: socket.inet_aton('10.0.%d.%d' % (i // 256, i % 256))
+    v6 = lambda i: socket.inet_pton(socket.AF_INET6, '2001:db8::%x' % i)
+    soa = name(b'ns1.example.com') + name(b'hostmaster.example.com') + \
+        struct.pack('!5I', 1, 7200, 3600, 1209600, 300)
+    # OPT in additional section, as EDNS servers answer
+    opt = [(OPT, 0, b'', b'')]
+    return [
+        ('a', make(1, b'www.example.com', A, answers=[(A, 300, v4(1))])),
+        ('a x8', make(2, b'www.example.com', A,
+                      answers=[(A, 300, v4(i)) for i in range(8)],
+                      additional=opt)),
+        ('aaaa x4', make(3, b'www.example.com', AAAA,
+                         answers=[(AAAA, 300, v6(i)) for i in range(4)],
+                         additional=opt)),
+        ('cname chain', make(4, b'www.example.com', A, answers=[
+            (CNAME, 300, name(b'www.example.com.cdn.example.net')),
+            (CNAME, 60, name(b'edge-1.cdn.example.net'),
+             b'www.example.com.cdn.example.net'),
+            (A, 20, v4(1), b'edge-1.cdn.example.net'),
+            (A, 20, v4(2), b'edge-1.cdn.example.net')], additional=opt)),
+        ('nxdomain', make(5, b'nx.example.com', A, rcode=3,
+                          authorities=[(SOA, 300, soa, b'example.com')],
+                          additional=opt)),
+        # larger than 512 bytes, truncated without EDNS
+        ('a x32 with glue', make(6, b'pool.example.com', A,
+                                 answers=[(A, 60, v4(i)) for i in range(32)],
+                                 authorities=[(NS, 3600, name(
+                                     b'ns%d.example.com' % i), b'example.com')
+                                     for i in range(4)],
+                                 additional=[(A, 3600, v4(i),
+                                              b'ns%d.example.com' % i)
+                                             for i in range(4)] + opt)),
+    ]
+
+
+def load_dns_corpus(path):
+    """raw responses, one in each file of directory `path`, or all in file
+    `path`, each after 2 bytes of length as dns over tcp sends them"""
+    corpus = []
+    if os.path.isdir(path):
+        for fname in sorted(os.listdir(path)):
+            with open(os.path.join(path, fname), 'rb') as f:
+                corpus.append((fname, f.read()))
+        return corpus
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + 2 <= len(data):
+        length, = struct.unpack('!H', data[pos:pos + 2])
+        corpus.append(('%s#%d' % (os.path.basename(path), len(corpus)),
+                       data[pos + 2:pos + 2 + length]))
+        pos += 2 + length
+    return corpus
+
+
+def bench_dns(corpus=None, duration=DURATION):
+    """return a dict of host information and parse time of each response"""
+    parser = asyncdns.DNSParser()
+    results = []
+    errors = {}
+    for name, data in dns_corpus() if corpus is None else corpus:
+        try:
+            ips = parser.parse_response(data).ips
+        except Exception as e:
+            errors[name] = str(e)
+            continue
+        calls = 0
+        elapsed = 0.0
+        while elapsed < duration:
+            start = timer()
+            for _ in range(100):
+                parser.parse_response(data)
+            elapsed += timer() - start
+            calls += 100
+        results.append({
+            "response": name,
+            "size": len(data),
+            "addresses": len(ips),
+            "calls": calls,
+            "parses_per_second": int(round(calls / elapsed)),
+            "latency_us": round(elapsed / calls * 1e6, 3),
+        })
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "time": int(time.time()),
+        "duration": duration,
+        "results": results,
+        "errors": errors,
+    }
+
+
+def run_dns(settings):
+    corpus = settings.get("bench_corpus")
+    report = bench_dns(load_dns_corpus(corpus) if corpus else None,
+                       settings.get("bench_duration") or DURATION)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+def run(settings):
+    report = bench_crypto(settings.get("bench_methods"),
+                          settings.get("bench_sizes") or SIZES,
+                          settings.get("bench_duration") or DURATION,
+                          settings.get("crypto_backend"))
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+def test_bench_crypto():
+    report = bench_crypto(['aes-256-cfb', 'chacha20-ietf-poly1305', 'table'],
+                          (64, 16384), 0.01)
+    assert not report["errors"], report["errors"]
+    assert len(report["results"]) == 3 * 2 * 2
+    for result in report["results"]:
+        assert result["backend"] == backend_name(result["method"]) != None
+    json.dumps(report)
+
+
+def test_bench_dns():
+    corpus = dns_corpus()
+    report = bench_dns(corpus, 0.001)
+    assert not report["errors"], report["errors"]
+    assert [r["addresses"] for r in report["results"]] == [1, 8, 4, 2, 0, 32]
+    json.dumps(report)
+
+
+if __name__ == '__main__':
+    test_bench_crypto()
+    test_bench_dns()
@@ -6,6 +6,8 @@ import sys
 import os
 import json
 
+from ss import utils, bench
+from ss.crypto import backend
 from ss.settings import settings
 
 def to_bytes(s):
@@ -52,6 +54,19 @@ class Command(object):
               "verbose": "-v",
               "eth": "--eth",
               "fork": "--fork",
+              "edge_triggered": "--edge-triggered",
+              "reuse_port": "--reuse-port",
+              "high_water": "--high-water",
+              "low_water": "--low-water",
+              "tunnel_pool": "--tunnel-pool",
+              "tunnel_idle": "--tunnel-idle",
+              "direct_hosts": "--direct-hosts",
+              "crypto_backend": "--crypto-backend",
+              "crypto_workers": "--crypto-workers",
+              "bench_methods": "--methods",
+              "bench_sizes": "--sizes",
+              "bench_duration": "--duration",
+              "bench_corpus": "--corpus",
             }
 
     def __init__(self, parser=None):
@@ -64,8 +79,10 @@ class Command(object):
                         prog="run myss as", dest="subcmd")
         self.local_parser = subcommand.add_parser("local")
         self.server_parser = subcommand.add_parser("server")
+        self.bench_parser = subcommand.add_parser("bench")
         self.add_server_argument()
         self.add_local_argument()
+        self.add_bench_argument()
 
     def add_arg(self, parser, **options):
         k = self.DEST_K[options["dest"]]
@@ -85,6 +102,12 @@ class Command(object):
         self.add_arg(parser, dest="quiet", help="quiet mode, only show warnings and errors",
                      action='store_true')
 
+    def add_crypto_backend_argument(self, parser):
+        self.add_arg(parser, dest="crypto_backend", default="auto",
+                     choices=["auto"] + list(backend.BACKENDS),
+                     help="library to en/decrypt with, default: auto, the "
+                     "fastest one is picked by a benchmark at startup")
+
     def add_common_argument(self, parser):
         self.add_arg(parser, metavar="CONFIG", type=self._check_config,
                      help="path to config file, if this parameter is specified," 
@@ -98,12 +121,34 @@ class Command(object):
                      help="encryption method, default: aes-256-cfb", 
                      type=self._check_method, dest="method")
 
+        self.add_crypto_backend_argument(parser)
+
         self.add_arg(parser, metavar="TIMEOUT", default=300, 
                      type=self._check_timeout, dest="timeout",
                      help="timeout in seconds for idle connection, default: 300")
 
         self.add_arg(parser, action='store_true', dest="fast_open",
                      help="use TCP_FASTOPEN, requires Linux 3.7+")
+
+        self.add_arg(parser, action='store_true', dest="edge_triggered",
+                     help="use edge-triggered epoll for tcp connections, "
+                     "only work on Linux")
+
+        self.add_arg(parser, metavar="THREADS", type=int,
+                     dest="crypto_workers", default=0,
+                     help="en/decrypt tcp chunks of 16 KiB and larger on so "
+                     "many threads, so bulk transfers of different "
+                     "connections use more cores, default: 0 (disabled)")
+
+        self.add_arg(parser, metavar="BYTES", type=self._check_size,
+                     dest="high_water", default=128 * 1024,
+                     help="stop reading from a connection when so many bytes "
+                     "are waiting to be sent to its peer, default: 131072")
+
+        self.add_arg(parser, metavar="BYTES", type=self._check_size,
+                     dest="low_water", default=32 * 1024,
+                     help="resume reading when pending bytes drop to this "
+                     "value, default: 32768")
         
     def add_server_argument(self):
         
@@ -118,6 +163,12 @@ class Command(object):
             help="daemon mode, only work on unix system"
             )
 
+        self.add_arg(parser, dest="reuse_port",
+            action="store_true",
+            help="every worker binds its own listening socket with "
+            "SO_REUSEPORT and runs its own io loop, requires Linux 3.9+"
+            )
+
         self.add_arg(parser, metavar="ADDR", dest="server", type=self._check_addr,
                      default=to_bytes("0.0.0.0"), required=True, 
                      help=" hostname or ipaddr, default is 0.0.0.0")
@@ -161,6 +212,19 @@ class Command(object):
         self.add_arg(parser, metavar="PAC", dest="pac", default=(PWD+"/config/pac"),
                      help="pac file, see `https://github.com/clowwindy/gfwlist2pac` for detail"
                      )
+        self.add_arg(parser, metavar="SIZE", type=int, dest="tunnel_pool",
+                     default=0,
+                     help="keep SIZE idle connections to remote server, so "
+                     "that new tunnels skip dns lookup and handshake, "
+                     "default: 0 (disabled)")
+        self.add_arg(parser, metavar="SECONDS", type=int, dest="tunnel_idle",
+                     default=60,
+                     help="close idle pooled connections after SECONDS, should "
+                     "be shorter than timeout of remote server, default: 60")
+        self.add_arg(parser, type=self._check_iplist,
+                     metavar="HOSTLIST", dest="direct_hosts",
+                     help="json file of hostname patterns, matched hosts are "
+                     "connected directly, not through remote server")
         self.add_arg(parser, dest="proxy_mode", default="off",
                     choices=["pac", "global", "off"],
                     help="system proxy mode"
@@ -170,6 +234,30 @@ class Command(object):
                 help="name of network interface which proxy set to")
         self.add_general_argument(self.local_parser)
 
+    def add_bench_argument(self):
+        parser = self.bench_parser
+        parser.add_argument("target", choices=["crypto", "dns"],
+                            help="what to benchmark, result is written to "
+                            "stdout in json")
+        self.add_arg(parser, metavar="METHODS", dest="bench_methods",
+                     type=self._check_methods,
+                     help="comma separated methods, default: all")
+        self.add_arg(parser, metavar="SIZES", dest="bench_sizes",
+                     type=self._check_sizes,
+                     default=",".join(str(s) for s in bench.SIZES),
+                     help="comma separated chunk sizes in bytes, default: "
+                     "%(default)s")
+        self.add_arg(parser, metavar="SECONDS", dest="bench_duration",
+                     type=float, default=bench.DURATION,
+                     help="time spent on encryption, and on decryption, of "
+                     "each case, default: %(default)s")
+        self.add_arg(parser, metavar="PATH", dest="bench_corpus",
+                     help="dns responses to parse, a directory of raw "
+                     "messages, or a file of length prefixed ones, default: "
+                     "built-in samples")
+        self.add_crypto_backend_argument(parser)
+        self.add_general_argument(parser)
+
     def _to_abspath(self, p):
         is_absolute = os.path.isabs(p)        
         if not is_absolute:
@@ -219,6 +307,15 @@ class Command(object):
             logging.warn("your timeout `%d` seems too long" % t)
         return t
 
+    def _check_size(self, s):
+        try:
+            s = int(s)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid int value: '%s'" % s)
+        if s <= 0:
+            raise argparse.ArgumentTypeError("size must be positive: '%d'" % s)
+        return s
+
     def _check_pswd(self, pswd):
         return to_bytes(pswd)
 
@@ -229,6 +326,23 @@ class Command(object):
                          " like `AES-256-CFB` is recommended." % m)
         return to_bytes(m)
 
+    def _check_methods(self, methods):
+        from ss import encrypt
+        methods = [m.strip().lower() for m in methods.split(",") if m.strip()]
+        for m in methods:
+            if m not in encrypt.method_supported:
+                raise argparse.ArgumentTypeError("unknown method `%s`" % m)
+        return methods
+
+    def _check_sizes(self, sizes):
+        try:
+            sizes = [int(s) for s in sizes.split(",") if s.strip()]
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid sizes: '%s'" % sizes)
+        if not sizes or min(sizes) <= 0:
+            raise argparse.ArgumentTypeError("sizes must be positive")
+        return sizes
+
     def _check_path(self, p):
         p = self._to_abspath(p)
         parent = os.path.dirname(p)
@@ -308,6 +422,20 @@ def check_fork(v):
         v = False
     return v
 
+def check_reuse_port(v):
+    if v and not utils.reuse_port_supported():
+        logging.warn("optional parameter --reuse-port is not supported "
+                     "on this system")
+        v = False
+    return v
+
+def check_water_marks(high, low):
+    if low >= high:
+        logging.warn("--low-water %d should be less than --high-water %d, "
+                     "use %d instead" % (low, high, high // 4))
+        low = high // 4
+    return high, low
+
 def parse_cli(args=None):
     
     cmd = Command()
@@ -317,7 +445,13 @@ def parse_cli(args=None):
         del cfg["rhost"]
 
     settings.update(cfg)
+    if cfg["subcmd"] == "bench":
+        config_logging(cfg)
+        return cfg
     settings["fork"] = check_fork(settings.get("fork", False))
+    settings["reuse_port"] = check_reuse_port(settings.get("reuse_port", False))
+    settings["high_water"], settings["low_water"] = check_water_marks(
+        settings["high_water"], settings["low_water"])
 
     if settings["fork"] and not settings["log_file"]:
         settings["log_file"] = DEFAULT_LOGFILE
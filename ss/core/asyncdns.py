@@ -19,9 +19,11 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 import sys
 import os
+import collections
 import socket
 import struct
 import re
+import time
 import logging
 import json
 from ss import utils
@@ -31,6 +33,41 @@ from ss.settings import settings
 
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d-]{1,63}(?<!-)$", re.IGNORECASE)
 
+# ttl of answers is clamped into [MIN_TTL, MAX_TTL] seconds
+MIN_TTL = 5
+MAX_TTL = 24 * 3600
+# NXDOMAIN or no address is cached for the ttl of SOA in authority section,
+# at most this long (RFC 2308)
+NEGATIVE_TTL = 60
+# an expired answer is still served for so long, while a query refreshes
+# it in background, so hot names never wait for dns (RFC 8767)
+STALE_TTL = 3600
+
+# a query is sent to one server at a time. it is sent again to the next
+# server if no answer comes in RETRY_TIMEOUT, which doubles after each try,
+# and fails after QUERY_TIMEOUT
+RETRY_TIMEOUT = 0.5
+QUERY_TIMEOUT = 5
+
+# rtt and loss rate of each server are smoothed like tcp does (RFC 6298).
+# a query goes to the best server first, and is hedged to the next one if
+# no answer comes within HEDGE_PERCENTILE of recent rtts of the first one
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+LOSS_ALPHA = 0.1
+RTT_SAMPLES = 32
+HEDGE_PERCENTILE = 95
+MIN_HEDGE_DELAY = 0.01
+# stats not updated for so long are dropped, so a server recovered from a
+# bad time is tried again
+SERVER_STATS_TTL = 600
+STATS_INTERVAL = 60
+
+# A and AAAA of a name are asked at once. when one family is answered with
+# addresses, the other is waited for so long before callbacks are answered,
+# a late one only goes to cache (RFC 8305, resolution delay)
+RESOLUTION_DELAY = 0.05
+
 utils.patch_socket()
 
 
@@ -45,63 +82,139 @@ def is_valid_hostname(hostname):
 class InvalidDomainName(Exception):pass
 
 
-class RR(object):
-    """resource record"""
+class DNSResponse(object):
+    """parsed response. `ips` are addresses of the question, following its
+    cname chain, `ttl` is the least one of the chain. if there is no
+    address, `ttl` is the negative one from SOA, None without SOA"""
 
-    __slots__ = ["domain_name", "qtype", "qcls", "ttl", "value"]
+    __slots__ = ["id", "rcode", "hostname", "qtype", "ips", "ttl"]
 
-    def __init__(self, dn, qt, qc, ttl, val):
-        self.domain_name = dn
-        self.qtype = qt
-        self.qcls = qc
+    def __init__(self, id, rcode, hostname, qtype, ips, ttl):
+        self.id = id
+        self.rcode = rcode
+        self.hostname = hostname
+        self.qtype = qtype
+        self.ips = ips
         self.ttl = ttl
-        self.value = val
-
-
-class Response(object):
-    DOMAIN_END = b"\x00"
-
-    def __init__(self, d):
-        self._offset = 0
-        self._data = d
-
-    def cut(self, i):
-        up = self._offset + i
-        t = self._data[self._offset:up]
-        self._offset = up
-        return t
-
-    def __getitem__(self, i):
-        return self._data[i]
-
-    def cut_domain(self):
-        """get domain from repsonse, return doamin 
-        string and its length in protocol"""
-        d = self._data
-        domain_part = []
-        up = 0
-        i = self._offset
-        while d[i] != self.DOMAIN_END:
-            length = struct.unpack("!B", d[i])[0]
-            if length >= 0xc0:
-                if i >= self._offset:
-                    self._offset += 2
-                i = struct.unpack("!H", d[i:i+2])[0] -0xc000
-                continue
-            up = i + length + 1
-            domain_part.append(d[i+1:up])
-            if up >= self._offset:
-                self._offset += (length + 1)
-            i = up
-        if up >= self._offset:
-            self._offset += 1
-        return ".".join(domain_part)
-
-    
+
+
+class DNSQuery(object):
+    """a question in flight, keyed by its transaction id"""
+
+    __slots__ = ["id", "hostname", "qtype", "request", "edns", "servers",
+                 "server", "sent", "tries", "failed", "deadline", "timer"]
+
+    def __init__(self, id, hostname, qtype, request, servers, deadline):
+        self.id = id
+        self.hostname = hostname
+        self.qtype = qtype
+        self.request = request
+        self.edns = True        # request has an OPT record
+        self.servers = servers  # to ask in order, the best first
+        self.server = None      # where the last try is sent to
+        self.sent = {}          # {server: time of sending}, None if resent
+        self.tries = 0
+        self.failed = set()     # servers answered with an error
+        self.deadline = deadline
+        self.timer = None
+
+
+class ServerStats(object):
+    """smoothed rtt and loss rate of a dns server"""
+
+    __slots__ = ["server", "srtt", "rttvar", "loss", "samples", "sent",
+                 "answered", "updated"]
+
+    def __init__(self, server):
+        self.server = server
+        self.reset()
+
+    def reset(self):
+        self.srtt = None
+        self.rttvar = 0
+        self.loss = 0.0
+        self.samples = collections.deque(maxlen=RTT_SAMPLES)
+        self.sent = self.answered = 0       # since last report
+        self.updated = 0
+
+    def _sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.samples.append(rtt)
+
+    def on_answer(self, rtt=None):
+        """`rtt` is None if the query was sent more than once (Karn)"""
+        if rtt is not None:
+            self._sample(rtt)
+        self.loss -= LOSS_ALPHA * self.loss
+        self.answered += 1
+        self.updated = time.time()
+
+    def on_slow(self, elapsed):
+        """another server answered first, no answer in `elapsed` seconds"""
+        if self.srtt is None or elapsed > self.srtt:
+            self._sample(elapsed)
+            self.updated = time.time()
+
+    def on_loss(self):
+        self.loss += LOSS_ALPHA * (1 - self.loss)
+        self.updated = time.time()
+
+    def score(self):
+        """expected seconds to get an answer, lower is better. a server
+        never asked is the best, so each one is tried"""
+        if self.srtt is None:
+            return 0
+        return (self.srtt + 4 * self.rttvar) / (1 - min(self.loss, 0.9))
+
+    def percentile(self, p):
+        if len(self.samples) < RTT_SAMPLES // 4:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+
+class Resolution(object):
+    """A and AAAA queries of a hostname, answered to callbacks together"""
+
+    __slots__ = ["hostname", "answers", "ttl", "negative_ttl", "timer"]
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.answers = {}       # {qtype: ips}, None if the query failed
+        self.ttl = MAX_TTL      # of families with addresses
+        self.negative_ttl = NEGATIVE_TTL
+        self.timer = None
+
+
+def sort_addresses(ips):
+    """interleave ipv6 and ipv4 addresses, ipv6 first (RFC 8305)"""
+    v6 = [ip for ip in ips if ':' in ip]
+    v4 = [ip for ip in ips if ':' not in ip]
+    result = []
+    for i in range(max(len(v6), len(v4))):
+        result.extend(family[i] for family in (v6, v4) if i < len(family))
+    return result
+
+
+def preferred_address(ips):
+    """ipv4 first for those which use only one address, because a host
+    without ipv6 route is still common"""
+    for ip in ips:
+        if ':' not in ip:
+            return ip
+    return ips[0]
+
+
 class DNSParser(object):
 
-    QTYPE = (QTYPE_A, QTYPE_NS, QTYPE_CNAME, QTYPE_AAAA, QTYPE_ANY) = \
-        (1, 2, 5, 28, 255)
+    QTYPE = (QTYPE_A, QTYPE_NS, QTYPE_CNAME, QTYPE_SOA, QTYPE_AAAA,
+             QTYPE_OPT, QTYPE_ANY) = (1, 2, 5, 6, 28, 41, 255)
+
+    RCODE_NOERROR, RCODE_FORMERR, RCODE_NXDOMAIN = 0, 1, 3
 
     QTYPE_IP = (QTYPE_A, QTYPE_AAAA)
 
@@ -109,52 +222,167 @@ class DNSParser(object):
 
     QCLASS_IN = 1
 
+    # advertised in OPT record, so large answers aren't truncated (RFC 6891)
+    EDNS_PAYLOAD_SIZE = 4096
+    MAX_POINTERS = 16       # of a name, more means a loop
+    MAX_CNAMES = 8
 
-    def build_request(self, hostname, qtype):
-        count = struct.pack("!HHHH", 1, 0, 0, 0)
-        header = os.urandom(2) + b"\x01\x00" + count
-        parts = hostname.split(".")
+    def build_request(self, hostname, qtype, txn_id=None, edns=True):
+        count = struct.pack("!HHHH", 1, 0, 0, 1 if edns else 0)
+        txn_id = os.urandom(2) if txn_id is None \
+            else struct.pack("!H", txn_id)
+        header = txn_id + b"\x01\x00" + count
+        parts = hostname.split(b".")
         qname = []
         for p in parts:
             if len(p) > self.MAX_PART_LENGTH:
                 raise InvalidDomainName(p)
             qname += [struct.pack("!B", len(p)), p]
-        qname = ''.join(qname) + b"\x00"
+        qname = b''.join(qname) + b"\x00"
         t_c = struct.pack("!HH", qtype, self.QCLASS_IN)
         question = qname + t_c
+        if edns:
+            # root name, payload size in class, no extended flags
+            question += struct.pack("!BHHIH", 0, self.QTYPE_OPT,
+                                    self.EDNS_PAYLOAD_SIZE, 0, 0)
         return header + question
 
-    def parse_response(self, response):
-        resp = Response(response)
-        resp.cut(6)     # ID and question number
-        answer_rrs, authority_rrs, addtional_rrs = \
-            struct.unpack("!HHH", resp.cut(6))
-        query_domain = resp.cut_domain()
-        query_type = resp.cut(2)
-        query_cls = resp.cut(2)
-
-        arrs = self.parse_rrs(resp, answer_rrs)
-        aurrs = self.parse_rrs(resp, authority_rrs)
-        adrrs = self.parse_rrs(resp, addtional_rrs)
-        rrs = arrs + aurrs + adrrs
-        return query_domain, rrs
-
-    def parse_rrs(self, resp, rrs):
-        rs = []
-        for i in xrange(rrs):
-            domain = resp.cut_domain()
-            qtype, qcls, ttl, data_length = struct.unpack("!HHIH" ,resp.cut(10))
-            if qtype == self.QTYPE_A:       # ipv4
-                data = socket.inet_ntoa(resp.cut(data_length))
-            elif qtype == self.QTYPE_AAAA:  # ipv6
-                data = socket.inet_ntop(socket.AF_INET6,resp.cut(data_length))
-            elif qtype in [self.QTYPE_NS, self.QTYPE_CNAME]:   # cname
-                data = resp.cut_domain()
-            else:   # other query type, such as SOA, PTR ant etc.
-                data = resp.cut_domain()
-            record = RR(domain, qtype, qcls, ttl, data)
-            rs.append(record)
-        return rs
+    def _read_name(self, data, octets, pos, names):
+        """return name at `pos` in lower case and offset after it. `names`
+        caches (name, end) by offset"""
+        start = pos
+        labels = []
+        end = None
+        pointers = 0
+        while True:
+            cached = names.get(pos)
+            if cached is not None:
+                if cached[0]:
+                    labels.append(cached[0])
+                if end is None:
+                    end = cached[1]
+                break
+            length = octets[pos]
+            if length >= 0xc0:
+                if end is None:
+                    end = pos + 2
+                pointers += 1
+                if pointers > self.MAX_POINTERS:
+                    raise Exception('too many pointers in name')
+                pos = (length & 0x3f) << 8 | octets[pos + 1]
+                continue
+            if length > self.MAX_PART_LENGTH:
+                raise Exception('invalid label length %d' % length)
+            if not length:
+                if end is None:
+                    end = pos + 1
+                break
+            labels.append(data[pos + 1:pos + 1 + length])
+            pos += length + 1
+        name = b'.'.join(labels).lower()
+        names[start] = (name, end)
+        return name, end
+
+    def _skip_name(self, octets, pos):
+        while True:
+            length = octets[pos]
+            if length >= 0xc0:
+                return pos + 2
+            if not length:
+                return pos + 1
+            pos += length + 1
+
+    def parse_response(self, data):
+        """
+        parse `data` in one pass, and only as far as needed: address
+        records of the question are collected following its cname chain,
+        reading stops after them. authority section is read for SOA only
+        if there is no address, additional section is never read.
+        """
+        # ints by index in both python 2 and 3, `data` itself is sliced
+        # only for labels and addresses
+        octets = bytearray(data)
+        size = len(octets)
+        txn_id, flags, qdcount, ancount, nscount = \
+            struct.unpack_from("!HHHHH", data, 0)
+        if not flags & 0x8000:
+            raise Exception('not a response')
+        if qdcount != 1:
+            raise Exception('%d questions in response' % qdcount)
+        names = {}
+        hostname, pos = self._read_name(data, octets, 12, names)
+        qtype, = struct.unpack_from("!H", data, pos)
+        pos += 4
+        target = hostname
+        ips = []
+        ttl = MAX_TTL
+        # records of other names, in case the chain is out of order
+        aliases = {}
+        others = {}
+        for _ in range(ancount):
+            # most owners are pointers to the question, or to a target
+            cached = names.get((octets[pos] & 0x3f) << 8 | octets[pos + 1]) \
+                if octets[pos] >= 0xc0 else None
+            if cached is not None:
+                owner = cached[0]
+                pos += 2
+            else:
+                owner, pos = self._read_name(data, octets, pos, names)
+            rtype, rcls, rttl, rdlen = struct.unpack_from("!HHIH", data, pos)
+            pos += 10
+            end = pos + rdlen
+            if rcls != self.QCLASS_IN or rtype not in (qtype,
+                                                         self.QTYPE_CNAME):
+                if ips:
+                    break
+                pos = end
+                continue
+            if owner != target and ips:
+                break           # addresses of the question are all read
+            if end > size:
+                raise Exception('record is truncated')
+            if owner != target:
+                if rtype == qtype:
+                    others.setdefault(owner, []).append(
+                        (self._address(qtype, data[pos:end]), rttl))
+                else:
+                    aliases[owner] = (
+                        self._read_name(data, octets, pos, names)[0], rttl)
+            elif rtype == qtype:
+                ips.append(self._address(qtype, data[pos:end]))
+                ttl = min(ttl, rttl)
+            elif not ips:
+                target = self._read_name(data, octets, pos, names)[0]
+                ttl = min(ttl, rttl)
+            pos = end
+        if not ips and (aliases or others):
+            for _ in range(self.MAX_CNAMES):
+                if target in others:
+                    ips = [ip for ip, _ in others[target]]
+                    ttl = min([ttl] + [t for _, t in others[target]])
+                    break
+                if target not in aliases:
+                    break
+                target, rttl = aliases[target]
+                ttl = min(ttl, rttl)
+        if not ips:
+            # negative answer is cached for min(ttl, MINIMUM) of SOA
+            ttl = None
+            for _ in range(nscount):
+                pos = self._skip_name(octets, pos)
+                rtype, rcls, rttl, rdlen = struct.unpack_from("!HHIH", data,
+                                                              pos)
+                pos += 10 + rdlen
+                if rtype == self.QTYPE_SOA and rdlen >= 20 and pos <= size:
+                    minimum, = struct.unpack_from("!I", data, pos - 4)
+                    ttl = min(rttl, minimum)
+                    break
+        return DNSResponse(txn_id, flags & 0xf, hostname, qtype, ips, ttl)
+
+    def _address(self, qtype, rdata):
+        if qtype == self.QTYPE_A:
+            return socket.inet_ntoa(rdata)
+        return socket.inet_ntop(socket.AF_INET6, rdata)
 
 
 class DNSResolver(object):
@@ -165,6 +393,8 @@ class DNSResolver(object):
         self._hosts = {}
         self._cbs = {}  # {hostname: {cb:None, cb1:None}}
         self._hostname_status = {}
+        self._queries = {}  # {transaction id: DNSQuery}
+        self._server_stats = {}     # {server: ServerStats}
         self._cache = LRUCache(maxsize=10000)
         self._sock = None
         self._registered = False
@@ -227,7 +457,7 @@ class DNSResolver(object):
         if not self.io_loop:
             self.io_loop = IOLoop.current()
         self.io_loop.add(self._sock, IOLoop.READ, self)
-        self.io_loop.add_periodic(self.handle_periodic)
+        self.io_loop.add_periodic(self.handle_periodic, STATS_INTERVAL)
         self._registered = True
 
     def _call_callback(self, hostname, ip, error=None):
@@ -241,32 +471,111 @@ class DNSResolver(object):
         if hostname in self._hostname_status:       
             del self._hostname_status[hostname]     # remove qtype of hostname. 
 
-    def _handle_data(self, data):
+    def _handle_data(self, data, server=None):
         try:
-            hostname, rrs = self._dns_parser.parse_response(data)
+            response = self._dns_parser.parse_response(data)
         except Exception as e:
             logging.warn("parse dns response error: %s" % str(e), exc_info=True)
             #logging.warn(data)
             return
-        ip = ""
-        for rr in rrs:
-            if rr.qtype in DNSParser.QTYPE_IP and rr.qcls == DNSParser.QCLASS_IN:
-                ip = rr.value
-                break
-        qtype = self._hostname_status.get(hostname, DNSParser.QTYPE_AAAA)
-        if not ip and qtype == DNSParser.QTYPE_A:   # if ipv4 didn't get an ip, try ipv6 again
-            self._send_req(hostname, DNSParser.QTYPE_AAAA)    
-            self._hostname_status[hostname] = DNSParser.QTYPE_AAAA  # update qtype
-        elif ip:
-            self._cache[hostname] = ip
-            self._call_callback(hostname, ip)
-        elif qtype == DNSParser.QTYPE_AAAA:
-            logging.info("unable to resolve %s using both ipv4 and ipv6" % hostname)
-            self._call_callback(hostname, None)
+        query = self._queries.get(response.id)
+        if query is None or query.qtype != response.qtype or \
+                query.hostname.lower() != response.hostname.lower():
+            # late answer of a finished query, or a forged one
+            logging.debug('drop dns response of unknown query %d',
+                          response.id)
+            return
+        hostname = query.hostname
+        rcode = response.rcode
+        if rcode == DNSParser.RCODE_FORMERR and query.edns:
+            # an old server which knows no EDNS, ask without OPT record
+            # (RFC 6891, section 7)
+            query.edns = False
+            query.request = self._dns_parser.build_request(
+                hostname, query.qtype, query.id, edns=False)
+            self._send_query(query)
+            return
+        if rcode not in (DNSParser.RCODE_NOERROR, DNSParser.RCODE_NXDOMAIN):
+            # e.g. SERVFAIL, it says nothing about the name, not cached.
+            # ask the other servers before giving up
+            logging.info("dns server %s fails to resolve %s, rcode %d" % (
+                server, hostname, rcode))
+            server = server or query.server
+            query.failed.add(server)
+            query.sent.pop(server, None)
+            self._stats_of(server).on_loss()
+            if not self._send_query(query):
+                self._finish_query(query)
+                self._on_answer(query, None)
+            return
+        self._account(query, server or query.server)
+        self._finish_query(query)
+        ips = response.ips
+        ttl = response.ttl
+        if not ips:
+            ttl = NEGATIVE_TTL if ttl is None else min(ttl, NEGATIVE_TTL)
+        self._on_answer(query, ips, ttl,
+                        rcode == DNSParser.RCODE_NXDOMAIN)
+
+    def _on_answer(self, query, ips, ttl=MAX_TTL, nxdomain=False):
+        """`ips` of one family is known, None if its query failed"""
+        hostname = query.hostname
+        state = self._hostname_status.get(hostname)
+        if state is None:
+            # callbacks are answered already, keep the late family
+            if ips:
+                self._merge_cache(hostname, ips, ttl)
+            return
+        if nxdomain:
+            # the name has no records of any type
+            for qtype in DNSParser.QTYPE_IP:
+                state.answers[qtype] = []
         else:
-            logging.warn("impossible!!")
-        
+            state.answers[query.qtype] = ips
+        if ips:
+            state.ttl = min(state.ttl, ttl)
+        elif ips is not None:
+            state.negative_ttl = min(state.negative_ttl, ttl)
+        if len(state.answers) == len(DNSParser.QTYPE_IP):
+            self._finish_resolution(state)
+        elif ips and state.timer is None:
+            io_loop = self.io_loop or IOLoop.current()
+            state.timer = io_loop.call_later(RESOLUTION_DELAY,
+                                             self._finish_resolution, state)
+
+    def _finish_resolution(self, state):
+        hostname = state.hostname
+        if self._hostname_status.get(hostname) is not state:
+            return
+        (self.io_loop or IOLoop.current()).cancel(state.timer)
+        state.timer = None
+        ips = []
+        for qtype in DNSParser.QTYPE_IP:
+            ips.extend(state.answers.get(qtype) or [])
+        if ips:
+            ips = sort_addresses(ips)
+            self._cache[hostname] = (ips, time.time() + max(state.ttl,
+                                                            MIN_TTL))
+            self._call_callback(hostname, preferred_address(ips))
+        elif None in state.answers.values():
+            # a family failed, it may have addresses, so nothing is cached
+            logging.info("fail to resolve %s" % hostname)
+            self._call_callback(hostname, None, Exception(
+                'fail to resolve %s' % hostname))
+        else:
+            self._cache[hostname] = ([], time.time() + max(state.negative_ttl,
+                                                           MIN_TTL))
+            logging.info("unable to resolve %s using both ipv4 and ipv6" %
+                         hostname)
+            self._call_callback(hostname, None)
 
+    def _merge_cache(self, hostname, ips, ttl):
+        entry = self._cache[hostname]
+        expire = time.time() + max(ttl, MIN_TTL)
+        if entry is not None and entry[0]:
+            ips = entry[0] + [ip for ip in ips if ip not in entry[0]]
+            expire = min(expire, entry[1])
+        self._cache[hostname] = (sort_addresses(ips), expire)
 
     def handle_events(self, sock, fd, event):
         if sock != self._sock:
@@ -279,18 +588,58 @@ class DNSResolver(object):
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                        socket.SOL_UDP)
             self._sock.setblocking(False)
-            self.io_loop.add(self._sock, IOLoop.READ | IOLoop.ERROR, self.handle_events)
+            self.io_loop.add(self._sock, IOLoop.READ | IOLoop.ERROR, self)
         else:
-            data, addr = sock.recvfrom(1024)
+            data, addr = sock.recvfrom(DNSParser.EDNS_PAYLOAD_SIZE)
             if addr[0] not in self._servers:
                 logging.warn('received a packet other than our dns')
                 return
-            self._handle_data(data)
+            self._handle_data(data, addr[0])
 
     def handle_periodic(self):
-        #self._cache.sweep()
-        pass
-        
+        """report scores of servers"""
+        for server in self._rank_servers():
+            stats = self._stats_of(server)
+            if not stats.sent:
+                continue
+            p = stats.percentile(HEDGE_PERCENTILE)
+            logging.info("dns server %s: score %.1fms, srtt %.1fms, p%d %s, "
+                         "loss %.1f%%, %d of %d answered" % (
+                         server, stats.score() * 1000,
+                         (stats.srtt or 0) * 1000, HEDGE_PERCENTILE,
+                         '%.1fms' % (p * 1000) if p is not None else '-',
+                         stats.loss * 100, stats.answered, stats.sent))
+            stats.sent = stats.answered = 0
+
+    def _stats_of(self, server):
+        stats = self._server_stats.get(server)
+        if stats is None:
+            stats = self._server_stats[server] = ServerStats(server)
+        return stats
+
+    def _rank_servers(self):
+        """servers, the best first"""
+        now = time.time()
+        for stats in self._server_stats.values():
+            if stats.updated and now - stats.updated > SERVER_STATS_TTL:
+                stats.reset()
+        # sort is stable, servers of same score keep order of resolv.conf
+        return sorted(self._servers,
+                      key=lambda server: self._stats_of(server).score())
+
+    def _account(self, query, server=None):
+        """update stats of servers `query` is sent to, `server` answered"""
+        now = time.time()
+        for s, sent in query.sent.items():
+            stats = self._stats_of(s)
+            if s == server:
+                stats.on_answer(None if sent is None else now - sent)
+            elif sent is not None:
+                if now - sent >= RETRY_TIMEOUT:
+                    stats.on_loss()
+                else:
+                    stats.on_slow(now - sent)
+
     def add_callback(self, hostname, callback):
         cbs = self._cbs.get(hostname, {})
         cbs.update({callback: None})
@@ -311,12 +660,115 @@ class DNSResolver(object):
         except KeyError:
             pass
 
+    def _start_resolution(self, hostname):
+        """ask A and AAAA of `hostname` at once, answers go to callbacks"""
+        state = self._hostname_status[hostname] = Resolution(hostname)
+        try:
+            for qtype in DNSParser.QTYPE_IP:
+                self._send_req(hostname, qtype)
+        except InvalidDomainName:
+            del self._hostname_status[hostname]
+            for query in list(self._queries.values()):
+                if query.hostname == hostname:
+                    self._finish_query(query)
+            raise
+        return state
+
     def _send_req(self, hostname, qtype):
-        req = self._dns_parser.build_request(hostname, qtype)
-        for server in self._servers:
-            logging.debug('resolving %s with type %d using server %s',
-                          hostname, qtype, server)
-            self._sock.sendto(req, (server, 53))
+        """start a query of `hostname`, its answer goes to `_on_answer`"""
+        txn_id = struct.unpack("!H", os.urandom(2))[0]
+        while txn_id in self._queries:
+            txn_id = (txn_id + 1) & 0xffff
+        req = self._dns_parser.build_request(hostname, qtype, txn_id)
+        query = DNSQuery(txn_id, hostname, qtype, req, self._rank_servers(),
+                         time.time() + QUERY_TIMEOUT)
+        self._queries[txn_id] = query
+        self._send_query(query)
+
+    def _send_query(self, query):
+        """send `query` to next server which hasn't failed it, and wait for
+        the answer with a backoff timeout. return False if none is left.
+        tries before are not cancelled, the first answer wins"""
+        servers = [s for s in query.servers if s not in query.failed]
+        if not servers:
+            return False
+        # failover, one server after another, the best first
+        server = servers[query.tries % len(servers)]
+        query.server = server
+        stats = self._stats_of(server)
+        now = time.time()
+        if server in query.sent:
+            # an answer can't tell which try it is for
+            sent = query.sent[server]
+            if sent is not None and now - sent >= RETRY_TIMEOUT:
+                stats.on_loss()
+            query.sent[server] = None
+        else:
+            query.sent[server] = now
+        stats.sent += 1
+        logging.debug('resolving %s with type %d using server %s',
+                      query.hostname, query.qtype, server)
+        try:
+            self._sock.sendto(query.request, (server, 53))
+        except (OSError, IOError) as e:
+            # e.g. network is unreachable, wait for timeout to try again
+            logging.warn('fail to send dns query to %s: %s' % (server, e))
+        io_loop = self.io_loop or IOLoop.current()
+        io_loop.cancel(query.timer)
+        timeout = RETRY_TIMEOUT * (2 ** query.tries)
+        if not query.tries and len(servers) > 1:
+            # hedge to the next server when the best one is slower than
+            # it usually is
+            p = stats.percentile(HEDGE_PERCENTILE)
+            if p is not None:
+                timeout = min(max(p, MIN_HEDGE_DELAY), timeout)
+        query.tries += 1
+        query.timer = io_loop.call_at(min(time.time() + timeout,
+                                          query.deadline),
+                                      self._on_query_timeout, query)
+        return True
+
+    def _on_query_timeout(self, query):
+        if self._queries.get(query.id) is not query:
+            return
+        if time.time() < query.deadline and self._send_query(query):
+            return
+        self._account(query)
+        self._finish_query(query)
+        logging.info("timeout resolving %s with type %d" % (
+            query.hostname, query.qtype))
+        self._on_answer(query, None)
+
+    def _finish_query(self, query):
+        self._queries.pop(query.id, None)
+        (self.io_loop or IOLoop.current()).cancel(query.timer)
+        query.timer = None
+
+    def _resolve_cached(self, hostname, callback):
+        """answer `callback` from cache and return True, if possible"""
+        entry = self._cache[hostname]
+        if entry is None:
+            return False
+        ips, expire = entry
+        now = time.time()
+        if now < expire:
+            logging.debug('hit cache: %s', hostname)
+            if ips:
+                callback((hostname, preferred_address(ips)), None)
+            else:
+                callback((hostname, None),
+                         Exception('unknown hostname %s' % hostname))
+            return True
+        if ips and now < expire + STALE_TTL:
+            logging.debug('hit stale cache: %s', hostname)
+            callback((hostname, preferred_address(ips)), None)
+            if hostname not in self._hostname_status:   # refresh it once
+                try:
+                    self._start_resolution(hostname)
+                except InvalidDomainName:
+                    pass
+            return True
+        return False
 
     def resolve(self,hostname, callback):
         if type(hostname) != bytes:
@@ -329,26 +781,35 @@ class DNSResolver(object):
             logging.debug('hit hosts: %s', hostname)
             ip = self._hosts[hostname]
             callback((hostname, ip), None)
-        elif hostname in self._cache:
-            logging.debug('hit cache: %s', hostname)
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
+        elif self._resolve_cached(hostname, callback):
+            return
         else:
             if not is_valid_hostname(hostname):
                 callback(None, Exception('invalid hostname: %s' % hostname))
                 return
-            if hostname in self._cbs:        # if hostname is under-resolving, just adds cb to         
+            if hostname in self._hostname_status:   # if hostname is under-resolving, just adds cb to
                 self.add_callback(hostname,  # callback list, doesn't send new request any more.
                     callback)   
                 return
             try:
-                self._send_req(hostname, DNSParser.QTYPE_A) # ipv4 first. if failed, send ipv6 req
-                self._hostname_status[hostname] = DNSParser.QTYPE_A
+                self._start_resolution(hostname)
                 self.add_callback(hostname, callback)
             except InvalidDomainName as e:
                 logging.warn("invalid hostname when build dns request: %s" % hostname)
 
+    def addresses(self, hostname):
+        """all cached addresses of `hostname`, ipv6 and ipv4 interleaved.
+        empty if it isn't resolved by dns"""
+        if type(hostname) != bytes:
+            hostname = hostname.encode('utf8')
+        entry = self._cache[hostname]
+        return list(entry[0]) if entry is not None else []
+
     def destroy(self):
+        for query in list(self._queries.values()):
+            self._finish_query(query)
+        for state in self._hostname_status.values():
+            (self.io_loop or IOLoop.current()).cancel(state.timer)
         if self._sock:
             if self._registered:
                 self.io_loop.remove_periodic(self.handle_periodic)
@@ -373,8 +834,13 @@ class DNSResolver(object):
         try:
             with open(path, "r") as f:
                 cache = json.load(f)
+            now = time.time()
             for k in cache:
-                self._cache[k] = cache[k]
+                # {hostname: [ips, expire]}, an ip alone is from old version
+                # which knows no ttl, drop it
+                entry = cache[k]
+                if isinstance(entry, list) and now < entry[1] + STALE_TTL:
+                    self._cache[utils.to_bytes(k)] = (entry[0], entry[1])
         except Exception:
             logging.warn("fail to load dns cache")
             return
@@ -384,10 +850,12 @@ class DNSResolver(object):
         if not path:    # local
             return
         path = os.path.expanduser(path)
-        keys = self._cache._cache.keys()
+        keys = list(self._cache._cache.keys())
         dns_dict = dict()
         for k in keys:
-            dns_dict[k] = self._cache[k]
+            ips, expire = self._cache[k]
+            if ips:     # negative answers are short lived, not kept
+                dns_dict[utils.to_str(k)] = [ips, expire]
         f = open(path, "w")
         try:
             import fcntl
@@ -397,3 +865,382 @@ class DNSResolver(object):
         finally:
             json.dump(dns_dict, f)
             f.close()
+
+
+def encode_name(name):
+    if not name:
+        return b'\0'
+    return b''.join(struct.pack("!B", len(p)) + p
+                    for p in name.split(b'.')) + b'\0'
+
+
+def make_response(txn_id, hostname, qtype, rcode=0, answers=(),
+                  authorities=(), additional=()):
+    """build a response for tests, rrs are (qtype, ttl, rdata) of
+    `hostname`, or (qtype, ttl, rdata, owner) of other names"""
+    data = [struct.pack("!HHHHHH", txn_id, 0x8180 | rcode, 1, len(answers),
+                        len(authorities), len(additional)),
+            encode_name(hostname),
+            struct.pack("!HH", qtype, DNSParser.QCLASS_IN)]
+    for rr in tuple(answers) + tuple(authorities) + tuple(additional):
+        rr_type, ttl, rdata = rr[:3]
+        # a pointer to the question, as servers do
+        owner = encode_name(rr[3]) if len(rr) > 3 else b'\xc0\x0c'
+        data.append(owner + struct.pack("!HHIH", rr_type, DNSParser.QCLASS_IN,
+                                        ttl, len(rdata)))
+        data.append(rdata)
+    return b''.join(data)
+
+
+class FakeSocket(object):
+    """records queries sent by a resolver in tests"""
+
+    def __init__(self):
+        self.sent = []      # [(txn_id, hostname, qtype, server)]
+
+    def sendto(self, data, addr):
+        txn_id, = struct.unpack("!H", data[:2])
+        hostname, pos = DNSParser()._read_name(data, bytearray(data), 12, {})
+        qtype, = struct.unpack_from("!H", data, pos)
+        self.sent.append((txn_id, hostname, qtype, addr[0]))
+
+    def find(self, hostname, qtype):
+        """transaction id of the last query of `hostname` and `qtype`"""
+        for txn_id, name, t, _ in reversed(self.sent):
+            if (name, t) == (hostname, qtype):
+                return txn_id
+
+    def close(self):
+        pass
+
+
+def test_parse_response():
+    parser = DNSParser()
+    A, CNAME = DNSParser.QTYPE_A, DNSParser.QTYPE_CNAME
+    hostname = b'www.example.com'
+    ip = lambda s: socket.inet_aton(s)
+
+    # cname chain, ttl is the least one of it
+    data = make_response(1, hostname, A, answers=[
+        (CNAME, 300, encode_name(b'cdn.example.net')),
+        (CNAME, 60, encode_name(b'edge.example.org'), b'cdn.example.net'),
+        (A, 120, ip('1.2.3.4'), b'edge.example.org'),
+        (A, 120, ip('1.2.3.5'), b'EDGE.example.org'),
+        (A, 10, ip('6.6.6.6'), b'other.example.org')])
+    response = parser.parse_response(data)
+    assert (response.id, response.rcode, response.hostname,
+            response.qtype) == (1, 0, hostname, A)
+    assert response.ips == ['1.2.3.4', '1.2.3.5'] and response.ttl == 60
+
+    # out of order
+    data = make_response(2, hostname, A, answers=[
+        (A, 120, ip('1.2.3.4'), b'edge.example.org'),
+        (CNAME, 60, encode_name(b'edge.example.org'), b'cdn.example.net'),
+        (CNAME, 300, encode_name(b'cdn.example.net'))])
+    response = parser.parse_response(data)
+    assert response.ips == ['1.2.3.4'] and response.ttl == 60
+
+    # reading stops after the addresses, a broken record behind them
+    # doesn't matter
+    data = make_response(3, hostname, A, answers=[
+        (A, 120, ip('1.2.3.4')), (46, 120, b'\0' * 100)])
+    response = parser.parse_response(data[:-50])
+    assert response.ips == ['1.2.3.4']
+    try:
+        parser.parse_response(make_response(3, hostname, A, answers=[
+            (A, 120, ip('1.2.3.4'))])[:-2])
+    except Exception:
+        pass
+    else:
+        raise AssertionError('truncated record is accepted')
+
+    # a name pointing to itself
+    data = make_response(4, hostname, A)
+    data = data[:6] + struct.pack('!H', 1) + data[8:] + \
+        struct.pack('!HHHIH', 0xc000 | len(data), A, 1, 1, 4) + ip('1.2.3.4')
+    try:
+        parser.parse_response(data)
+    except Exception as e:
+        assert 'pointers' in str(e)
+    else:
+        raise AssertionError('pointer loop is accepted')
+
+    # no address, ttl from SOA, at most its MINIMUM
+    soa = encode_name(b'ns.example.com') + encode_name(b'root.example.com') \
+        + struct.pack('!5I', 1, 2, 3, 4, 20)
+    data = make_response(5, hostname, A, rcode=DNSParser.RCODE_NXDOMAIN,
+                         authorities=[(DNSParser.QTYPE_SOA, 300, soa,
+                                       b'example.com')])
+    response = parser.parse_response(data)
+    assert response.ips == [] and response.ttl == 20
+    assert parser.parse_response(make_response(5, hostname, A)).ttl is None
+
+    # requests advertise a large udp payload
+    request = parser.build_request(hostname, A, 6)
+    assert struct.unpack('!H', request[10:12])[0] == 1
+    assert request[-11:] == struct.pack('!BHHIH', 0, DNSParser.QTYPE_OPT,
+                                        DNSParser.EDNS_PAYLOAD_SIZE, 0, 0)
+    assert parser.build_request(hostname, A, 6, edns=False) == \
+        request[:11] + b'\0' + request[12:-11]
+
+
+def test_edns_fallback():
+    resolver = DNSResolver(IOLoop())
+    resolver._servers = ['10.0.0.1']
+    sock = resolver._sock = FakeSocket()
+    hostname = b'old.example.com'
+    resolver.resolve(hostname, lambda result, error: None)
+    query = resolver._queries[sock.find(hostname, DNSParser.QTYPE_A)]
+    assert query.edns
+    resolver._handle_data(make_response(query.id, hostname,
+                                        DNSParser.QTYPE_A,
+                                        rcode=DNSParser.RCODE_FORMERR))
+    assert not query.edns and query.id in resolver._queries
+    assert sock.sent[-1][:3] == (query.id, hostname, DNSParser.QTYPE_A)
+    assert query.request == resolver._dns_parser.build_request(
+        hostname, DNSParser.QTYPE_A, query.id, edns=False)
+    resolver.destroy()
+
+
+def test_cache():
+    resolver = DNSResolver(IOLoop())
+    resolver._servers = ['10.0.0.1']
+    sock = resolver._sock = FakeSocket()
+    results = []
+    callback = lambda result, error: results.append((result, error))
+    hostname = b'cache.example.com'
+
+    resolver.resolve(hostname, callback)
+    assert [q[1:3] for q in sock.sent] == [(hostname, DNSParser.QTYPE_A),
+                                           (hostname, DNSParser.QTYPE_AAAA)]
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_A), hostname, DNSParser.QTYPE_A,
+        answers=[(DNSParser.QTYPE_A, 300, socket.inet_aton('1.2.3.4')),
+                 (DNSParser.QTYPE_A, 100, socket.inet_aton('1.2.3.5'))]))
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_AAAA), hostname,
+        DNSParser.QTYPE_AAAA))
+    assert results.pop() == ((hostname, '1.2.3.4'), None)
+    ips, expire = resolver._cache[hostname]
+    assert ips == ['1.2.3.4', '1.2.3.5']
+    assert 95 < expire - time.time() <= 100
+
+    resolver.resolve(hostname, callback)
+    assert results.pop() == ((hostname, '1.2.3.4'), None)
+    assert len(sock.sent) == 2
+
+    # expired, served stale at once and refreshed in background once
+    resolver._cache[hostname] = (ips, time.time() - 1)
+    resolver.resolve(hostname, callback)
+    resolver.resolve(hostname, callback)
+    assert results == [((hostname, '1.2.3.4'), None)] * 2
+    assert len(sock.sent) == 4
+    del results[:]
+    for qtype in DNSParser.QTYPE_IP:
+        resolver._handle_data(make_response(
+            sock.find(hostname, qtype), hostname, qtype,
+            answers=[(DNSParser.QTYPE_A, 300, socket.inet_aton('1.2.3.6'))]
+            if qtype == DNSParser.QTYPE_A else []))
+    assert not results
+    assert resolver._cache[hostname][0] == ['1.2.3.6']
+
+    # negative answer, ttl from SOA
+    hostname = b'nx.example.com'
+    resolver.resolve(hostname, callback)
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_A), hostname, DNSParser.QTYPE_A,
+        rcode=DNSParser.RCODE_NXDOMAIN,
+        authorities=[(DNSParser.QTYPE_SOA, 30,
+                      b'\0\0' + struct.pack("!5I", 1, 2, 3, 4, 3600))]))
+    assert results.pop()[1] is not None
+    ips, expire = resolver._cache[hostname]
+    assert ips == [] and 25 < expire - time.time() <= 30
+    count = len(sock.sent)
+    resolver.resolve(hostname, callback)
+    assert results.pop()[1] is not None
+    assert len(sock.sent) == count
+    resolver.destroy()
+
+
+def test_dual_stack():
+    io_loop = IOLoop()
+    resolver = DNSResolver(io_loop)
+    resolver._servers = ['10.0.0.1']
+    sock = resolver._sock = FakeSocket()
+    results = []
+    callback = lambda result, error: results.append((result, error))
+    hostname = b'dual.example.com'
+    v4 = [(DNSParser.QTYPE_A, 300, socket.inet_aton(ip))
+          for ip in ('1.2.3.4', '1.2.3.5')]
+    v6 = [(DNSParser.QTYPE_AAAA, 300,
+           socket.inet_pton(socket.AF_INET6, ip)) for ip in ('::1', '::2')]
+
+    # both families, addresses are interleaved, ipv6 first
+    resolver.resolve(hostname, callback)
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_AAAA), hostname,
+        DNSParser.QTYPE_AAAA, answers=v6))
+    assert not results
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_A), hostname, DNSParser.QTYPE_A,
+        answers=v4))
+    assert results.pop() == ((hostname, '1.2.3.4'), None)
+    assert resolver.addresses(hostname) == ['::1', '1.2.3.4', '::2',
+                                            '1.2.3.5']
+
+    # AAAA is lost, A is answered after resolution delay, not the timeout
+    hostname = b'v4.example.com'
+    resolver.resolve(hostname, callback)
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_A), hostname, DNSParser.QTYPE_A,
+        answers=v4))
+    state = resolver._hostname_status[hostname]
+    assert not results
+    assert state.timer.deadline - time.time() <= RESOLUTION_DELAY
+    resolver._finish_resolution(state)
+    assert results.pop() == ((hostname, '1.2.3.4'), None)
+    assert resolver.addresses(hostname) == ['1.2.3.4', '1.2.3.5']
+    # the late one goes to cache
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_AAAA), hostname,
+        DNSParser.QTYPE_AAAA, answers=v6[:1]))
+    assert not results
+    assert resolver.addresses(hostname) == ['::1', '1.2.3.4', '1.2.3.5']
+
+    # ipv6 only
+    hostname = b'v6.example.com'
+    resolver.resolve(hostname, callback)
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_A), hostname, DNSParser.QTYPE_A))
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_AAAA), hostname,
+        DNSParser.QTYPE_AAAA, answers=v6))
+    assert results.pop() == ((hostname, '::1'), None)
+
+    # a failed family isn't cached as negative
+    hostname = b'fail.example.com'
+    resolver.resolve(hostname, callback)
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_A), hostname, DNSParser.QTYPE_A))
+    query = resolver._queries[sock.find(hostname, DNSParser.QTYPE_AAAA)]
+    query.deadline = time.time()
+    resolver._on_query_timeout(query)
+    assert results.pop()[1] is not None
+    assert resolver._cache[hostname] is None
+    assert not resolver._queries and not resolver._hostname_status
+    resolver.destroy()
+
+
+def test_retransmit():
+    io_loop = IOLoop()
+    resolver = DNSResolver(io_loop)
+    resolver._servers = ['10.0.0.1', '10.0.0.2']
+    sock = resolver._sock = FakeSocket()
+    results = []
+    callback = lambda result, error: results.append((result, error))
+    hostname = b'retry.example.com'
+
+    resolver.resolve(hostname, callback)
+    query = resolver._queries[sock.find(hostname, DNSParser.QTYPE_A)]
+    # no answer, the next server is asked with a longer timeout
+    resolver._on_query_timeout(query)
+    resolver._on_query_timeout(query)
+    sent = [q for q in sock.sent if q[2] == DNSParser.QTYPE_A]
+    assert [q[3] for q in sent] == ['10.0.0.1', '10.0.0.2', '10.0.0.1']
+    assert len(set(q[0] for q in sent)) == 1
+    assert query.timer.deadline - time.time() > RETRY_TIMEOUT * 3
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_AAAA), hostname,
+        DNSParser.QTYPE_AAAA))
+
+    # wrong id, or answer of another question is dropped
+    resolver._handle_data(make_response(
+        (query.id + 1) & 0xffff, hostname, DNSParser.QTYPE_A,
+        answers=[(DNSParser.QTYPE_A, 300, socket.inet_aton('6.6.6.6'))]))
+    resolver._handle_data(make_response(
+        query.id, b'other.example.com', DNSParser.QTYPE_A,
+        answers=[(DNSParser.QTYPE_A, 300, socket.inet_aton('6.6.6.6'))]))
+    assert not results
+
+    # SERVFAIL fails over to the other server, then gives up
+    resolver._handle_data(make_response(query.id, hostname,
+                                        DNSParser.QTYPE_A, rcode=2),
+                          '10.0.0.1')
+    assert sock.sent[-1][3] == '10.0.0.2' and not results
+    resolver._handle_data(make_response(query.id, hostname,
+                                        DNSParser.QTYPE_A, rcode=2),
+                          '10.0.0.2')
+    assert results.pop()[1] is not None
+    assert not resolver._queries and resolver._cache[hostname] is None
+
+    # deadline
+    resolver.resolve(hostname, callback)
+    for qtype in DNSParser.QTYPE_IP:
+        query = resolver._queries[sock.find(hostname, qtype)]
+        query.deadline = time.time()
+        resolver._on_query_timeout(query)
+    assert results.pop()[1] is not None
+    assert not resolver._queries and hostname not in resolver._hostname_status
+    resolver.destroy()
+
+
+def test_server_stats():
+    resolver = DNSResolver(IOLoop())
+    resolver._servers = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+    sock = resolver._sock = FakeSocket()
+    results = []
+    callback = lambda result, error: results.append((result, error))
+    answer = [(DNSParser.QTYPE_A, 300, socket.inet_aton('1.2.3.4'))]
+
+    # servers never asked are tried first
+    assert resolver._rank_servers() == resolver._servers
+    slow, fast, lossy = [resolver._stats_of(s) for s in resolver._servers]
+    for _ in range(RTT_SAMPLES):
+        slow.on_answer(0.2)
+        fast.on_answer(0.01)
+        lossy.on_answer(0.01)
+    for _ in range(10):
+        lossy.on_loss()
+    assert 0.19 < slow.srtt < 0.21 and fast.loss == 0
+    assert resolver._rank_servers() == ['10.0.0.2', '10.0.0.3', '10.0.0.1']
+
+    # the best one is asked, and hedged to the next one soon
+    hostname = b'hedge.example.com'
+    resolver.resolve(hostname, callback)
+    query = resolver._queries[sock.find(hostname, DNSParser.QTYPE_A)]
+    assert [q[3] for q in sock.sent] == ['10.0.0.2'] * 2
+    assert query.timer.deadline - time.time() < 0.02
+    query.sent['10.0.0.2'] -= 0.05
+    resolver._on_query_timeout(query)
+    assert sock.sent[-1][2:] == (DNSParser.QTYPE_A, '10.0.0.3')
+    # the first try is still waited for, the first answer wins
+    resolver._handle_data(make_response(query.id, hostname,
+                                        DNSParser.QTYPE_A, answers=answer),
+                          '10.0.0.2')
+    assert query.id not in resolver._queries
+    assert 0.01 < fast.srtt < 0.02 and fast.samples[-1] >= 0.05
+    assert lossy.loss > 0.5
+    resolver._handle_data(make_response(
+        sock.find(hostname, DNSParser.QTYPE_AAAA), hostname,
+        DNSParser.QTYPE_AAAA))
+    assert results.pop() == ((hostname, '1.2.3.4'), None)
+
+    # a server gives no answer, it loses score
+    hostname = b'loss.example.com'
+    resolver.resolve(hostname, callback)
+    query = resolver._queries[sock.find(hostname, DNSParser.QTYPE_A)]
+    first = resolver._stats_of(query.server)
+    loss = first.loss
+    query.sent[query.server] -= RETRY_TIMEOUT
+    resolver._on_query_timeout(query)
+    resolver._handle_data(make_response(query.id, hostname,
+                                        DNSParser.QTYPE_A, answers=answer),
+                          query.server)
+    assert first.loss > loss and first.server != query.server
+
+    resolver.handle_periodic()
+    assert fast.sent == 0
+    fast.updated -= SERVER_STATS_TTL + 1
+    resolver._rank_servers()
+    assert fast.srtt is None
+    resolver.destroy()
@@ -1,6 +1,5 @@
 ﻿# -*- coding: utf-8 -*-
 import re
-import collections
 import logging
 import errno
 import socket
@@ -9,9 +8,11 @@ import os
 import sys
 import weakref
 from ss.ioloop import IOLoop
-from ss import utils
+from ss import utils, encrypt
 from ss.lru_cache import lru_cache
 from . import socks5, pac
+from .connector import HappyEyeballs
+from .buffer import BufferPool, ChunkQueue
 from ss.settings import settings
 try:
     import urlparse
@@ -54,7 +55,14 @@ class BaseTCPHandler(object):
     HDL_POSITIVE, HDL_NEGATIVE, HDL_LISTEN = (0, 1, 2)
     BACKLOG = 1024
     BUF_SIZE = 32 * 1024
-    MAX_BUF_SIZE = 52428800    # 50MB
+    # chunks shorter than this are copied out of pooled buffer, so that
+    # small writes do not pin a whole `BUF_SIZE` buffer
+    MIN_POOLED_CHUNK = 4 * 1024
+    # stop reading when so many bytes wait to be written to peer,
+    # resume when they drop to low water mark
+    HIGH_WATER = 128 * 1024
+    LOW_WATER = 32 * 1024
+    EDGE_TRIGGERED = False      # whether handler drains socket until EAGAIN
 
     def __init__(self, io_loop, conn, addr, tags):
         """
@@ -81,15 +89,27 @@ class BaseTCPHandler(object):
         self._status = self.STAGE_INIT        # init
         self._events = 0x00
         self._registered = False
+        self._edge_triggered = False
+        # in edge-triggered mode, whether socket may still have data to
+        # read, or room to write
+        self._sock_readable = False
+        self._sock_writable = tags == self.HDL_NEGATIVE
         self._last_activity = 0     # 上次活跃时间点, 用于清理长时间没有数据传输的socket连接
-        self._read_buf = collections.deque()    # 这个就是peer sock的write缓存, 写sock时需要从里面取出数据
-        self._rbuf_size = 0
-        self._write_buf = collections.deque()   # 这个其实没太大必要了, 因为这个就是上面的
-        self._wbuf_size = 0
+        self._read_buf = ChunkQueue(buffer_pool)    # 这个就是peer sock的write缓存, 写sock时需要从里面取出数据
+        self._write_buf = ChunkQueue(buffer_pool)   # 握手应答等需要直接写回的数据
+        # pipe used to splice data from this socket to peer without copying
+        # it to user space, only for direct connections.
+        self._pipe = None
+        self._pipe_size = 0         # bytes in pipe
+        self._pipe_full = False
+        self._read_paused = False   # paused by backpressure
+        self._high_water = settings.get("high_water") or self.HIGH_WATER
+        self._low_water = settings.get("low_water") or self.LOW_WATER
 
         self._started = False
         self._op_hdl_ref = None
         self._peer_addr = None
+        self._connector = None      # racing connections to peer
         self._tags = tags
 
     def register(self, event=None):
@@ -101,7 +121,11 @@ class BaseTCPHandler(object):
             self.__class__.__name__)
         if not self.io_loop:
             self.io_loop = IOLoop.current()
-        if event is not None:
+        if self.EDGE_TRIGGERED and self.io_loop.edge_triggered:
+            # interest mask never changes in edge-triggered mode
+            events = IOLoop.READ|IOLoop.WRITE|IOLoop.ERROR|IOLoop.EDGE
+            self._edge_triggered = True
+        elif event is not None:
             events = IOLoop.READ|IOLoop.ERROR|event
         else:
             events = IOLoop.READ|IOLoop.ERROR
@@ -129,10 +153,21 @@ class BaseTCPHandler(object):
     def on_read(self):
         raise NotImplementedError()
 
+    def use_splice(self):
+        raise NotImplementedError()
+
     @property
     def closed(self):
         return self._status == self.STAGE_CLOSED
 
+    @property
+    def _rbuf_size(self):
+        return len(self._read_buf)
+
+    @property
+    def _wbuf_size(self):
+        return len(self._write_buf)
+
     def on_sock_error(self):
         logging.error("got socket error")
         if self._sock:
@@ -142,17 +177,58 @@ class BaseTCPHandler(object):
     def destroy(self):
         raise NotImplementedError()
 
+    def _recv(self, bufsize):
+        """
+        recv data from socket. return None if no data available now,
+        empty string if connection was closed or broken.
+        """
+        try:
+            data = self._sock.recv(bufsize)
+        except (OSError, IOError) as e:
+            if utils.errno_from_exception(e) in \
+                    (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                self._sock_readable = False
+                return None
+            return b''
+        # a short read means kernel buffer has been drained
+        self._sock_readable = len(data) == bufsize
+        return data
+
+    def _recv_chunk(self, bufsize):
+        """
+        like `_recv`, but recv into a pooled buffer. return (data, buffer), 
+        `data` is a memoryview on `buffer` which should be released to 
+        `buffer_pool` after use.
+        """
+        buf = buffer_pool.acquire()
+        try:
+            length = self._sock.recv_into(buf, bufsize)
+        except (OSError, IOError) as e:
+            buffer_pool.release(buf)
+            if utils.errno_from_exception(e) in \
+                    (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                self._sock_readable = False
+                return None, None
+            return b'', None
+        self._sock_readable = length == bufsize
+        if not length:
+            buffer_pool.release(buf)
+            return b'', None
+        return memoryview(buf)[:length], buf
+
     def _append_to_rbuf(self, data, codec=False):
         if codec:
-            data = self._codec(data)
+            try:
+                data = self._codec(data)
+            except encrypt.DecryptError as e:
+                logging.warning("connection %s:%d: %s" % (
+                    self._addr[:2] + (e, )))
+                self.destroy()
+                return
         self._read_buf.append(data)
-        self._rbuf_size += len(data)
 
     def _pop_from_rbuf(self, bufsize):
-        utils.merge_prefix(self._read_buf, bufsize)
-        data = self._read_buf.popleft()
-        self._rbuf_size -= len(data)
-        return data
+        return self._read_buf.pop(bufsize)
 
     def relate(self, other_handler):
         if self._op_hdl_ref:
@@ -170,14 +246,22 @@ class BaseTCPHandler(object):
             if not ip:
                 self.destroy()
                 return
+            # all addresses of both families are raced, see `HappyEyeballs`
+            ips = self._dns_resolver.addresses(result[0]) or [ip]
             try:
                 peer_port = self._peer_addr[1]
                 self._status = self.STAGE_DNS_RESOVED
-                self._create_peer_socket(ip, peer_port)
+                self._create_peer_socket(ips, peer_port)
             except Exception as e:
                 logging.error(e)
 
-    def _create_peer_socket(self, ip, port):
+    def _create_peer_socket(self, ips, port):
+        if len(ips) > 1:
+            self._connector = HappyEyeballs(self.io_loop, ips, port,
+                                            self._on_peer_connected)
+            self._connector.start()
+            return
+        ip = ips[0]
         addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM,
                                    socket.SOL_TCP)
         if len(addrs) == 0:
@@ -194,12 +278,27 @@ class BaseTCPHandler(object):
                 err not in _ERRNO_WOULDBLOCK:
                 self.destroy()
                 return
-            
+        self._attach_peer(sock, sa)
+
+    def _on_peer_connected(self, sock, sa, error):
+        self._connector = None
+        if error:
+            logging.warning("can't connect to %s:%d: %s" % (
+                self._peer_addr[0], self._peer_addr[1], error))
+            self.destroy()
+            return
+        self._attach_peer(sock, sa)
+
+    def _attach_peer(self, sock, sa):
         peer_handler = self.__class__(self.io_loop, sock, sa, self._dns_resolver, 
                                       self.HDL_POSITIVE)
         peer_handler._direct_conn = self._direct_conn
         self.relate(peer_handler)
         peer_handler.relate(self)
+        if self._direct_conn and utils.splice:
+            # data is relayed as it is, kernel can do it for us
+            self.use_splice()
+            peer_handler.use_splice()
 
         event = IOLoop.WRITE if peer_handler.writable else None
         peer_handler.register(event)
@@ -209,6 +308,9 @@ class BaseTCPHandler(object):
 
         
 
+buffer_pool = BufferPool(BaseTCPHandler.BUF_SIZE)   # shared by handlers of this process
+
+
 class BaseMixin(object):
     """
     status explanation:
@@ -280,10 +382,15 @@ class BaseMixin(object):
     def on_recv_syn(self):
         pass
 
+    def _connect_peer(self):
+        self._dns_resolver.resolve(self._peer_addr[0], 
+                                   self._on_dns_resolved)
+
 
 class LocalMixin(BaseMixin):
     
     ISLOCAL = 1
+    tunnel_pool = None      # warm connections to ssserver, see `TunnelPool`
 
     def __init__(self, dns_resolver):
         super(LocalMixin, self).__init__(dns_resolver)
@@ -291,15 +398,30 @@ class LocalMixin(BaseMixin):
 
     @lru_cache(maxsize=1000)
     def _exclusive_host(self, host):
-        if self.ISLOCAL:
-            return True
-        iplist = settings.get("forbidden_ip", [])
-        return (host in iplist)
+        """
+        return `False` if `host` matches one of `direct_hosts`, which is
+        connected directly instead of through ssserver. data of direct
+        connections is relayed as it is, by splice(2) if possible.
+        """
+        host = utils.to_str(host)
+        for pattern in settings.get("direct_hosts") or []:
+            if re.match(pattern, host):
+                return False
+        return True
 
     def _sshost(self):
         return (settings["server"], 
             settings["server_port"])
 
+    def _connect_peer(self):
+        if not self._direct_conn and self.tunnel_pool is not None:
+            tunnel = self.tunnel_pool.claim()
+            if tunnel:      # no dns lookup and handshake
+                self._status = self.STAGE_DNS_RESOVED
+                self._attach_peer(*tunnel)
+                return
+        super(LocalMixin, self)._connect_peer()
+
     def _nego_response(self, data):
         if data.startswith("GET /pac"):
             data = str(pac.ProxyAutoConfig())
@@ -313,19 +435,14 @@ class LocalMixin(BaseMixin):
             logging.warning("read on closed socket!")
             self.destroy()
             return
-        data = None
-        try:
-            data = self._sock.recv(self.BUF_SIZE)
-        except (OSError, IOError) as e:
-            if utils.errno_from_exception(e) in \
-                (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
+        data = self._recv(self.BUF_SIZE)
+        if data is None:
+            return
         if not data:
             self.destroy()
             return
         resp, length = self._nego_response(data)
         self._write_buf.append(resp)
-        self._wbuf_size += length
         self._status = self.STAGET_SOCKS5_NEGO
         return
         
@@ -334,13 +451,9 @@ class LocalMixin(BaseMixin):
             logging.warning("read on closed socket!")
             self.destroy()
             return
-        data = None
-        try:
-            data = self._sock.recv(self.BUF_SIZE)
-        except (OSError, IOError) as e:
-            if utils.errno_from_exception(e) in \
-                (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
+        data = self._recv(self.BUF_SIZE)
+        if data is None:
+            return
         if not data:
             self.destroy()
             return
@@ -356,7 +469,6 @@ class LocalMixin(BaseMixin):
             port_to_send = struct.pack('>H', port)
             data = header + addr_to_send + port_to_send
             self._write_buf.append(data)    # send back ack
-            self._wbuf_size += len(data)
             return
         elif cmd == socks5.CMD_CONNECT:
             data = data[3:]
@@ -365,10 +477,9 @@ class LocalMixin(BaseMixin):
             self.destroy()
             return
         self._append_to_rbuf(data)
-        utils.merge_prefix(self._read_buf, self.BUF_SIZE)    
         if not self._read_buf:
             return
-        data = self._read_buf[0]
+        data = self._read_buf.peek(self.BUF_SIZE)
         header_result = socks5.parse_header(data)
         if not header_result:
             return
@@ -379,15 +490,15 @@ class LocalMixin(BaseMixin):
         self._status = self.STAGE_SOCKS5_SYN
         ack, l = socks5.gen_ack()
         self._write_buf.append(ack)    # send back ack
-        self._wbuf_size += l
         if self._exclusive_host(remote_addr):    #
             self._append_to_rbuf(data, codec=True)
             self._peer_addr = self._sshost()        # connect ssserver
         else:
             self._direct_conn = True
+            if len(data) > header_length:   # payload after address header
+                self._append_to_rbuf(data[header_length:])
             self._peer_addr = (utils.to_str(remote_addr), remote_port)  #直连
-        self._dns_resolver.resolve(self._peer_addr[0], 
-                                   self._on_dns_resolved)
+        self._connect_peer()
 
 
 class RemoteMixin(BaseMixin):
@@ -403,22 +514,17 @@ class RemoteMixin(BaseMixin):
             logging.warning("read on closed socket!")
             self.destroy()
             return
-        data = None
-        try:
-            data = self._sock.recv(self.BUF_SIZE)
-        except (OSError, IOError) as e:
-            if utils.errno_from_exception(e) in \
-                (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
+        data = self._recv(self.BUF_SIZE)
+        if data is None:
+            return
         if not data:
             self.destroy()
             return
         self._append_to_rbuf(data, codec=True)
 
-        utils.merge_prefix(self._read_buf, self.BUF_SIZE)    
         if not self._read_buf:
             return
-        data = self._read_buf[0]
+        data = self._read_buf.peek(self.BUF_SIZE)
         header_result = socks5.parse_header(data)
         if not header_result:
             return
@@ -459,17 +565,13 @@ class HttpLocalMixin(LocalMixin):
         if not self._read_buf:
             return ""
         maxrange = maxrange or self.MAX_HEADER_LEN
-        utils.merge_prefix(self._read_buf, maxrange)
+        data = self._read_buf.peek(maxrange)
         pattern = re.compile(regex)
-        m = pattern.search(self._read_buf[0])
+        m = pattern.search(data)
         if m:
-            endpos = m.end()
-            utils.merge_prefix(self._read_buf, endpos)
-            data = self._read_buf.popleft()
-            self._rbuf_size -= endpos
-            return data
+            return self._read_buf.pop(m.end())
         else:
-            if len(self._read_buf[0]) >= maxrange:
+            if len(data) >= maxrange:
                 # not found regex in specified range
                 # bad request, need to close socket soon
                 raise HttpRequestError(413, "Entity Too Large")
@@ -482,13 +584,9 @@ class HttpLocalMixin(LocalMixin):
             logging.warning("read on closed socket!")
             self.destroy()
             return
-        data = None
-        try:
-            data = self._sock.recv(self.BUF_SIZE)
-        except (OSError, IOError) as e:
-            if utils.errno_from_exception(e) in \
-                (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
-                return
+        data = self._recv(self.BUF_SIZE)
+        if data is None:
+            return
         if not data:
             self.destroy()
             return
@@ -500,16 +598,17 @@ class HttpLocalMixin(LocalMixin):
             http_response, ss_premble, addr = http2shadosocks(http_request)
             if http_response:
                 self._write_buf.append(http_response)
-                self._wbuf_size += len(http_response)
             if self._exclusive_host(addr[0]):
                 self._append_to_rbuf(ss_premble, codec=True)
                 self._peer_addr = self._sshost()        # connect ssserver
             else:
                 self._direct_conn = True
                 self._peer_addr = addr
+                header_length = socks5.parse_header(ss_premble)[3]
+                if len(ss_premble) > header_length:     # plain http request
+                    self._append_to_rbuf(ss_premble[header_length:])
             self._status = self.STAGE_SOCKS5_SYN
-            self._dns_resolver.resolve(self._peer_addr[0], 
-                                   self._on_dns_resolved)          
+            self._connect_peer()
         except HttpRequestError as e:
             logging.warn(e)
             self.destroy()
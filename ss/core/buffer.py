@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+buffers on tcp relay path.
+
+`BufferPool` recycles fixed size bytearrays for `socket.recv_into`, and
+`ChunkQueue` keeps chunks to be sent, partial send is recorded by offset
+in the first chunk, so data is never joined or sliced before sending.
+"""
+import collections
+
+
+class BufferPool(object):
+
+    def __init__(self, size, max_free=256):
+        self.size = size
+        self.max_free = max_free    # buffers kept for reuse at most
+        self._free = []
+
+    def acquire(self):
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf):
+        if len(self._free) < self.max_free:
+            self._free.append(buf)
+
+    def __len__(self):
+        return len(self._free)
+
+
+class ChunkQueue(object):
+    """
+    fifo of byte chunks. a chunk is a bytes object or a memoryview on
+    a buffer from `pool`, which goes back to pool once chunk is consumed.
+    """
+
+    def __init__(self, pool=None):
+        self._chunks = collections.deque()  # (data, pooled buffer or None)
+        self._offset = 0        # consumed bytes of first chunk
+        self._size = 0
+        self._pool = pool
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data, buf=None):
+        length = len(data)
+        if not length:
+            if buf is not None and self._pool is not None:
+                self._pool.release(buf)
+            return
+        self._chunks.append((data, buf))
+        self._size += length
+
+    def front(self):
+        """memoryview of unconsumed bytes in first chunk"""
+        data = memoryview(self._chunks[0][0])
+        return data[self._offset:] if self._offset else data
+
+    def consume(self, length):
+        """drop `length` bytes from head, e.g. after they have been sent"""
+        self._size -= length
+        chunks = self._chunks
+        while length > 0:
+            data, buf = chunks[0]
+            left = len(data) - self._offset
+            if length < left:
+                self._offset += length
+                return
+            length -= left
+            chunks.popleft()
+            self._offset = 0
+            if buf is not None and self._pool is not None:
+                self._pool.release(buf)
+
+    def segments(self, max_count):
+        """
+        unconsumed data of first `max_count` chunks, as list of (chunk, 
+        start, length).
+        """
+        result = []
+        offset = self._offset
+        for data, buf in self._chunks:
+            if len(result) >= max_count:
+                break
+            result.append((data, offset, len(data) - offset))
+            offset = 0
+        return result
+
+    def peek(self, size):
+        """return up to `size` bytes from head without consuming them"""
+        parts = []
+        remaining = size
+        offset = self._offset
+        for data, _ in self._chunks:
+            if remaining <= 0:
+                break
+            part = memoryview(data)[offset:offset + remaining].tobytes()
+            parts.append(part)
+            remaining -= len(part)
+            offset = 0
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def pop(self, size):
+        data = self.peek(size)
+        self.consume(len(data))
+        return data
+
+    def clear(self):
+        while self._chunks:
+            data, buf = self._chunks.popleft()
+            if buf is not None and self._pool is not None:
+                self._pool.release(buf)
+        self._offset = 0
+        self._size = 0
+
+
+def test_consume():
+    pool = BufferPool(8, max_free=4)
+    queue = ChunkQueue(pool)
+    bufs = []
+    for part in (b'abcdefgh', b'ijk'):
+        buf = pool.acquire()
+        buf[:len(part)] = part
+        queue.append(memoryview(buf)[:len(part)], buf)
+        bufs.append(buf)
+    queue.append(b'lmnop')
+    queue.append(b'')       # ignored
+    assert len(queue) == 16 and queue.peek(10) == b'abcdefghij'
+    queue.consume(3)
+    assert queue.front().tobytes() == b'defgh' and len(pool) == 0
+    # ends exactly at first chunk, its buffer goes back to pool
+    queue.consume(5)
+    assert queue.front().tobytes() == b'ijk' and len(pool) == 1
+    # across two chunks, partly into third
+    queue.consume(4)
+    assert queue.front().tobytes() == b'mnop' and len(pool) == 2
+    assert len(queue) == 4
+    assert [(d, s, l) for d, s, l in queue.segments(8)] == [(b'lmnop', 1, 4)]
+    assert queue.pop(10) == b'mnop' and not queue
+    assert sorted(map(id, pool._free)) == sorted(map(id, bufs))
+
+
+def test_segments():
+    from ss import utils
+    queue = ChunkQueue()
+    for i in range(utils.IOV_MAX + 5):
+        queue.append(b'%04d' % i)
+    queue.consume(2)
+    segments = queue.segments(utils.IOV_MAX)
+    assert len(segments) == utils.IOV_MAX
+    assert segments[0] == (b'0000', 2, 2) and segments[1] == (b'0001', 0, 4)
+    assert segments[-1][0] == b'%04d' % (utils.IOV_MAX - 1)
+    assert len(queue.segments(3)) == 3
+    queue.clear()
+    assert not queue and queue.segments(utils.IOV_MAX) == []
+
+
+def test_max_free():
+    pool = BufferPool(16, max_free=2)
+    bufs = [pool.acquire() for _ in range(4)]
+    assert len(pool) == 0 and all(len(buf) == 16 for buf in bufs)
+    for buf in bufs:
+        pool.release(buf)
+    assert len(pool) == 2       # the rest are left to gc
+    assert pool.acquire() is bufs[1] and pool.acquire() is bufs[0]
+    assert id(pool.acquire()) not in map(id, bufs)
+    # chunks dropped by `clear` are trimmed the same way
+    queue = ChunkQueue(pool)
+    for buf in [pool.acquire() for _ in range(3)]:
+        queue.append(memoryview(buf)[:1], buf)
+    queue.clear()
+    assert len(pool) == 2
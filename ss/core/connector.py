@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+connect to a dual-stack host, Happy Eyeballs style (RFC 8305).
+
+a host often has addresses of both families, but broken ipv6 route is still
+common, and connecting to a black hole stalls until tcp gives up. so
+`HappyEyeballs` doesn't wait for one address after another: an attempt is
+started every `ATTEMPT_DELAY` seconds, or at once when the last one fails,
+and the first connected socket wins, other attempts are closed.
+"""
+import errno
+import logging
+import os
+import socket
+from ss import utils
+from ss.ioloop import IOLoop
+
+
+class HappyEyeballs(object):
+
+    ATTEMPT_DELAY = 0.25    # RFC 8305 recommends 250ms
+
+    def __init__(self, io_loop, ips, port, callback):
+        """
+        @params:
+            ips, addresses to try in order, see `asyncdns.sort_addresses`
+            callback, `callback(sock, sa, error)` gets the connected
+                      socket, which is removed from `io_loop`, or the
+                      error of last attempt if none is connected
+        """
+        self.io_loop = io_loop
+        self._ips = list(ips)
+        self._port = port
+        self._callback = callback
+        self._attempts = {}     # {fd: (sock, sa)}
+        self._timer = None
+        self._error = None
+        self._closed = False
+        self._keepalive = True  # not watched by timing wheel
+
+    def start(self):
+        self._next_attempt()
+
+    def _next_attempt(self):
+        self.io_loop.cancel(self._timer)
+        self._timer = None
+        while self._ips:
+            ip = self._ips.pop(0)
+            sock = None
+            try:
+                addrs = socket.getaddrinfo(ip, self._port, 0,
+                                           socket.SOCK_STREAM, socket.SOL_TCP)
+                af, socktype, proto, canonname, sa = addrs[0]
+                sock = socket.socket(af, socktype, proto)
+                sock.setblocking(False)
+                sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+                sock.connect(sa)
+            except (OSError, IOError) as e:
+                if sock is None or utils.errno_from_exception(e) not in \
+                        (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    # e.g. no route of this family, try next one at once
+                    logging.debug("connect to %s:%d failed: %s" % (
+                        ip, self._port, e))
+                    self._error = e
+                    if sock is not None:
+                        sock.close()
+                    continue
+            self._attempts[sock.fileno()] = (sock, sa)
+            self.io_loop.register(sock, IOLoop.WRITE | IOLoop.ERROR, self)
+            if self._ips:
+                self._timer = self.io_loop.call_later(self.ATTEMPT_DELAY,
+                                                      self._next_attempt)
+            return
+        if not self._attempts:
+            self._finish(None, None, self._error or
+                         Exception('no address to connect'))
+
+    def handle_events(self, sock, fd, events):
+        if fd not in self._attempts:
+            return
+        sock, sa = self._attempts.pop(fd)
+        self.io_loop.remove(sock)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err or events & IOLoop.ERROR:
+            logging.debug("connect to %s:%d failed: %s" % (
+                sa[:2] + (os.strerror(err) if err else 'socket error', )))
+            self._error = socket.error(err, os.strerror(err))
+            sock.close()
+            self._next_attempt()    # don't wait for the timer
+            return
+        self._finish(sock, sa, None)
+
+    def _finish(self, sock, sa, error):
+        callback = self._callback
+        self.destroy()
+        callback(sock, sa, error)
+
+    def destroy(self):
+        """close all attempts, callback is not called any more"""
+        if self._closed:
+            return
+        self._closed = True
+        self.io_loop.cancel(self._timer)
+        self._timer = None
+        for sock, sa in self._attempts.values():
+            self.io_loop.remove(sock)
+            sock.close()
+        self._attempts = {}
+        self._callback = None
+
+
+def test_happy_eyeballs():
+    import time
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    port = listener.getsockname()[1]
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.2', port))    # nothing listens on it
+    io_loop = IOLoop()
+    results = []
+
+    def callback(sock, sa, error):
+        results.append((sock, sa, error))
+        io_loop.stop()
+
+    # refused at once, the next address is tried without delay
+    start = time.time()
+    HappyEyeballs(io_loop, ['127.0.0.2', '127.0.0.1'], port,
+                  callback).start()
+    io_loop.call_later(2, io_loop.stop)
+    io_loop.run()
+    sock, sa, error = results.pop()
+    assert error is None and sa == ('127.0.0.1', port)
+    assert time.time() - start < HappyEyeballs.ATTEMPT_DELAY
+    sock.close()
+
+    # all fail
+    HappyEyeballs(io_loop, ['127.0.0.2'], port, callback).start()
+    io_loop.run()
+    sock, sa, error = results.pop()
+    assert sock is None and error is not None
+
+    # the next attempt waits, and is cancelled when the first one wins
+    connector = HappyEyeballs(io_loop, ['127.0.0.1', '127.0.0.2'], port,
+                              callback)
+    connector.start()
+    assert len(connector._attempts) == 1 and connector._timer is not None
+    io_loop.run()
+    sock, sa, error = results.pop()
+    assert error is None and sa == ('127.0.0.1', port)
+    assert connector._ips == ['127.0.0.2'] and connector._timer is None
+    sock.close()
+    closed.close()
+    listener.close()
+
+
+if __name__ == '__main__':
+    test_happy_eyeballs()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+en/decrypt large tcp chunks on worker threads.
+
+ctypes releases GIL while libcrypto or libsodium is working, so chunks of
+different connections can be en/decrypted on several cores at once. a
+connection hands at most one chunk to `CryptoExecutor` at a time, so its
+cipher is never used by two threads, and its stream keeps in order, see
+`ConnHandler._offload`. results are passed back to loop thread through a
+socketpair which is watched by `IOLoop`.
+"""
+import collections
+import errno
+import logging
+import socket
+import threading
+from ss import utils
+from ss.ioloop import IOLoop
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class CryptoExecutor(object):
+
+    OFFLOAD_SIZE = 16 * 1024    # smaller chunks are cheaper to do inline
+
+    def __init__(self, io_loop, workers=2, offload_size=OFFLOAD_SIZE):
+        self.io_loop = io_loop
+        self.workers = workers
+        self.offload_size = offload_size
+        self._jobs = queue.Queue()
+        self._done = collections.deque()    # (callback, result, error)
+        self._threads = []
+        self._wakeup_r = self._wakeup_w = None
+        self._keepalive = True      # not watched by timing wheel
+        self._registered = False
+
+    def register(self):
+        """start workers, it must be called after fork"""
+        if self._registered:
+            raise Exception('already add to loop')
+        if not self.io_loop:
+            self.io_loop = IOLoop.current()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.io_loop.register(self._wakeup_r, IOLoop.READ | IOLoop.ERROR, self)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='crypto-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._registered = True
+        logging.info("crypto executor: %d workers, offload chunks of %d B "
+                     "and larger" % (self.workers, self.offload_size))
+
+    def submit(self, func, args, callback):
+        """run `func(*args)` on a worker, then `callback(result, error)`
+        on loop thread"""
+        self._jobs.put((func, args, callback))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            func, args, callback = job
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            self._done.append((callback, result, error))
+            try:
+                self._wakeup_w.send(b'\0')
+            except (OSError, IOError) as e:
+                # a full socket buffer has woken up the loop already
+                if utils.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error("crypto executor: %s" % e)
+
+    def handle_events(self, sock, fd, events):
+        while True:
+            try:
+                if not sock.recv(4096):
+                    break
+            except (OSError, IOError) as e:
+                if utils.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logging.error("crypto executor: %s" % e)
+                break
+        # a job done after here sends another byte
+        done = self._done
+        while done:
+            callback, result, error = done.popleft()
+            try:
+                callback(result, error)
+            except Exception as e:
+                logging.error(e, exc_info=True)
+
+    def destroy(self):
+        if not self._registered:
+            return
+        self._registered = False
+        for _ in self._threads:
+            self._jobs.put(None)
+        self._threads = []
+        self.io_loop.remove(self._wakeup_r)
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+
+def test_executor():
+    import time
+    io_loop = IOLoop()
+    executor = CryptoExecutor(io_loop, workers=2)
+    executor.register()
+    results = []
+    loop_thread = threading.current_thread()
+
+    def job(i):
+        time.sleep(0.001 * (i % 3))
+        if i == 5:
+            raise ValueError(i)
+        return i * 2
+
+    def make_callback(i):
+        def callback(result, error):
+            assert threading.current_thread() is loop_thread
+            results.append((i, result, error))
+            if len(results) == 10:
+                io_loop.stop()
+        return callback
+
+    for i in range(10):
+        executor.submit(job, (i, ), make_callback(i))
+    io_loop.call_later(5, io_loop.stop)
+    io_loop.run()
+    assert len(results) == 10
+    for i, result, error in results:
+        if i == 5:
+            assert result is None and isinstance(error, ValueError)
+        else:
+            assert result == i * 2 and error is None
+    executor.destroy()
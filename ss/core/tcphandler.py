@@ -3,173 +3,384 @@ import logging
 import socket
 import errno
 import os
+import time
 import collections
 from ss import encrypt
 from ss import utils
 from ss.ioloop import IOLoop
 from ss.settings import settings
-from .base import BaseTCPHandler, \
+from .base import BaseTCPHandler, buffer_pool, \
     RemoteMixin, LocalMixin, HttpLocalMixin
 
     
 class ConnHandler(BaseTCPHandler):
 
+    EDGE_TRIGGERED = True
+    MAX_READS_PER_EVENT = 8     # in edge-triggered mode, then yield to others
+    PIPE_SIZE = 256 * 1024      # capacity of splice pipe
+
+    crypto_executor = None      # offloads large chunks, see `CryptoExecutor`
+
     def __init__(self, io_loop, conn, addr, tags):
         self._encryptor = encrypt.Encryptor(settings['password'],
                                             settings['method'])
+        self._offloaded = collections.deque()   # (data, buf), first is running
+        self._offload_size = 0
+        self._eof_pending = False
+        self._resume_pending = False    # `_resume_read` is queued
+        self._recv_size = self.BUF_SIZE
+        if self._encryptor.chunk_size:
+            # read whole aead chunks in bulk transfer, none is sealed short
+            self._recv_size -= self.BUF_SIZE % self._encryptor.chunk_size
         BaseTCPHandler.__init__(self, io_loop, conn, addr, tags)
 
     def handle_events(self, sock, fd, events):
         """
         默认监听read和error, 回调结束后, 会判断当前_read_buf是否为空, 
-        不为空则为peer增加write事件
+        不为空则为peer增加write事件.
+        edge-triggered模式下, 读到EAGAIN为止, 然后直接调用on_write, 
+        不再修改监听事件
         """
         if self._status == self.STAGE_CLOSED:
-            logging.warning("socket %d already closed" % self._sock.fileno())
+            logging.warning("socket %d already closed" % fd)
             return
         if events & IOLoop.ERROR:
             self.on_sock_error()
 
-        default_events = IOLoop.ERROR | IOLoop.READ
-
         if events & IOLoop.READ:
-            if self._status == self.STAGE_INIT:
-                self.on_recv_nego()
-            elif self._status == self.STAGET_SOCKS5_NEGO:
-                self.on_recv_syn()
-            elif self._status == self.STAGE_PEER_CONNECTED:
-                self.on_read()
-            else:
-                # it will take few time transfer status from 
-                # STAGE_SOCKS5_SYN to STAGE_DNS_RESOVED. During 
-                # this period, fd may become readable. 
-                self.on_read()
+            self._sock_readable = True
+            reads = 0
+            while self._sock_readable and self._sock and \
+                    not self.read_paused:
+                self._dispatch_read()
+                reads += 1
+                if not self._edge_triggered or \
+                        reads >= self.MAX_READS_PER_EVENT:
+                    break
         if events & IOLoop.WRITE:
+                self._sock_writable = True
                 self.on_write()
 
         if self._status == self.STAGE_CLOSED:       # socket may be closed in callback func
             return
 
-        _events = default_events | IOLoop.WRITE if self.writable \
-            else default_events
-        self.update_events(_events)
-
         peer = self.peer
+        if self._edge_triggered:
+            if self._sock_writable and self.writable:
+                self.on_write()
+            if peer and peer._sock_writable and peer.writable:
+                peer.on_write()
+            for handler in (self, peer):
+                if handler and handler._sock_readable and handler._sock \
+                        and not handler.read_paused \
+                        and not handler._resume_pending:
+                    # no new edge would come, continue in next iteration
+                    handler._resume_pending = True
+                    self.io_loop.call_soon(handler._resume_read)
+            return
+
+        self.update_events(self.interest)
         if peer:
-            peer_events = default_events | IOLoop.WRITE if peer.writable \
-                else default_events
-            peer.update_events(peer_events)
+            peer.update_events(peer.interest)
+
+    def _resume_read(self):
+        self._resume_pending = False
+        if self._status == self.STAGE_CLOSED or not self._sock:
+            return
+        self.io_loop.touch(self._sock)     # it is active without events
+        self.handle_events(self._sock, self._sock.fileno(), IOLoop.READ)
+
+    def _dispatch_read(self):
+        if self._status == self.STAGE_INIT:
+            self.on_recv_nego()
+        elif self._status == self.STAGET_SOCKS5_NEGO:
+            self.on_recv_syn()
+        elif self._status == self.STAGE_PEER_CONNECTED:
+            self.on_read()
+        else:
+            # it will take few time transfer status from 
+            # STAGE_SOCKS5_SYN to STAGE_DNS_RESOVED. During 
+            # this period, fd may become readable. 
+            self.on_read()
 
     @property
     def writable(self):
+        peer = self.peer
         return bool(self._write_buf or 
-            (self.peer and self.peer._read_buf))
+            (peer and (peer._read_buf or peer._pipe_size)))
+
+    @property
+    def read_paused(self):
+        """stop reading when pipe is full or too much data is waiting 
+        for peer, until peer drains it"""
+        return self._pipe_full or self._read_paused or self._eof_pending
+
+    @property
+    def interest(self):
+        """events to poll in level-triggered mode"""
+        events = IOLoop.ERROR
+        if not self.read_paused:
+            events |= IOLoop.READ
+        if self.writable:
+            events |= IOLoop.WRITE
+        return events
 
 
     def update_events(self, events):
-        """"""
-        if self._sock:
+        """only modify interest mask when it really changes"""
+        if self._sock and events != self._events:
             self.io_loop.modify(self._sock, events)
             self._events = events
                 
     def on_write(self):
-        # NOTICE 写数据时, 都是从对方的read_buf取出数据写的
+        # NOTICE 写数据时, 先写自己的write_buf(握手应答等), 再从对方的read_buf取出数据写
+        peer_handler = self.peer
+        if not peer_handler:
+            return self._send_queues((self._write_buf, ))
+        num_bytes = self._send_queues((self._write_buf, peer_handler._read_buf))
+        if peer_handler._read_paused and \
+                peer_handler._rbuf_size <= peer_handler._low_water:
+            peer_handler._read_paused = False
+        if not (self._write_buf or peer_handler._read_buf) and \
+                peer_handler._pipe_size:
+            num_bytes += self._splice_out(peer_handler)
+        return num_bytes
+
+    def _send_queues(self, queues):
+        """
+        send chunks in `queues` in order. up to `IOV_MAX` chunks are handed to
+        kernel in one syscall, so the first flight of a tunnel (iv, address
+        header and payload) usually goes out in a single segment.
+        """
         num_bytes = 0
-        peer_handler = self.peer     
-               
-        if not peer_handler:    # if peer not created
-            write_buf = self._write_buf
-        else:
-            write_buf = peer_handler._read_buf
-            if self._write_buf:     
-                # self._write_buf中一般不会有数据, 有数据时
-                # peer_handler._read_buf肯定为空, 此次操作
-                # 时间为O(1)
-                utils.merge_prefix(self._write_buf, self.BUF_SIZE)                    
-                data = self._write_buf.popleft()
-                write_buf.appendleft(data)   
-                peer_handler._rbuf_size += len(data)
-                self._wbuf_size -= len(data)
-
-
-        if not write_buf:
-            return num_bytes
-        utils.merge_prefix(write_buf, self.BUF_SIZE)
-        while write_buf:
-            try:
-                if not self._sock:
+        while self._sock:
+            segments = []
+            for write_buf in queues:
+                segments.extend(write_buf.segments(utils.IOV_MAX - len(segments)))
+                if len(segments) >= utils.IOV_MAX:
                     break
-                length = self._sock.send(write_buf[0])
-                if length:
-                    utils.merge_prefix(write_buf, length)
-                    write_buf.popleft()
-                    num_bytes += length
+            if not segments:
+                break
+            try:
+                if len(segments) > 1 and utils.sendmsg:
+                    length = utils.sendmsg(self._sock, segments)
                 else:
-                    break
+                    data, start, size = segments[0]
+                    length = self._sock.send(memoryview(data)[start:start + size])
             except (socket.error, IOError, OSError) as e:
                 error_no = utils.errno_from_exception(e)
                 if error_no in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):     # 缓冲区满
-                    break
+                    self._sock_writable = False
                 else:
                     logging.error(e)
                     self.destroy()
-                    break
-        if not peer_handler:
-            self._wbuf_size -= num_bytes
-        else:
-            peer_handler._rbuf_size -= num_bytes
-        logging.debug("TCP: send {:6d} B to   {:15s}:{:5d} ".format(num_bytes, *self._addr))
+                break
+            if not length:
+                break
+            num_bytes += length
+            for write_buf in queues:
+                sent = min(length, len(write_buf))
+                write_buf.consume(sent)
+                length -= sent
+        if num_bytes:
+            logging.debug("TCP: send {:6d} B to   {:15s}:{:5d} ".format(num_bytes, *self._addr))
         return num_bytes
 
-    def on_read(self):
-        data = None
-        if not self._sock:
+    def use_splice(self):
+        if self._pipe:
             return
         try:
-            data = self._sock.recv(self.BUF_SIZE)
+            r, w, capacity = utils.create_pipe(self.PIPE_SIZE)
         except (OSError, IOError) as e:
-            if utils.errno_from_exception(e) in \
-                    (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+            logging.warn("can't create pipe, fallback to copy: %s" % e)
+            return
+        self._pipe = (r, w)
+        self._pipe_capacity = capacity
+
+    def _splice_in(self):
+        room = self._pipe_capacity - self._pipe_size
+        if room <= 0:
+            self._pipe_full = True
+            return
+        try:
+            length = utils.splice(self._sock.fileno(), self._pipe[1], room)
+        except (OSError, IOError) as e:
+            if utils.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.debug(e)
+                self.destroy()
+                return
+            length = None
+        if length == 0:
+            self.destroy()      # EOF
+            return
+        if length:
+            self._pipe_size += length
+            logging.debug("TCP: splice {:6d} B from {:15s}:{:5d} ".format(length, *self._addr))
+            if length == room:
                 return
+        # short or blocked splice, either socket has been drained, or pipe
+        # has run out of buffers
+        if self._pipe_size and utils.bytes_available(self._sock):
+            self._pipe_full = True
+        else:
+            self._sock_readable = False
+
+    def _splice_out(self, peer_handler):
+        num_bytes = 0
+        while peer_handler._pipe_size and self._sock:
+            try:
+                length = utils.splice(peer_handler._pipe[0], self._sock.fileno(),
+                                      peer_handler._pipe_size)
+            except (OSError, IOError) as e:
+                if utils.errno_from_exception(e) in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._sock_writable = False
+                else:
+                    logging.debug(e)
+                    self.destroy()
+                break
+            if not length:
+                break
+            num_bytes += length
+            peer_handler._pipe_size -= length
+            peer_handler._pipe_full = False
+        logging.debug("TCP: splice {:6d} B to   {:15s}:{:5d} ".format(num_bytes, *self._addr))
+        return num_bytes
+
+    def _close_pipe(self):
+        if self._pipe:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
+            self._pipe_size = 0
+
+    def on_read(self):
+        if not self._sock:
+            return
+        if self._pipe:
+            return self._splice_in()
+        if not self._direct_conn and (self._encryptor.aead or
+                (self.togfw and not self._encryptor.iv_sent)):
+            # iv goes before data, no room for it in place, and aead
+            # changes length of data
+            data, buf = self._recv(self._recv_size), None
+        else:
+            data, buf = self._recv_chunk(self.BUF_SIZE)
+        if data is None:
+            return
         if not data:
+            if self._offloaded:
+                self._eof_pending = True    # after chunks in executor
+            else:
+                self.destroy()
+            return
+        executor = self.crypto_executor
+        if self._offloaded or (executor is not None and
+                not self._direct_conn and len(data) >= executor.offload_size):
+            # chunks behind an offloaded one wait for it, to keep in order
+            self._offload(data, buf)
+            return
+        # en/decrypt in place, so data stays in pooled buffer
+        try:
+            data = self._codec(data, None if buf is None else data)
+        except encrypt.DecryptError as e:
+            logging.warning("connection %s:%d: %s" % (self._addr[:2] + (e, )))
             self.destroy()
             return
-        data = self._codec(data)
-        self._read_buf.append(data)
+        self._append_chunk(data, buf)
+
+    def _append_chunk(self, data, buf):
+        if buf is not None and len(data) < self.MIN_POOLED_CHUNK:
+            # don't pin a whole buffer for a small chunk
+            data = data.tobytes()
+            buffer_pool.release(buf)
+            buf = None
+        self._read_buf.append(data, buf)
         date_length = len(data)
-        self._rbuf_size += date_length
         logging.debug("TCP: recv {:6d} B from {:15s}:{:5d} ".format(date_length, *self._addr))
-        if self._rbuf_size >= self.MAX_BUF_SIZE:
-            logging.warn("connection: %s:%d read buffer over flow!" % self._addr)
+        if self._rbuf_size >= self._high_water:
+            # peer is slower than us, wait for it
+            logging.debug("connection: %s:%d paused, %d B pending" % (
+                self._addr[:2] + (self._rbuf_size, )))
+            self._read_paused = True
+
+    def _offload(self, data, buf):
+        self._offloaded.append((data, buf))
+        self._offload_size += len(data)
+        if len(self._offloaded) == 1:
+            self._submit_offloaded()
+        if self._rbuf_size + self._offload_size >= self._high_water:
+            self._read_paused = True
+
+    def _submit_offloaded(self):
+        data, buf = self._offloaded[0]
+        self.crypto_executor.submit(self._codec,
+                                    (data, None if buf is None else data),
+                                    self._on_offloaded)
+
+    def _on_offloaded(self, data, error):
+        """called on loop thread when first offloaded chunk is done"""
+        chunk, buf = self._offloaded.popleft()
+        self._offload_size -= len(chunk)
+        if self._status == self.STAGE_CLOSED or not self._sock:
+            if buf is not None:
+                buffer_pool.release(buf)
+            return
+        if error is not None:
+            if buf is not None:
+                buffer_pool.release(buf)
+            logging.warning("connection %s:%d: %s" % (
+                self._addr[:2] + (error, )))
             self.destroy()
-        
+            return
+        self._append_chunk(data, buf)
+        if self._offloaded:
+            self._submit_offloaded()
+        elif self._eof_pending:
+            self.destroy()
+            return
+        # relay the chunk as if it was just read
+        self.handle_events(self._sock, self._sock.fileno(), 0)
+
     @property
     def togfw(self):
         #    0      0         1      1 
         # remote negative | local positive
         return self._tags == self.ISLOCAL
 
-    def _codec(self, data):
+    def _codec(self, data, out=None):
         if getattr(self, "_direct_conn", False):
-            func = lambda x: x
-        else:
-            func = self._encryptor.encrypt if self.togfw \
-                else self._encryptor.decrypt
-        return func(data)
+            return data
+        func = self._encryptor.encrypt if self.togfw \
+            else self._encryptor.decrypt
+        return func(data, out)
 
     def destroy(self):
         if self._status == self.STAGE_CLOSED:
             logging.info('already destroyed')
             return
         self._status = self.STAGE_CLOSED
+        if self._connector:
+            self._connector.destroy()
+            self._connector = None
         if self._sock:
             logging.debug("   socket connected to %s:%d closed!" % self._addr)
             self.io_loop.remove(self._sock)
             self._sock.close()
             self._sock = None
-            if self._read_buf and self.peer and self.peer._sock:
+            if (self._read_buf or self._pipe_size) and self.peer and self.peer._sock:
                 self.peer.on_write()    # 如果还有数据, 立即触发on_write
+        self._read_buf.clear()
+        self._write_buf.clear()
+        # the first one is still in executor, it is released when it is done
+        while len(self._offloaded) > 1:
+            data, buf = self._offloaded.pop()
+            self._offload_size -= len(data)
+            if buf is not None:
+                buffer_pool.release(buf)
+        self._close_pipe()
         if self.peer:
             op_sock = self.peer._sock
             if op_sock:
@@ -178,6 +389,8 @@ class ConnHandler(BaseTCPHandler):
                 op_sock.close()
                 if self.peer:
                     self.peer._sock = None
+            if self.peer:
+                self.peer._close_pipe()
         self._op_hdl_ref = None
 
     @property
@@ -187,6 +400,9 @@ class ConnHandler(BaseTCPHandler):
         
 class ListenHandler(BaseTCPHandler):
 
+    MAX_ACCEPTS_PER_EVENT = 64
+    STATS_INTERVAL = 60
+
     def __init__(self, io_loop, sa, conn_hdcls, dns_resolver=None):
         """
         @params:
@@ -201,6 +417,11 @@ class ListenHandler(BaseTCPHandler):
         self._conn_hd_cls = conn_hdcls
         self._dns_resolver = dns_resolver
         self._keepalive = True
+        # accept counters, reset every `STATS_INTERVAL` seconds
+        self._accepted = 0
+        self._max_batch = 0
+        self._full_batches = 0
+        self._stats_since = time.time()
 
     def bind(self, sa):
         addrs = socket.getaddrinfo(sa[0], sa[1], 0, socket.SOCK_STREAM, socket.SOL_TCP)
@@ -209,6 +430,9 @@ class ListenHandler(BaseTCPHandler):
         af, socktype, proto, canonname, sa_ = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if settings.get("reuse_port", False):
+            # every worker binds its own socket, kernel balances between them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind(sa_)
         server_socket.setblocking(False)
         if settings.get("fast_open", False):
@@ -220,6 +444,11 @@ class ListenHandler(BaseTCPHandler):
         return server_socket
 
 
+    def register(self, event=None):
+        super(ListenHandler, self).register(event)
+        self._stats_since = time.time()
+        self.io_loop.add_periodic(self.handle_periodic, self.STATS_INTERVAL)
+
     def handle_events(self, sock, fd, events):
         if self._status == self.STAGE_CLOSED:
             logging.warning("handler destoryed!")
@@ -227,22 +456,58 @@ class ListenHandler(BaseTCPHandler):
         if events & self.io_loop.ERROR:
             self.destroy()
             raise Exception('server_socket error')
-        try:
-            conn, addr = self._sock.accept()
-            logging.debug("accept %s:%d" % addr)
-            handler = self._conn_hd_cls(self.io_loop, conn, addr, self._dns_resolver, 
-                                        self.HDL_NEGATIVE)
-            handler.register()
-        except (OSError, IOError) as e:
-            err_no = utils.errno_from_exception(e)
-            if err_no in (errno.EAGAIN, errno.EINPROGRESS,
-                            errno.EWOULDBLOCK):
-                return
-            else:
+        # accept until EAGAIN, but no more than `MAX_ACCEPTS_PER_EVENT`
+        # connections, so that a connection storm cannot starve established
+        # connections. listen socket is level-triggered, the rest will be
+        # accepted in next iteration. aborted connections count too, or a
+        # flood of them would keep us here.
+        batch = attempts = 0
+        while attempts < self.MAX_ACCEPTS_PER_EVENT:
+            attempts += 1
+            try:
+                conn, addr = self._sock.accept()
+            except (OSError, IOError) as e:
+                err_no = utils.errno_from_exception(e)
+                if err_no == errno.ECONNABORTED:    # reset before accepted
+                    continue
+                if err_no not in (errno.EAGAIN, errno.EINPROGRESS,
+                                  errno.EWOULDBLOCK):
+                    logging.error("fatal error: %s" % e)
+                break
+            batch += 1
+            try:
+                conn.setblocking(False)     # accepted socket doesn't inherit it
+                logging.debug("accept %s:%d" % addr[:2])
+                handler = self._conn_hd_cls(self.io_loop, conn, addr, self._dns_resolver, 
+                                            self.HDL_NEGATIVE)
+                handler.register()
+            except (OSError, IOError) as e:
                 logging.error("fatal error: %s" % e)
+        else:
+            self._full_batches += 1     # not drained
+        self._accepted += batch
+        self._max_batch = max(self._max_batch, batch)
+
+    def handle_periodic(self):
+        """report accept rate, full batches mean that connections arrive
+        faster than we accept, and listen backlog may overflow"""
+        now = time.time()
+        elapsed = max(now - self._stats_since, 1e-3)
+        host, port = self._addr[:2]
+        if self._accepted:
+            logging.info("accepted %d connections on %s:%d in %.1fs, %.1f/s, "
+                         "at most %d per wakeup" % (self._accepted, host, port,
+                         elapsed, self._accepted / elapsed, self._max_batch))
+        if self._full_batches:
+            logging.warning("%d wakeups hit accept cap %d on %s:%d, listen "
+                            "backlog %d may overflow" % (self._full_batches,
+                            self.MAX_ACCEPTS_PER_EVENT, host, port, self.BACKLOG))
+        self._stats_since = now
+        self._accepted = self._max_batch = self._full_batches = 0
 
     def destroy(self):
         self._status = self.STAGE_CLOSED
+        self.io_loop.remove_periodic(self.handle_periodic)
         self.io_loop.remove(self._sock)
         self._sock.close()
 
@@ -264,4 +529,329 @@ class HttpLocalConnHandler(ConnHandler, HttpLocalMixin):
 
     def __init__(self,  io_loop, conn, addr, dns_resolver, tags):
         ConnHandler.__init__(self, io_loop, conn, addr, tags)
-        HttpLocalMixin.__init__(self, dns_resolver)
\ No newline at end of file
+        HttpLocalMixin.__init__(self, dns_resolver)
+
+def _handler_pair(io_loop):
+    """
+    two related handlers as if peer has been connected, return them with the
+    other ends of their sockets: client -> handler -> peer -> server
+    """
+    settings.update({"password": b"key", "method": "table"})
+    client, sock = socket.socketpair()
+    peer_sock, server = socket.socketpair()
+    handler = LocalConnHandler(io_loop, sock, ("127.0.0.1", 1), None,
+                               ConnHandler.HDL_NEGATIVE)
+    peer = LocalConnHandler(io_loop, peer_sock, ("127.0.0.1", 2), None,
+                            ConnHandler.HDL_POSITIVE)
+    handler.relate(peer)
+    peer.relate(handler)
+    for s in (client, sock, peer_sock, server):
+        s.setblocking(False)
+    for h in (handler, peer):
+        h._status = h.STAGE_PEER_CONNECTED
+        h._sock_writable = True
+        h.register()
+    return client, handler, peer, server
+
+
+def _send_some(sock, data):
+    try:
+        return sock.send(data)
+    except socket.error as e:
+        assert utils.errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK)
+        return 0
+
+
+def _recv_some(sock, size=65536):
+    try:
+        return sock.recv(size)
+    except socket.error as e:
+        assert utils.errno_from_exception(e) in (errno.EAGAIN, errno.EWOULDBLOCK)
+        return b''
+
+
+def test_splice():
+    if not utils.splice:
+        return
+    io_loop = IOLoop()
+    client, handler, peer, server = _handler_pair(io_loop)
+    handler._direct_conn = peer._direct_conn = True
+    handler.use_splice()
+    peer.use_splice()
+    data = os.urandom(handler._pipe_capacity * 4)
+    sent = 0
+    # nobody drains the pipe, reading pauses when it is full
+    while not handler._pipe_full:
+        sent += _send_some(client, data[sent:])
+        handler.on_read()
+    assert handler.read_paused and handler._pipe_size > 0
+    assert handler._pipe_size <= handler._pipe_capacity
+    assert peer.writable
+    # peer splices out of the pipe, reading goes on
+    received = b''
+    while len(received) < len(data):
+        sent += _send_some(client, data[sent:])
+        if not handler.read_paused:
+            handler.on_read()
+        peer.on_write()
+        received += _recv_some(server)
+    assert received == data
+    assert handler._pipe_size == 0 and not handler.read_paused
+    # EOF closes both sides and their pipes
+    client.close()
+    handler.on_read()
+    assert handler.closed and handler._pipe is None and peer._pipe is None
+    server.setblocking(True)
+    assert server.recv(1) == b''
+    server.close()
+
+
+def test_resume_read():
+    io_loop = IOLoop()
+    client, handler, peer, server = _handler_pair(io_loop)
+    handler._direct_conn = peer._direct_conn = True
+    handler._edge_triggered = peer._edge_triggered = True
+    handler.MAX_READS_PER_EVENT = 1
+    data = os.urandom(handler.BUF_SIZE * 3)
+    assert _send_some(client, data) == len(data)
+    fd = handler._sock.fileno()
+    entry = io_loop._wheel._entries[fd]
+    # the rest is read in next iteration, queued once for several events
+    handler.handle_events(handler._sock, fd, IOLoop.READ)
+    handler.handle_events(handler._sock, fd, IOLoop.READ)
+    assert handler._resume_pending and len(io_loop._callbacks) == 1
+    entry[io_loop._wheel.LAST_ACTIVITY] = 0
+    io_loop._run_timers(time.time())
+    assert entry[io_loop._wheel.LAST_ACTIVITY] > 0     # touched
+    assert handler._resume_pending and len(io_loop._callbacks) == 1
+    io_loop._run_timers(time.time())    # drained, nothing more to read
+    assert not handler._resume_pending and not io_loop._callbacks
+    received = b''
+    while True:
+        chunk = _recv_some(server)
+        if not chunk:
+            break
+        received += chunk
+    assert received == data
+    handler.destroy()
+    client.close()
+    server.close()
+
+
+def test_water_marks():
+    io_loop = IOLoop()
+    client, handler, peer, server = _handler_pair(io_loop)
+    handler._high_water, handler._low_water = 64 * 1024, 16 * 1024
+    peer._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16 * 1024)
+    data = os.urandom(1024 * 1024)
+    sent = 0
+    # server doesn't read, data piles up until high water mark
+    while not handler.read_paused:
+        assert handler._rbuf_size < handler._high_water
+        sent += _send_some(client, data[sent:sent + 16 * 1024])
+        handler.on_read()
+        peer.on_write()
+    assert handler._rbuf_size >= handler._high_water
+    assert not handler.interest & IOLoop.READ
+    # slow server, reading resumes only below low water mark
+    while handler.read_paused:
+        assert handler._rbuf_size > handler._low_water
+        _recv_some(server, 4096)
+        peer.on_write()
+    assert handler._rbuf_size <= handler._low_water
+    assert handler.interest & IOLoop.READ
+    handler.destroy()
+    client.close()
+    server.close()
+
+
+def test_send_queues():
+    # native sendmsg on python 3, and writev by ctypes which python 2 uses
+    funcs = [utils.sendmsg, utils._load_writev()]
+    for sendmsg in [f for i, f in enumerate(funcs) if f and f not in funcs[:i]]:
+        old, utils.sendmsg = utils.sendmsg, sendmsg
+        try:
+            _check_send_queues()
+        finally:
+            utils.sendmsg = old
+
+
+def _check_send_queues():
+    import random
+    from .buffer import ChunkQueue
+    io_loop = IOLoop()
+    client, handler, peer, server = _handler_pair(io_loop)
+    peer._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    queues = (ChunkQueue(buffer_pool), ChunkQueue(buffer_pool), ChunkQueue())
+    parts = [[], [], []]
+    # more chunks than IOV_MAX, bytes and views on pooled buffers
+    for i in range(utils.IOV_MAX + 200):
+        data = os.urandom(random.randint(1, 600))
+        parts[i % 3].append(data)
+        if i % 2:
+            buf = buffer_pool.acquire()
+            buf[:len(data)] = data
+            queues[i % 3].append(memoryview(buf)[:len(data)], buf)
+        else:
+            queues[i % 3].append(data)
+    expected = b''.join(b''.join(p) for p in parts)
+    total = len(expected)
+    sent = partial = 0
+    received = []
+    while sent < total:
+        length = peer._send_queues(queues)
+        sent += length
+        # consumed bytes are exactly those kernel took
+        assert sum(map(len, queues)) == total - sent
+        if sent < total and not peer._sock_writable:
+            partial += 1
+            peer._sock_writable = True
+        received.append(_recv_some(server, 2048))     # slow peer
+    server.setblocking(True)
+    received = b''.join(received)
+    while len(received) < total:
+        received += server.recv(65536)
+    assert received == expected and partial > 1
+    handler.destroy()
+    client.close()
+    server.close()
+
+
+def _offload_pair(io_loop, delay):
+    """handler which offloads every chunk to executor, each takes `delay`
+    seconds, so that several chunks are in flight"""
+    from .cryptopool import CryptoExecutor
+    client, handler, peer, server = _handler_pair(io_loop)
+    executor = CryptoExecutor(io_loop, workers=2, offload_size=1)
+    executor.register()
+    handler.crypto_executor = executor
+    codec = handler._codec
+
+    def slow_codec(data, out=None):
+        time.sleep(delay)
+        return codec(data, out)
+    handler._codec = slow_codec
+    return client, handler, peer, server, executor
+
+
+def _receive(io_loop, sock, length, timeout=5):
+    """run loop until `length` bytes or EOF are received from `sock`,
+    return them and whether EOF is received"""
+    received = []
+    eof = []
+    deadline = time.time() + timeout
+
+    def check():
+        while not eof:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                eof.append(True)
+                break
+            received.append(data)
+        if eof or sum(map(len, received)) >= length or time.time() > deadline:
+            io_loop.stop()
+        else:
+            io_loop.call_later(0.005, check)
+    io_loop.call_soon(check)
+    io_loop.run()
+    return b''.join(received), bool(eof)
+
+
+def test_offload_order():
+    io_loop = IOLoop()
+    client, handler, peer, server, executor = _offload_pair(io_loop, 0.01)
+    depth = []
+    offload = handler._offload
+
+    def record(data, buf):
+        offload(data, buf)
+        depth.append(len(handler._offloaded))
+    handler._offload = record
+    data = os.urandom(handler.BUF_SIZE * 6)
+    client.setblocking(True)
+    client.sendall(data)
+    received, eof = _receive(io_loop, server, len(data))
+    decryptor = encrypt.Encryptor(settings["password"], settings["method"])
+    assert decryptor.decrypt(received) == data and not eof
+    assert max(depth) > 1       # several chunks wait behind the running one
+    assert not handler._offloaded and not handler._offload_size
+    handler.destroy()
+    executor.destroy()
+    client.close()
+    server.close()
+
+
+def test_offload_eof():
+    io_loop = IOLoop()
+    client, handler, peer, server, executor = _offload_pair(io_loop, 0.05)
+    data = os.urandom(handler.BUF_SIZE * 3)
+    client.setblocking(True)
+    client.sendall(data)
+    client.shutdown(socket.SHUT_WR)     # FIN, closing would hang it up
+    # EOF is read while chunks are still in executor
+    head, eof = _receive(io_loop, server, 1)
+    assert handler._eof_pending and handler._offloaded
+    assert handler.read_paused and not handler.closed
+    received, eof = _receive(io_loop, server, len(data) + 1)
+    received = head + received
+    decryptor = encrypt.Encryptor(settings["password"], settings["method"])
+    assert decryptor.decrypt(received) == data and eof
+    assert handler.closed and peer._sock is None
+    executor.destroy()
+    client.close()
+    server.close()
+
+
+def test_offload_destroy():
+    import threading
+    io_loop = IOLoop()
+    client, handler, peer, server, executor = _offload_pair(io_loop, 0)
+    client.setblocking(True)
+    # first chunk is read as bytes, it carries iv
+    client.sendall(b'x')
+    assert len(_receive(io_loop, server, 1)[0]) == 1
+    # the rest is read into pooled buffers, a worker holds the first one
+    codec = handler._codec
+    started, finish = threading.Event(), threading.Event()
+
+    def blocked_codec(data, out=None):
+        started.set()
+        finish.wait(5)
+        return codec(data, out)
+    handler._codec = blocked_codec
+    for _ in range(3):
+        buffer_pool.release(bytearray(buffer_pool.size))
+    free = len(buffer_pool)
+    for _ in range(3):
+        client.sendall(os.urandom(handler.BUF_SIZE))
+        handler.on_read()
+    started.wait(5)
+    assert len(handler._offloaded) == 3
+    assert all(buf is not None for data, buf in handler._offloaded)
+    handler.destroy()
+    # waiting ones are released at once, the running one when it is done
+    assert len(handler._offloaded) == 1
+    assert len(buffer_pool) == free - 3 + 2
+    finish.set()
+    deadline = time.time() + 5
+    while handler._offloaded and time.time() < deadline:
+        io_loop.call_later(0.01, io_loop.stop)
+        io_loop.run()
+    assert not handler._offloaded and not handler._offload_size
+    assert len(buffer_pool) == free
+    executor.destroy()
+    client.close()
+    server.close()
+
+
+if __name__ == '__main__':
+    test_splice()
+    test_resume_read()
+    test_water_marks()
+    test_send_queues()
+    test_offload_order()
+    test_offload_eof()
+    test_offload_destroy()
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+warm connections from sslocal to ssserver.
+
+a new tunnel costs a dns lookup and a tcp handshake before the first byte
+can be relayed, on high latency links that is one more RTT for every page
+load. `TunnelPool` keeps some connections established in advance, and
+`LocalMixin` claims one of them instead of connecting by itself.
+"""
+import collections
+import errno
+import logging
+import socket
+import time
+from ss import utils
+from ss.ioloop import IOLoop
+
+TCP_FASTOPEN_CONNECT = 30   # linux 4.11+, SYN is sent with the first write
+
+
+class TunnelPool(object):
+
+    PROBE_INTERVAL = 10     # seconds between health checks
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, io_loop, addr, dns_resolver, size=4, idle_timeout=60,
+                 fast_open=False):
+        """
+        @params:
+            addr, host and port of ssserver
+            size, number of idle connections to keep
+            idle_timeout, idle connections older than it are closed, it
+                          should be shorter than timeout of ssserver
+            fast_open, connect with TCP_FASTOPEN_CONNECT, handshake is
+                       deferred to the first write and carries data
+        """
+        self.io_loop = io_loop
+        self._addr = addr
+        self._dns_resolver = dns_resolver
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._fast_open = fast_open
+        self._ip = None
+        self._resolving = False
+        # {fd: (sock, sa, since, registered)}, sockets connected with
+        # TCP_FASTOPEN_CONNECT are not in loop until they are claimed
+        self._idle = collections.OrderedDict()
+        self._connecting = {}                   # {fd: (sock, sa, since)}
+        self._keepalive = True      # not watched by timing wheel
+        self._registered = False
+        self._closed = False
+        self._claimed = 0
+        self._missed = 0
+
+    def register(self):
+        if self._registered:
+            raise Exception('already add to loop')
+        if not self.io_loop:
+            self.io_loop = IOLoop.current()
+        self.io_loop.add_periodic(self.handle_periodic, self.PROBE_INTERVAL)
+        self._registered = True
+        self._fill()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def claim(self):
+        """return (sock, sockaddr) of an established connection, or None"""
+        while self._idle:
+            fd, (sock, sa, since, registered) = self._idle.popitem(last=False)
+            if registered:
+                self.io_loop.remove(sock)
+            if not self._alive(sock):
+                sock.close()
+                continue
+            self._claimed += 1
+            self.io_loop.call_soon(self._fill)
+            return sock, sa
+        self._missed += 1
+        self.io_loop.call_soon(self._fill)
+        return None
+
+    def _fill(self):
+        if self._closed or self._resolving:
+            return
+        if self._size - len(self._idle) - len(self._connecting) <= 0:
+            return
+        # resolve on every fill, resolver answers from its cache until ttl
+        # expires, so a new address of ssserver is followed
+        self._resolving = True
+        self._dns_resolver.resolve(self._addr[0], self._on_resolved)
+
+    def _on_resolved(self, result, error):
+        self._resolving = False
+        if self._closed:
+            return
+        if error or not result or not result[1]:
+            logging.warning("tunnel pool: can't resolve %s: %s" % (
+                self._addr[0], error))
+            return
+        ip = utils.to_str(result[1])
+        if ip != self._ip:
+            if self._ip:
+                logging.info("tunnel pool: %s moved from %s to %s" % (
+                    self._addr[0], self._ip, ip))
+            self._ip = ip
+            for fd, (sock, sa, since, registered) in list(self._idle.items()):
+                if sa[0] != ip:     # still to the old address
+                    del self._idle[fd]
+                    self._discard(sock)
+        for _ in range(self._size - len(self._idle) - len(self._connecting)):
+            if not self._connect():
+                break
+
+    def _connect(self):
+        try:
+            addrs = socket.getaddrinfo(self._ip, self._addr[1], 0,
+                                       socket.SOCK_STREAM, socket.SOL_TCP)
+            af, socktype, proto, canonname, sa = addrs[0]
+            sock = socket.socket(af, socktype, proto)
+        except (OSError, IOError) as e:
+            logging.warning("tunnel pool: %s" % e)
+            return False
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        deferred = False
+        if self._fast_open:
+            try:
+                sock.setsockopt(socket.SOL_TCP, TCP_FASTOPEN_CONNECT, 1)
+                deferred = True
+            except (OSError, IOError):
+                logging.warning("tunnel pool: TCP_FASTOPEN_CONNECT is not "
+                                "available, fall back to normal connect")
+                self._fast_open = False
+        try:
+            sock.connect(sa)
+        except (OSError, IOError) as e:
+            if utils.errno_from_exception(e) not in \
+                    (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                logging.warning("tunnel pool: connect to %s:%d failed: %s" % (
+                    sa[:2] + (e, )))
+                sock.close()
+                return False
+            deferred = False
+        now = time.time()
+        if deferred:
+            # nothing is sent before the first write, no event to watch
+            self._idle[sock.fileno()] = (sock, sa, now, False)
+        else:
+            self._connecting[sock.fileno()] = (sock, sa, now)
+            self.io_loop.register(sock, IOLoop.WRITE | IOLoop.ERROR, self)
+        return True
+
+    def handle_events(self, sock, fd, events):
+        if fd in self._connecting:
+            sock, sa, since = self._connecting.pop(fd)
+            if events & IOLoop.ERROR or \
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                logging.warning("tunnel pool: connect to %s:%d failed: %s" % (
+                    sa[:2] + (utils.get_sock_error(sock), )))
+                self._discard(sock)
+                return
+            # an idle tunnel becomes readable only when server closes it
+            self.io_loop.modify(sock, IOLoop.READ | IOLoop.ERROR)
+            self._idle[fd] = (sock, sa, time.time(), True)
+        elif fd in self._idle:
+            logging.debug("tunnel pool: idle tunnel closed by server")
+            self._idle.pop(fd)
+            self._discard(sock)
+
+    def handle_periodic(self):
+        """drop expired and broken connections, then fill up pool"""
+        now = time.time()
+        for fd, (sock, sa, since, registered) in list(self._idle.items()):
+            if now - since > self._idle_timeout or not self._alive(sock):
+                del self._idle[fd]
+                self._discard(sock)
+        for fd, (sock, sa, since) in list(self._connecting.items()):
+            if now - since > self.CONNECT_TIMEOUT:
+                del self._connecting[fd]
+                self._discard(sock)
+        if self._claimed or self._missed:
+            logging.debug("tunnel pool: %d claimed, %d missed, %d idle" % (
+                self._claimed, self._missed, len(self._idle)))
+            self._claimed = self._missed = 0
+        self._fill()
+
+    def _alive(self, sock):
+        """whether `sock` is neither closed nor failed. a deferred fast open
+        socket has not connected yet, it fails only if something is wrong
+        with it locally"""
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except (OSError, IOError) as e:
+            return utils.errno_from_exception(e) in \
+                (errno.EAGAIN, errno.EWOULDBLOCK)
+        return False    # closed by server, or unexpected data
+
+    def _discard(self, sock):
+        try:
+            self.io_loop.remove(sock)
+        except (KeyError, ValueError, OSError, IOError):
+            pass
+        sock.close()
+
+    def destroy(self):
+        self._closed = True
+        if self._registered:
+            self.io_loop.remove_periodic(self.handle_periodic)
+            self._registered = False
+        for sock, sa, since, registered in self._idle.values():
+            self._discard(sock)
+        for sock, sa, since in self._connecting.values():
+            self._discard(sock)
+        self._idle.clear()
+        self._connecting.clear()
+
+
+class _FakeResolver(object):
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.calls = 0
+
+    def resolve(self, hostname, callback):
+        self.calls += 1
+        callback((hostname, self.ip), None)
+
+
+def _closed(sock):
+    try:
+        return sock.fileno() == -1
+    except socket.error:    # python 2
+        return True
+
+
+def _run_until(io_loop, condition, timeout=2):
+    deadline = time.time() + timeout
+
+    def check():
+        if condition() or time.time() > deadline:
+            io_loop.stop()
+        else:
+            io_loop.call_later(0.01, check)
+    io_loop.call_soon(check)
+    io_loop.run()
+    assert condition()
+
+
+def test_tunnel_pool():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('0.0.0.0', 0))
+    listener.listen(16)
+    listener.settimeout(1)
+    port = listener.getsockname()[1]
+    io_loop = IOLoop()
+    resolver = _FakeResolver('127.0.0.1')
+    pool = TunnelPool(io_loop, ('ss.example.com', port), resolver, size=2)
+    pool.register()
+    assert resolver.calls == 1 and len(pool._connecting) == 2
+    _run_until(io_loop, lambda: len(pool) == 2)
+    accepted = [listener.accept()[0] for _ in range(2)]
+
+    # claim, then pool fills up again, resolving through cache again
+    sock, sa = pool.claim()
+    assert sa == ('127.0.0.1', port)
+    _run_until(io_loop, lambda: len(pool) == 2)
+    assert resolver.calls == 2 and pool._claimed == 1
+    sock.close()
+    accepted.append(listener.accept()[0])
+
+    # closed by server before claimed, the probe drops them
+    for conn in accepted:
+        conn.close()
+    assert pool.claim() is None and pool._missed == 1 and not len(pool)
+    _run_until(io_loop, lambda: len(pool) == 2)
+    accepted = [listener.accept()[0] for _ in range(2)]
+
+    # idle ones expire, fresh ones are connected to the new address
+    old = [entry[0] for entry in pool._idle.values()]
+    pool.handle_periodic()
+    assert len(pool) == 2       # neither expired nor moved
+    for fd, entry in list(pool._idle.items()):
+        pool._idle[fd] = entry[:2] + (time.time() - 61, ) + entry[3:]
+    resolver.ip = '127.0.0.2'
+    pool.handle_periodic()
+    assert not len(pool) and all(_closed(s) for s in old)
+    _run_until(io_loop, lambda: len(pool) == 2)
+    assert all(entry[1][0] == '127.0.0.2' for entry in pool._idle.values())
+    accepted += [listener.accept()[0] for _ in range(2)]
+
+    # a newer address drops idle tunnels to the old one
+    resolver.ip = '127.0.0.1'
+    assert pool.claim() is not None
+    _run_until(io_loop, lambda: len(pool) == 2)
+    assert all(entry[1][0] == '127.0.0.1' for entry in pool._idle.values())
+    pool.destroy()
+    assert not len(pool) and not pool._connecting
+    for conn in accepted:
+        conn.close()
+    listener.close()
+
+
+def test_fast_open_probe():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    io_loop = IOLoop()
+    pool = TunnelPool(io_loop, ('127.0.0.1', listener.getsockname()[1]),
+                      _FakeResolver('127.0.0.1'), size=2, fast_open=True)
+    pool.register()
+    _run_until(io_loop, lambda: len(pool) == 2)
+    # connect is deferred only once kernel has a fast open cookie of server,
+    # such a socket never connected, it is probed as well
+    for sock, sa, since, registered in pool._idle.values():
+        assert pool._alive(sock)
+    probed = []
+    pool._alive = lambda sock: probed.append(sock) and False
+    assert pool.claim() is None and len(probed) == 2
+    pool.destroy()
+    listener.close()
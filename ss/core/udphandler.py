@@ -191,6 +191,8 @@ class ListenHandler(object):
         af, socktype, proto, canonname, sa = addrs[0]
         sock = socket.socket(af, socktype, proto)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if settings.get("reuse_port", False):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind(tuple(sa))
         sock.setblocking(False)
         return sock
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+framing of AEAD ciphers, compatible with shadowsocks AEAD protocol.
+
+a tcp stream is `[salt][length][length tag][payload][payload tag]...`,
+length is 2 bytes big endian and payload is at most `PAYLOAD_SIZE` bytes.
+length and payload are sealed separately, each with its own nonce, which is
+a little endian counter increased after every use. a udp packet is
+`[salt][payload][tag]` sealed with zero nonce. the key of a cipher is
+HKDF-SHA1(master key, salt, "ss-subkey").
+
+backends implement `_seal` and `_open` on raw addresses, so chunks of one
+`update` are en/decrypted into one output buffer, and copied out once.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hashlib
+import struct
+from ctypes import c_char_p, c_void_p, cast, addressof, string_at
+
+from ss.crypto import util
+
+__all__ = ['AeadCryptoBase', 'DecryptError', 'PAYLOAD_SIZE']
+
+PAYLOAD_SIZE = 0x3FFF
+TAG_LEN = 16
+NONCE_LEN = 12
+LENGTH_LEN = 2
+SUBKEY_INFO = b'ss-subkey'
+
+# overhead of a chunk
+CHUNK_OVERHEAD = LENGTH_LEN + TAG_LEN * 2
+
+
+class DecryptError(Exception):
+    """data is forged, corrupted, or encrypted with another key"""
+
+
+_trans_5c = bytes(bytearray((x ^ 0x5C) for x in range(256)))
+_trans_36 = bytes(bytearray((x ^ 0x36) for x in range(256)))
+
+
+def hmac_sha1(key, msg):
+    # `hmac.new` is slow for a new key on each udp packet
+    if len(key) > 64:
+        key = hashlib.sha1(key).digest()
+    key = key.ljust(64, b'\0')
+    inner = hashlib.sha1(key.translate(_trans_36) + msg).digest()
+    return hashlib.sha1(key.translate(_trans_5c) + inner).digest()
+
+
+def hkdf_sha1(key, salt, info, length):
+    prk = hmac_sha1(salt, key)
+    okm = b''
+    block = b''
+    i = 1
+    while len(okm) < length:
+        block = hmac_sha1(prk, block + info + struct.pack('B', i))
+        okm += block
+        i += 1
+    return okm[:length]
+
+
+def _address(data):
+    # c_char_p on bytes points to its internal buffer, no copy
+    return cast(c_char_p(data), c_void_p).value
+
+
+def _out_buffer(size):
+    return addressof(util.scratch_buffer(size))
+
+
+class AeadCryptoBase(object):
+    """
+    subclass implements (and `_set_subkey()` if subkey is kept elsewhere):
+        _seal(nonce, dst, src, length), write `length` bytes encrypted
+            from `src` and the tag to `dst`
+        _open(nonce, dst, src, length), verify the tag following `length`
+            bytes at `src` and decrypt them to `dst`, return False if the
+            tag is wrong
+    """
+
+    AEAD = True
+
+    def __init__(self, cipher_name, key, iv, op):
+        self._key = key
+        self._subkey = hkdf_sha1(key, iv, SUBKEY_INFO, len(key))
+        self._op = op
+        self._counter = 0
+        self._pending = b''         # received bytes of an incomplete chunk
+        self._payload_len = None    # decrypted length of pending chunk
+
+    def reset(self, iv):
+        """start over with a new salt"""
+        self._subkey = hkdf_sha1(self._key, iv, SUBKEY_INFO, len(self._key))
+        self._set_subkey()
+        self._counter = 0
+        self._pending = b''
+        self._payload_len = None
+
+    def _set_subkey(self):
+        pass
+
+    def _next_nonce(self):
+        nonce = struct.pack('<QI', self._counter & 0xFFFFFFFFFFFFFFFF,
+                            self._counter >> 64)
+        self._counter += 1
+        return nonce
+
+    def update(self, data):
+        if type(data) is not bytes:
+            data = data.tobytes() if isinstance(data, memoryview) \
+                else bytes(data)
+        if self._op:
+            return self._encrypt(data)
+        return self._decrypt(data)
+
+    def _encrypt(self, data):
+        l = len(data)
+        if not l:
+            return b''
+        # chunks are as large as possible, fewer tags to compute and send
+        count = (l + PAYLOAD_SIZE - 1) // PAYLOAD_SIZE
+        dst = _out_buffer(l + count * CHUNK_OVERHEAD)
+        src = _address(data)
+        pos = out = 0
+        while pos < l:
+            size = min(l - pos, PAYLOAD_SIZE)
+            self._seal(self._next_nonce(), dst + out,
+                       struct.pack('>H', size), LENGTH_LEN)
+            out += LENGTH_LEN + TAG_LEN
+            self._seal(self._next_nonce(), dst + out, src + pos, size)
+            out += size + TAG_LEN
+            pos += size
+        return string_at(dst, out)
+
+    def _decrypt(self, data):
+        if self._pending:
+            data = self._pending + data
+        l = len(data)
+        dst = _out_buffer(l)
+        src = _address(data)
+        pos = out = 0
+        while True:
+            if self._payload_len is None:
+                if l - pos < LENGTH_LEN + TAG_LEN:
+                    break
+                if not self._open(self._next_nonce(), dst + out, src + pos,
+                                  LENGTH_LEN):
+                    raise DecryptError('invalid tag of chunk length')
+                size, = struct.unpack('>H', string_at(dst + out, LENGTH_LEN))
+                if size > PAYLOAD_SIZE:
+                    raise DecryptError('invalid chunk length %d' % size)
+                self._payload_len = size
+                pos += LENGTH_LEN + TAG_LEN
+            size = self._payload_len
+            if l - pos < size + TAG_LEN:
+                break
+            if not self._open(self._next_nonce(), dst + out, src + pos, size):
+                raise DecryptError('invalid tag of chunk payload')
+            self._payload_len = None
+            pos += size + TAG_LEN
+            out += size
+        self._pending = data[pos:] if pos < l else b''
+        return string_at(dst, out)
+
+    def update_packet(self, data):
+        """en/decrypt a whole udp packet"""
+        if type(data) is not bytes:
+            data = bytes(data)
+        l = len(data)
+        nonce = b'\0' * NONCE_LEN
+        if self._op:
+            dst = _out_buffer(l + TAG_LEN)
+            self._seal(nonce, dst, _address(data), l)
+            return string_at(dst, l + TAG_LEN)
+        if l < TAG_LEN:
+            raise DecryptError('packet is too short')
+        dst = _out_buffer(l)
+        if not self._open(nonce, dst, _address(data), l - TAG_LEN):
+            raise DecryptError('invalid tag of packet')
+        return string_at(dst, l - TAG_LEN)
+
+    def _seal(self, nonce, dst, src, length):
+        raise NotImplementedError()
+
+    def _open(self, nonce, dst, src, length):
+        raise NotImplementedError()
+
+
+def test_hmac_sha1():
+    import hmac
+    for key in (b'', b'k' * 20, b'k' * 64, b'k' * 100):
+        assert hmac_sha1(key, b'message') == \
+            hmac.new(key, b'message', hashlib.sha1).digest()
+
+
+def test_hkdf_sha1():
+    # RFC 5869, test case 4
+    key = b'\x0b' * 11
+    salt = bytes(bytearray(range(13)))
+    info = bytes(bytearray(range(0xf0, 0xfa)))
+    okm = hkdf_sha1(key, salt, info, 42)
+    assert okm == bytes(bytearray.fromhex(
+        '085a01ea1b10f36933068b56efa5ad81a4f14b822f5b091568a9cdd4f155fda2'
+        'c22e422478d305f3f896'))
+
+
+def run_aead(cipher, decipher, packet_cipher, packet_decipher):
+    from os import urandom
+    import random
+
+    plain = urandom(16384 * 64 + 100)
+    results = []
+    pos = 0
+    while pos < len(plain):
+        l = random.randint(100, 65536)
+        results.append(cipher.update(plain[pos:pos + l]))
+        pos += l
+    c = b''.join(results)
+    results = []
+    pos = 0
+    while pos < len(c):
+        l = random.randint(1, 32768)
+        results.append(decipher.update(c[pos:pos + l]))
+        pos += l
+    assert b''.join(results) == plain
+
+    packet = packet_cipher.update_packet(plain[:1500])
+    assert packet_decipher.update_packet(packet) == plain[:1500]
+    forged = packet[:-1] + struct.pack('B', (ord(packet[-1:]) + 1) % 256)
+    try:
+        packet_decipher.update_packet(forged)
+    except DecryptError:
+        pass
+    else:
+        raise AssertionError('forged packet is accepted')
+
+
+if __name__ == '__main__':
+    test_hmac_sha1()
+    test_hkdf_sha1()
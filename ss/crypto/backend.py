@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+registry of crypto backends.
+
+a method may be implemented by more than one backend, e.g. aes-256-gcm by
+libcrypto through ctypes and by `cryptography` package. `select` picks the
+fastest of them by a short benchmark at startup, unless a backend is given.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import logging
+import os
+import time
+
+from ss.crypto import rc4_md5, openssl, sodium, table, pyca
+
+__all__ = ['BACKENDS', 'default_ciphers', 'providers', 'select']
+
+# {name: modules with `ciphers`}
+BACKENDS = collections.OrderedDict([
+    ('openssl', (openssl, rc4_md5)),    # libcrypto, ctypes
+    ('sodium', (sodium, )),             # libsodium, ctypes
+    ('cryptography', (pyca, )),         # libcrypto, cffi
+    ('builtin', (table, )),
+])
+
+# which backend a method uses when nothing is selected
+DEFAULT_ORDER = ('sodium', 'openssl', 'builtin', 'cryptography')
+
+BENCHMARK_SIZE = 16 * 1024
+BENCHMARK_DURATION = 0.02   # seconds for each backend
+
+
+def providers(method):
+    """return OrderedDict of {backend name: (key_len, iv_len, class)}"""
+    result = collections.OrderedDict()
+    for name in BACKENDS:
+        for module in BACKENDS[name]:
+            if method in module.ciphers:
+                result[name] = module.ciphers[method]
+    return result
+
+
+def default_ciphers():
+    """{method: (key_len, iv_len, class)} of preferred backends"""
+    result = {}
+    for name in reversed(DEFAULT_ORDER):
+        for module in BACKENDS[name]:
+            result.update(module.ciphers)
+    return result
+
+
+def benchmark(method, entry, size=BENCHMARK_SIZE,
+              duration=BENCHMARK_DURATION):
+    """return encryption speed of `entry` in bytes per second"""
+    key_len, iv_len, m = entry
+    cipher = m(method, os.urandom(key_len or 16), os.urandom(iv_len), 1)
+    data = os.urandom(size)
+    count = 0
+    start = time.time()
+    while True:
+        cipher.update(data)
+        count += 1
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return size * count / elapsed
+
+
+def select(method, backend=None):
+    """
+    return (backend name, (key_len, iv_len, class)) for `method`. the
+    fastest available backend is picked if `backend` is None or 'auto'.
+    """
+    candidates = providers(method)
+    if not candidates:
+        raise Exception('method %s not supported' % method)
+    if backend and backend != 'auto':
+        if backend in candidates:
+            logging.info('crypto: %s uses %s backend' % (method, backend))
+            return backend, candidates[backend]
+        logging.warning('crypto: %s backend does not implement %s, select '
+                        'automatically' % (backend, method))
+    speeds = []
+    for name, entry in candidates.items():
+        try:
+            speeds.append((benchmark(method, entry), name))
+        except Exception as e:
+            logging.debug('crypto: %s backend is not available: %s' % (
+                name, e))
+    if not speeds:
+        raise Exception('no backend is available for %s' % method)
+    speeds.sort(reverse=True)
+    logging.info('crypto: %s uses %s backend, %s' % (
+        method, speeds[0][1], ', '.join('%s %.1f MB/s' % (name, speed / 1e6)
+                                        for speed, name in speeds)))
+    return speeds[0][1], candidates[speeds[0][1]]
+
+
+def test_backends_agree():
+    import random
+    plain = os.urandom(100000)
+    methods = set()
+    for name in BACKENDS:
+        for module in BACKENDS[name]:
+            methods.update(module.ciphers)
+    for method in sorted(methods):
+        results = {}
+        for name, (key_len, iv_len, m) in providers(method).items():
+            try:
+                cipher = m(method, b'k' * (key_len or 16), b'i' * iv_len, 1)
+            except Exception:
+                continue    # library or cipher is missing here
+            random.seed(method)     # same chunks for all backends
+            parts = []
+            pos = 0
+            while pos < len(plain):
+                l = random.randint(1, 8192)
+                parts.append(cipher.update(plain[pos:pos + l]))
+                pos += l
+            results[name] = b''.join(parts)
+        assert len(set(results.values())) <= 1, (method, list(results))
+
+
+def test_select():
+    name, entry = select('aes-256-cfb')
+    assert name in BACKENDS
+    entry = providers('aes-256-cfb')['openssl']
+    assert select('aes-256-cfb', 'openssl') == ('openssl', entry)
+    assert select('table', 'sodium')[0] == 'builtin'
+
+
+if __name__ == '__main__':
+    test_backends_agree()
+    test_select()
@@ -17,22 +17,26 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_long, byref,\
-    create_string_buffer, c_void_p
+from ctypes import c_char_p, c_int, byref,\
+    c_void_p, string_at
 
 from ss import utils
-from ss.crypto import util
+from ss.crypto import util, aead
 
 __all__ = ['ciphers']
 
 libcrypto = None
+ctx_cleanup = None
 loaded = False
 
-buf_size = 2048
+# same values for gcm and chacha20-poly1305
+EVP_CTRL_AEAD_SET_IVLEN = 0x9
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
 
 
 def load_openssl():
-    global loaded, libcrypto, buf
+    global loaded, libcrypto, ctx_cleanup
 
     libcrypto = util.find_library(('crypto', 'eay32'),
                                   'EVP_get_cipherbyname',
@@ -47,14 +51,20 @@ def load_openssl():
                                             c_char_p, c_char_p, c_int)
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+                                           c_void_p, c_int)
 
-    libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
+    libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
+    libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int,
+                                              c_void_p)
+
+    # EVP_CIPHER_CTX_cleanup is renamed to EVP_CIPHER_CTX_reset since 1.1.0
+    ctx_cleanup = getattr(libcrypto, 'EVP_CIPHER_CTX_reset', None) or \
+        libcrypto.EVP_CIPHER_CTX_cleanup
+    ctx_cleanup.argtypes = (c_void_p,)
     libcrypto.EVP_CIPHER_CTX_free.argtypes = (c_void_p,)
     if hasattr(libcrypto, 'OpenSSL_add_all_ciphers'):
         libcrypto.OpenSSL_add_all_ciphers()
 
-    buf = create_string_buffer(buf_size)
     loaded = True
 
 
@@ -69,17 +79,31 @@ def load_cipher(cipher_name):
     return None
 
 
+# {name: EVP_CIPHER}, looked up once instead of for each connection
+cached_ciphers = {}
+
+
+def get_cipher(cipher_name):
+    cipher = cached_ciphers.get(cipher_name)
+    if cipher:
+        return cipher
+    if not loaded:
+        load_openssl()
+    name = utils.to_bytes(cipher_name)
+    cipher = libcrypto.EVP_get_cipherbyname(name)
+    if not cipher:
+        cipher = load_cipher(name)
+    if not cipher:
+        raise Exception('cipher %s not found in libcrypto' % name)
+    cached_ciphers[cipher_name] = cipher
+    return cipher
+
+
 class OpenSSLCrypto(object):
     def __init__(self, cipher_name, key, iv, op):
         self._ctx = None
-        if not loaded:
-            load_openssl()
-        cipher_name = utils.to_bytes(cipher_name)
-        cipher = libcrypto.EVP_get_cipherbyname(cipher_name)
-        if not cipher:
-            cipher = load_cipher(cipher_name)
-        if not cipher:
-            raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        cipher = get_cipher(cipher_name)
+        self._key = key
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
         self._ctx = libcrypto.EVP_CIPHER_CTX_new()
@@ -90,26 +114,130 @@ class OpenSSLCrypto(object):
         if not r:
             self.clean()
             raise Exception('can not initialize cipher context')
+        # marshalled once, not on every update
+        self._out_len = c_int(0)
+        self._out_len_ref = byref(self._out_len)
+
+    def reset(self, iv):
+        """start over with a new iv, context and key schedule are reused"""
+        # rc4 has no iv, its state is reset by setting key again
+        key = None if iv else self._key
+        if not libcrypto.EVP_CipherInit_ex(self._ctx, None, None, key, iv, -1):
+            raise Exception('can not reset cipher context')
 
     def update(self, data):
-        global buf_size, buf
-        cipher_out_len = c_long(0)
+        if type(data) is not bytes:
+            return self._update_buffer(data)
         l = len(data)
-        if buf_size < l:
-            buf_size = l * 2
-            buf = create_string_buffer(buf_size)
-        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
-                                   byref(cipher_out_len), c_char_p(data), l)
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        buf = util.scratch_buffer(l)
+        libcrypto.EVP_CipherUpdate(self._ctx, buf, self._out_len_ref, data, l)
+        # copy only the output, buf.raw would copy the whole buffer
+        return string_at(buf, self._out_len.value)
+
+    def _update_buffer(self, data):
+        out = bytearray(len(data))
+        length = self.update_into(data, out)
+        return bytes(out[:length])
+
+    def update_into(self, data, out):
+        """
+        en/decrypt `data` into `out`, a bytearray or writable memoryview 
+        not shorter than `data`. `out` may be `data` itself. return number
+        of bytes written.
+        """
+        dst = utils.get_buffer(out, writable=True)
+        # in place needs only one buffer, which saves a few microseconds
+        src = dst if out is data else utils.get_buffer(data)
+        try:
+            if dst.len < src.len:
+                raise ValueError('output buffer is too small')
+            libcrypto.EVP_CipherUpdate(self._ctx, dst.buf, self._out_len_ref,
+                                       src.buf, src.len)
+            return self._out_len.value
+        finally:
+            if src is not dst:
+                utils.release_buffer(src)
+            utils.release_buffer(dst)
+
+    def __del__(self):
+        self.clean()
+
+    def clean(self):
+        if self._ctx:
+            ctx_cleanup(self._ctx)
+            libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+
+class OpenSSLChacha20Crypto(OpenSSLCrypto):
+    """
+    chacha20 with 8 bytes nonce and 64 bit counter. iv of libcrypto is
+    the whole 16 bytes, counter first.
+    """
+    def __init__(self, cipher_name, key, iv, op):
+        OpenSSLCrypto.__init__(self, b'chacha20', key, b'\0' * 8 + iv, op)
+
+    def reset(self, iv):
+        OpenSSLCrypto.reset(self, b'\0' * 8 + iv)
+
+
+# names in libcrypto
+AEAD_CIPHER_NAMES = {
+    'chacha20-ietf-poly1305': 'chacha20-poly1305',
+}
+
+
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        self._ctx = None
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        cipher = get_cipher(AEAD_CIPHER_NAMES.get(cipher_name, cipher_name))
+        self._ctx = libcrypto.EVP_CIPHER_CTX_new()
+        if not self._ctx:
+            raise Exception('can not create cipher context')
+        # key is set once, nonce is set for each chunk
+        if not libcrypto.EVP_CipherInit_ex(self._ctx, cipher, None, None,
+                                           None, c_int(op)) or \
+                not libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx,
+                                                  EVP_CTRL_AEAD_SET_IVLEN,
+                                                  aead.NONCE_LEN, None):
+            self.clean()
+            raise Exception('can not initialize cipher context')
+        self._set_subkey()
+        self._out_len = c_int(0)
+        self._out_len_ref = byref(self._out_len)
+
+    def _set_subkey(self):
+        if not libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                           self._subkey, None, -1):
+            raise Exception('can not set key of cipher context')
+
+    def _seal(self, nonce, dst, src, length):
+        ctx = self._ctx
+        out_len = self._out_len_ref
+        libcrypto.EVP_CipherInit_ex(ctx, None, None, None, nonce, -1)
+        libcrypto.EVP_CipherUpdate(ctx, dst, out_len, src, length)
+        libcrypto.EVP_CipherFinal_ex(ctx, dst + length, out_len)
+        libcrypto.EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_AEAD_GET_TAG,
+                                      aead.TAG_LEN, dst + length)
+
+    def _open(self, nonce, dst, src, length):
+        ctx = self._ctx
+        out_len = self._out_len_ref
+        libcrypto.EVP_CipherInit_ex(ctx, None, None, None, nonce, -1)
+        libcrypto.EVP_CipherUpdate(ctx, dst, out_len, src, length)
+        libcrypto.EVP_CIPHER_CTX_ctrl(ctx, EVP_CTRL_AEAD_SET_TAG,
+                                      aead.TAG_LEN, src + length)
+        return libcrypto.EVP_CipherFinal_ex(ctx, dst + length, out_len) > 0
 
     def __del__(self):
         self.clean()
 
     def clean(self):
         if self._ctx:
-            libcrypto.EVP_CIPHER_CTX_cleanup(self._ctx)
+            ctx_cleanup(self._ctx)
             libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
 
 
 ciphers = {
@@ -138,6 +266,11 @@ ciphers = {
     'rc2-cfb': (16, 8, OpenSSLCrypto),
     'rc4': (16, 0, OpenSSLCrypto),
     'seed-cfb': (16, 16, OpenSSLCrypto),
+    'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
+    'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
+    'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
+    'chacha20': (32, 8, OpenSSLChacha20Crypto),
+    'chacha20-ietf-poly1305': (32, 32, OpenSSLAeadCrypto),
 }
 
 
@@ -148,6 +281,20 @@ def run_method(method):
 
     util.run_cipher(cipher, decipher)
 
+    cipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 1)
+    decipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 0)
+
+    util.run_cipher_into(cipher, decipher)
+
+
+def run_aead_method(method):
+    key_len = ciphers[method][0]
+    args = (method, b'k' * key_len, b'i' * key_len)
+    aead.run_aead(OpenSSLAeadCrypto(*(args + (1, ))),
+                  OpenSSLAeadCrypto(*(args + (0, ))),
+                  OpenSSLAeadCrypto(*(args + (1, ))),
+                  OpenSSLAeadCrypto(*(args + (0, ))))
+
 
 def test_aes_128_cfb():
     run_method('aes-128-cfb')
@@ -169,6 +316,14 @@ def test_aes_256_ctr():
     run_method('aes-256-ctr')
 
 
+def test_aes_128_gcm():
+    run_aead_method('aes-128-gcm')
+
+
+def test_aes_256_gcm():
+    run_aead_method('aes-256-gcm')
+
+
 def test_bf_cfb():
     run_method('bf-cfb')
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ciphers of `cryptography` package (pyca), if it is installed.
+
+it calls libcrypto through cffi, which costs less per call than ctypes.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+from ctypes import memmove, string_at
+
+from ss.crypto import aead
+
+__all__ = ['ciphers']
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, \
+        modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, \
+        ChaCha20Poly1305
+except ImportError:
+    Cipher = None
+
+
+ALGORITHMS = {
+    'aes': 'AES',
+    'camellia': 'Camellia',
+}
+
+
+class PycaCrypto(object):
+    def __init__(self, cipher_name, key, iv, op):
+        self._key = key
+        self._op = op
+        self._ctx = None
+        if cipher_name == 'chacha20':
+            self._algorithm = self._mode = None
+        else:
+            algorithm, _, mode = cipher_name.split('-')
+            self._algorithm = getattr(algorithms, ALGORITHMS[algorithm])
+            self._mode = getattr(modes, mode.upper())
+        self.reset(iv)
+
+    def reset(self, iv):
+        """start over with a new iv"""
+        if self._algorithm is None:
+            # chacha20, 64 bit counter goes before 8 bytes nonce
+            cipher = Cipher(algorithms.ChaCha20(self._key, b'\0' * 8 + iv),
+                            None, backend=default_backend())
+        else:
+            cipher = Cipher(self._algorithm(self._key), self._mode(iv),
+                            backend=default_backend())
+        self._ctx = cipher.encryptor() if self._op else cipher.decryptor()
+
+    def update(self, data):
+        if type(data) is not bytes:
+            data = data.tobytes() if isinstance(data, memoryview) \
+                else bytes(data)
+        return self._ctx.update(data)
+
+
+class PycaAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        if cipher_name == 'chacha20-ietf-poly1305':
+            self._aead_class = ChaCha20Poly1305
+        else:
+            self._aead_class = AESGCM
+        self._set_subkey()
+
+    def _set_subkey(self):
+        self._aead = self._aead_class(self._subkey)
+
+    def _seal(self, nonce, dst, src, length):
+        if type(src) is not bytes:
+            src = string_at(src, length)
+        result = self._aead.encrypt(nonce, src, None)
+        memmove(dst, result, len(result))
+
+    def _open(self, nonce, dst, src, length):
+        try:
+            result = self._aead.decrypt(
+                nonce, string_at(src, length + aead.TAG_LEN), None)
+        except InvalidTag:
+            return False
+        memmove(dst, result, length)
+        return True
+
+
+if Cipher is None:
+    ciphers = {}
+else:
+    ciphers = {
+        'aes-128-cfb': (16, 16, PycaCrypto),
+        'aes-192-cfb': (24, 16, PycaCrypto),
+        'aes-256-cfb': (32, 16, PycaCrypto),
+        'aes-128-ofb': (16, 16, PycaCrypto),
+        'aes-192-ofb': (24, 16, PycaCrypto),
+        'aes-256-ofb': (32, 16, PycaCrypto),
+        'aes-128-ctr': (16, 16, PycaCrypto),
+        'aes-192-ctr': (24, 16, PycaCrypto),
+        'aes-256-ctr': (32, 16, PycaCrypto),
+        'aes-128-cfb8': (16, 16, PycaCrypto),
+        'aes-192-cfb8': (24, 16, PycaCrypto),
+        'aes-256-cfb8': (32, 16, PycaCrypto),
+        'camellia-128-cfb': (16, 16, PycaCrypto),
+        'camellia-192-cfb': (24, 16, PycaCrypto),
+        'camellia-256-cfb': (32, 16, PycaCrypto),
+        'chacha20': (32, 8, PycaCrypto),
+        'aes-128-gcm': (16, 16, PycaAeadCrypto),
+        'aes-192-gcm': (24, 24, PycaAeadCrypto),
+        'aes-256-gcm': (32, 32, PycaAeadCrypto),
+        'chacha20-ietf-poly1305': (32, 32, PycaAeadCrypto),
+    }
@@ -24,13 +24,27 @@ from ss.crypto import openssl
 __all__ = ['ciphers']
 
 
-def create_cipher(alg, key, iv, op, key_as_bytes=0, d=None, salt=None,
-                  i=1, padding=1):
+def rc4_key(key, iv):
     md5 = hashlib.md5()
     md5.update(key)
     md5.update(iv)
-    rc4_key = md5.digest()
-    return openssl.OpenSSLCrypto(b'rc4', rc4_key, b'', op)
+    return md5.digest()
+
+
+class RC4MD5Crypto(openssl.OpenSSLCrypto):
+    def __init__(self, cipher_name, key, iv, op):
+        self._master_key = key
+        openssl.OpenSSLCrypto.__init__(self, b'rc4', rc4_key(key, iv), b'',
+                                       op)
+
+    def reset(self, iv):
+        self._key = rc4_key(self._master_key, iv)
+        openssl.OpenSSLCrypto.reset(self, b'')
+
+
+def create_cipher(alg, key, iv, op, key_as_bytes=0, d=None, salt=None,
+                  i=1, padding=1):
+    return RC4MD5Crypto(alg, key, iv, op)
 
 
 ciphers = {
@@ -17,24 +17,24 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_ulonglong, byref, \
-    create_string_buffer, c_void_p
+from ctypes import c_char_p, c_int, c_ulonglong, c_void_p, addressof, \
+    cast, create_string_buffer, memmove
 
-from ss.crypto import util
+from ss import utils
+from ss.crypto import util, aead
 
 __all__ = ['ciphers']
 
 libsodium = None
 loaded = False
 
-buf_size = 2048
-
 # for salsa20 and chacha20
 BLOCK_SIZE = 64
+ZEROS = b'\0' * BLOCK_SIZE
 
 
 def load_libsodium():
-    global loaded, libsodium, buf
+    global loaded, libsodium
 
     libsodium = util.find_library('sodium', 'crypto_stream_salsa20_xor_ic',
                                   'libsodium')
@@ -42,17 +42,25 @@ def load_libsodium():
         raise Exception('libsodium not found')
 
     libsodium.crypto_stream_salsa20_xor_ic.restype = c_int
-    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_salsa20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                        c_ulonglong,
                                                        c_char_p, c_ulonglong,
                                                        c_char_p)
     libsodium.crypto_stream_chacha20_xor_ic.restype = c_int
-    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_char_p,
+    libsodium.crypto_stream_chacha20_xor_ic.argtypes = (c_void_p, c_void_p,
                                                         c_ulonglong,
                                                         c_char_p, c_ulonglong,
                                                         c_char_p)
 
-    buf = create_string_buffer(buf_size)
+    libsodium.crypto_aead_chacha20poly1305_ietf_encrypt.restype = c_int
+    libsodium.crypto_aead_chacha20poly1305_ietf_encrypt.argtypes = (
+        c_void_p, c_void_p, c_void_p, c_ulonglong, c_void_p, c_ulonglong,
+        c_void_p, c_char_p, c_char_p)
+    libsodium.crypto_aead_chacha20poly1305_ietf_decrypt.restype = c_int
+    libsodium.crypto_aead_chacha20poly1305_ietf_decrypt.argtypes = (
+        c_void_p, c_void_p, c_void_p, c_void_p, c_ulonglong, c_void_p,
+        c_ulonglong, c_char_p, c_char_p)
+
     loaded = True
 
 
@@ -72,31 +80,109 @@ class SodiumCrypto(object):
             raise Exception('Unknown cipher')
         # byte counter, not block counter
         self.counter = 0
+        # a partially used block is finished through this buffer
+        self._block = create_string_buffer(BLOCK_SIZE)
+        self._block_ptr = addressof(self._block)
+
+    def reset(self, iv):
+        """start over with a new iv"""
+        self.iv = iv
+        self.iv_ptr = c_char_p(iv)
+        self.counter = 0
+
+    def _xor(self, dst, src, l):
+        """en/decrypt `l` bytes at `src`, an address or bytes, to address
+        `dst`"""
+        counter = self.counter
+        self.counter = counter + l
+        padding = counter % BLOCK_SIZE
+        if not padding:
+            self.cipher(dst, src, l, self.iv_ptr, counter // BLOCK_SIZE,
+                        self.key_ptr)
+            return
+        # xor_ic starts at a block boundary, so the rest of current block
+        # goes through the block buffer kept on instance, instead of
+        # padding the whole data
+        head = min(BLOCK_SIZE - padding, l)
+        block = self._block_ptr
+        memmove(block + padding, src, head)
+        self.cipher(block, block, padding + head, self.iv_ptr,
+                    counter // BLOCK_SIZE, self.key_ptr)
+        memmove(dst, block + padding, head)
+        if l > head:
+            # aligned now, straight to `dst`
+            if type(src) is bytes:
+                src = cast(c_char_p(src), c_void_p).value
+            self.cipher(dst + head, src + head, l - head, self.iv_ptr,
+                        (counter + head) // BLOCK_SIZE, self.key_ptr)
 
     def update(self, data):
-        global buf_size, buf
+        if type(data) is not bytes:
+            data = data.tobytes() if isinstance(data, memoryview) \
+                else bytes(data)
         l = len(data)
+        counter = self.counter
+        # xor_ic starts at a block boundary, so data of an unaligned update
+        # goes after the used part of current block. for small data the
+        # concatenation costs less than more calls through ctypes
+        padding = counter % BLOCK_SIZE
+        if padding:
+            data = ZEROS[:padding] + data
+        buf = util.scratch_buffer(padding + l)
+        self.cipher(buf, data, padding + l, self.iv_ptr,
+                    counter // BLOCK_SIZE, self.key_ptr)
+        self.counter = counter + l
+        # slicing copies `l` bytes, while `buf.raw` copies whole buffer
+        return buf[padding:padding + l]
+
+    def update_into(self, data, out):
+        """
+        en/decrypt `data` into `out`, a bytearray or writable memoryview
+        not shorter than `data`. `out` may be `data` itself. return number
+        of bytes written.
+        """
+        dst = utils.get_buffer(out, writable=True)
+        # in place needs only one buffer, which saves a few microseconds
+        src = dst if out is data else utils.get_buffer(data)
+        try:
+            l = src.len
+            if dst.len < l:
+                raise ValueError('output buffer is too small')
+            self._xor(dst.buf, src.buf, l)
+            return l
+        finally:
+            if src is not dst:
+                utils.release_buffer(src)
+            utils.release_buffer(dst)
+
+
+class SodiumAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        if not loaded:
+            load_libsodium()
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        if cipher_name == 'chacha20-ietf-poly1305':
+            self._encrypt_func = \
+                libsodium.crypto_aead_chacha20poly1305_ietf_encrypt
+            self._decrypt_func = \
+                libsodium.crypto_aead_chacha20poly1305_ietf_decrypt
+        else:
+            raise Exception('Unknown cipher')
 
-        # we can only prepend some padding to make the encryption align to
-        # blocks
-        padding = self.counter % BLOCK_SIZE
-        if buf_size < padding + l:
-            buf_size = (padding + l) * 2
-            buf = create_string_buffer(buf_size)
+    def _seal(self, nonce, dst, src, length):
+        self._encrypt_func(dst, None, src, length, None, 0, None,
+                           nonce, self._subkey)
 
-        if padding:
-            data = (b'\0' * padding) + data
-        self.cipher(byref(buf), c_char_p(data), padding + l,
-                    self.iv_ptr, int(self.counter / BLOCK_SIZE), self.key_ptr)
-        self.counter += l
-        # buf is copied to a str object when we access buf.raw
-        # strip off the padding
-        return buf.raw[padding:padding + l]
+    def _open(self, nonce, dst, src, length):
+        return self._decrypt_func(dst, None, None, src,
+                                  length + aead.TAG_LEN, None, 0,
+                                  nonce, self._subkey) == 0
 
 
 ciphers = {
     'salsa20': (32, 8, SodiumCrypto),
     'chacha20': (32, 8, SodiumCrypto),
+    'chacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
 }
 
 
@@ -114,7 +200,46 @@ def test_chacha20():
 
     util.run_cipher(cipher, decipher)
 
+    cipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 1)
+    decipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 0)
+
+    util.run_cipher_into(cipher, decipher)
+
+
+def test_unaligned():
+    from os import urandom
+    import random
+
+    plain = urandom(4096)
+    expected = SodiumCrypto('chacha20', b'k' * 32, b'i' * 8, 1).update(plain)
+    cipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 8, 1)
+    out = bytearray(len(plain))
+    pos = 0
+    while pos < len(plain):
+        l = random.randint(0, 100)
+        chunk = plain[pos:pos + l]
+        how = random.randint(0, 2)
+        if how == 0:
+            out[pos:pos + len(chunk)] = cipher.update(chunk)
+        elif how == 1:
+            out[pos:pos + len(chunk)] = cipher.update(
+                memoryview(bytearray(chunk)))
+        else:
+            cipher.update_into(chunk, memoryview(out)[pos:pos + len(chunk)])
+        pos += len(chunk)
+    assert bytes(out) == expected
+
+
+def test_chacha20_ietf_poly1305():
+    args = ('chacha20-ietf-poly1305', b'k' * 32, b'i' * 32)
+    aead.run_aead(SodiumAeadCrypto(*(args + (1, ))),
+                  SodiumAeadCrypto(*(args + (0, ))),
+                  SodiumAeadCrypto(*(args + (1, ))),
+                  SodiumAeadCrypto(*(args + (0, ))))
+
 
 if __name__ == '__main__':
     test_chacha20()
+    test_unaligned()
+    test_chacha20_ietf_poly1305()
     test_salsa20()
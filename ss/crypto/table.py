@@ -39,11 +39,14 @@ def get_table(key):
     m.update(key)
     s = m.digest()
     a, b = struct.unpack('<QQ', s)
-    table = maketrans(b'', b'')
-    table = [table[i: i + 1] for i in range(len(table))]
+    table = list(range(256))
     for i in range(1, 1024):
-        table.sort(key=lambda x: int(a % (ord(x) + i)))
-    return table
+        # sort keys of all byte values at once, then sort by list lookup,
+        # instead of a python lambda called for each comparison key
+        keys = [a % (x + i) for x in range(256)]
+        table.sort(key=keys.__getitem__)
+    all_bytes = maketrans(b'', b'')
+    return [all_bytes[x: x + 1] for x in table]
 
 
 def init_table(key):
@@ -59,7 +62,13 @@ class TableCipher(object):
         self._encrypt_table, self._decrypt_table = init_table(key)
         self._op = op
 
+    def reset(self, iv):
+        pass
+
     def update(self, data):
+        if type(data) is not bytes:
+            data = data.tobytes() if isinstance(data, memoryview) \
+                else bytes(data)
         if self._op:
             return translate(data, self._encrypt_table)
         else:
@@ -19,6 +19,21 @@ from __future__ import absolute_import, division, print_function, \
 
 import os
 import logging
+import threading
+from ctypes import create_string_buffer
+
+_scratch = threading.local()
+
+
+def scratch_buffer(size):
+    """
+    ctypes buffer of at least `size` bytes for cipher output. each thread
+    has its own, so ciphers may also run on worker threads.
+    """
+    buf = getattr(_scratch, 'buf', None)
+    if buf is None or len(buf) < size:
+        buf = _scratch.buf = create_string_buffer(max(size * 2, 2048))
+    return buf
 
 
 def find_library_nt(name):
@@ -122,6 +137,27 @@ def run_cipher(cipher, decipher):
     assert b''.join(results) == plain
 
 
+def run_cipher_into(cipher, decipher):
+    """same as `run_cipher`, but encrypt into a buffer, and decrypt in place"""
+    from os import urandom
+    import random
+
+    plain = urandom(16384 * 64)
+    cipher_text = bytearray(len(plain))
+    out = memoryview(cipher_text)
+    pos = 0
+    while pos < len(plain):
+        l = random.randint(100, 32768)
+        chunk = plain[pos:pos + l]
+        pos += cipher.update_into(chunk, out[pos:pos + len(chunk)])
+    pos = 0
+    while pos < len(plain):
+        l = random.randint(100, 32768)
+        chunk = out[pos:pos + l]
+        pos += decipher.update_into(chunk, chunk)
+    assert bytes(cipher_text) == plain
+
+
 def test_find_library():
     assert find_library('c', 'strcpy', 'libc') is not None
     assert find_library(['c'], 'strcpy', 'libc') is not None
@@ -21,23 +21,95 @@ import os
 import sys
 import hashlib
 import logging
+import threading
 
 from ss import utils
-from ss.crypto import rc4_md5, openssl, sodium, table
+from ss.lru_cache import LRUCache
+from ss.crypto import backend
+from ss.crypto.aead import DecryptError, PAYLOAD_SIZE
 
 
-method_supported = {}
-method_supported.update(rc4_md5.ciphers)
-method_supported.update(openssl.ciphers)
-method_supported.update(sodium.ciphers)
-method_supported.update(table.ciphers)
+method_supported = backend.default_ciphers()
 
 
-def random_string(length):
-    return os.urandom(length)
+def init_backend(method, name=None):
+    """
+    choose the backend of `method` by name, or the fastest one if `name`
+    is None or 'auto', see `ss.crypto.backend`.
+    """
+    method = utils.to_str(method).lower()
+    name, method_supported[method] = backend.select(method, name)
+    with _packet_ciphers_lock:
+        packet_ciphers.clear()
+    return name
 
 
-cached_keys = {}
+class RandomPool(object):
+    """
+    hands out slices of a large `os.urandom` block, instead of making a
+    syscall for the iv of each connection and udp packet. a forked child
+    drops the slices inherited from its parent, so they are never used
+    twice.
+    """
+
+    BLOCK_SIZE = 4096
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self._slices = {}       # {length: [unused slices]}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # python 2 has no fork hook, so pid is compared on each call
+        self._check_pid = not hasattr(os, 'register_at_fork')
+        if not self._check_pid:
+            os.register_at_fork(after_in_child=self.clear)
+
+    def clear(self):
+        self._slices = {}
+        self._pid = os.getpid()
+
+    def get(self, length):
+        if self._check_pid and os.getpid() != self._pid:
+            self.clear()
+        try:
+            # list.pop is atomic, threads never get the same slice
+            return self._slices[length].pop()
+        except (KeyError, IndexError):
+            pass
+        if not 0 < length <= self.block_size // 4:
+            return os.urandom(length)
+        with self._lock:
+            block = os.urandom(self.block_size)
+            slices = [block[i:i + length]
+                      for i in range(0, self.block_size - length + 1, length)]
+            self._slices[length] = slices
+            return slices.pop()
+
+
+_random_pool = RandomPool()
+random_string = _random_pool.get
+
+
+# {(password, key_len, iv_len): (key, iv)}, bounded for rotated passwords
+cached_keys = LRUCache(maxsize=256)
+# LRUCache relinks entries even on lookup, and keys are also made on
+# crypto workers and config watcher threads
+_cached_keys_lock = threading.Lock()
+
+
+def _as_bytes(buf):
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return bytes(buf)
+
+
+def update_into(cipher, buf, out):
+    """write result of `cipher` on `buf` into `out`, return its length"""
+    if hasattr(cipher, 'update_into'):
+        return cipher.update_into(buf, out)
+    result = cipher.update(_as_bytes(buf))
+    memoryview(out)[:len(result)] = result
+    return len(result)
 
 
 def try_cipher(key, method=None):
@@ -47,9 +119,10 @@ def try_cipher(key, method=None):
 def EVP_BytesToKey(password, key_len, iv_len):
     # equivalent to OpenSSL's EVP_BytesToKey() with count 1
     # so that we make the same key and iv as nodejs version
-    cached_key = '%s-%d-%d' % (password, key_len, iv_len)
-    r = cached_keys.get(cached_key, None)
-    if r:
+    cached_key = (password, key_len, iv_len)
+    with _cached_keys_lock:
+        r = cached_keys[cached_key]
+    if r is not None:
         return r
     m = []
     i = 0
@@ -64,10 +137,30 @@ def EVP_BytesToKey(password, key_len, iv_len):
     ms = b''.join(m)
     key = ms[:key_len]
     iv = ms[key_len:key_len + iv_len]
-    cached_keys[cached_key] = (key, iv)
+    with _cached_keys_lock:
+        cached_keys[cached_key] = (key, iv)
     return key, iv
 
 
+def init_key(password, method):
+    """
+    derive key of `password` for `method` ahead, so that connections and
+    packets find it in cache. call it at startup and after config reload,
+    which also drops udp ciphers of the old password.
+    """
+    with _packet_ciphers_lock:
+        packet_ciphers.clear()
+    method = utils.to_str(method).lower()
+    m = method_supported.get(method)
+    if m is None:
+        return
+    if m[0] > 0:
+        EVP_BytesToKey(utils.to_bytes(password), m[0], m[1])
+    else:
+        # password is used directly, e.g. table builds its tables from it
+        m[2](method, utils.to_bytes(password), b'', 1)
+
+
 class Encryptor(object):
     def __init__(self, key, method):
         self.key = key
@@ -79,6 +172,10 @@ class Encryptor(object):
         method = method.lower()
         self._method_info = self.get_method_info(method)
         if self._method_info:
+            # aead ciphers add a length and tags to each chunk, so data 
+            # can't be en/decrypted in place
+            self.aead = getattr(self._method_info[2], 'AEAD', False)
+            self.chunk_size = PAYLOAD_SIZE if self.aead else 0
             self.cipher = self.get_cipher(key, method, 1,
                                           random_string(self._method_info[1]))
         else:
@@ -108,45 +205,111 @@ class Encryptor(object):
             self.cipher_iv = iv[:m[1]]
         return m[2](method, key, iv, op)
 
-    def encrypt(self, buf):
+    def encrypt(self, buf, out=None):
+        """
+        return encrypted `buf`. if `out`, a bytearray or writable memoryview
+        is given, result is written into it, and a memoryview of result is
+        returned. `out` may be `buf` itself once iv has been sent, unless
+        cipher is aead.
+        """
         if len(buf) == 0:
             return buf
-        if self.iv_sent:
-            return self.cipher.update(buf)
-        else:
+        if out is None:
+            if self.iv_sent:
+                return self.cipher.update(buf)
+            else:
+                self.iv_sent = True
+                return self.cipher_iv + self.cipher.update(buf)
+        pos = 0
+        if not self.iv_sent:
+            if out is buf:
+                raise ValueError('no room for iv in place')
+            pos = len(self.cipher_iv)
+        out = memoryview(out)
+        if pos:
+            out[:pos] = self.cipher_iv
             self.iv_sent = True
-            return self.cipher_iv + self.cipher.update(buf)
+        length = update_into(self.cipher, buf, out[pos:])
+        return out[:pos + length]
 
-    def decrypt(self, buf):
+    def decrypt(self, buf, out=None):
+        """
+        return decrypted `buf`. if `out` is given, result is written into it,
+        and a memoryview of result is returned. `out` may be `buf` itself,
+        unless cipher is aead. raise `DecryptError` if an aead cipher
+        finds data forged.
+        """
         if len(buf) == 0:
             return buf
+        if out is not None:
+            inplace = out is buf
+            out = memoryview(out)
         if self.decipher is None:
             decipher_iv_len = self._method_info[1]
-            decipher_iv = buf[:decipher_iv_len]
+            decipher_iv = _as_bytes(buf[:decipher_iv_len])
             self.decipher = self.get_cipher(self.key, self.method, 0,
                                             iv=decipher_iv)
+            if out is not None and inplace:
+                out = out[decipher_iv_len:]
             buf = buf[decipher_iv_len:]
             if len(buf) == 0:
                 return buf
-        return self.decipher.update(buf)
+        if out is None:
+            return self.decipher.update(buf)
+        return out[:update_into(self.decipher, buf, out)]
+
+
+# {(password, method, op): [iv_len, key, cipher class, cipher]}, bounded
+# like `cached_keys`, and cleared by `init_key` on config reload
+packet_ciphers = LRUCache(maxsize=64)
+# cleared on config watcher thread, while udp looks up on loop thread
+_packet_ciphers_lock = threading.Lock()
+
+
+def get_packet_cipher(password, method, op):
+    """
+    return [iv_len, key, cipher class, cipher] for `encrypt_all`. cipher is
+    created for the first packet, and reset with a new iv for later ones.
+    """
+    with _packet_ciphers_lock:
+        entry = packet_ciphers[(password, method, op)]
+    if entry is None:
+        (key_len, iv_len, m) = method_supported[method.lower()]
+        if key_len > 0:
+            key, _ = EVP_BytesToKey(password, key_len, iv_len)
+        else:
+            key = password
+        entry = [iv_len, key, m, None]
+        with _packet_ciphers_lock:
+            packet_ciphers[(password, method, op)] = entry
+    return entry
 
 
 def encrypt_all(password, method, op, data):
     result = []
-    method = method.lower()
-    (key_len, iv_len, m) = method_supported[method]
-    if key_len > 0:
-        key, _ = EVP_BytesToKey(password, key_len, iv_len)
-    else:
-        key = password
+    entry = get_packet_cipher(password, method, op)
+    iv_len, key, m, cipher = entry
     if op:
         iv = random_string(iv_len)
         result.append(iv)
     else:
+        if len(data) < iv_len:
+            return b''
         iv = data[:iv_len]
         data = data[iv_len:]
-    cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    if cipher is None:
+        cipher = entry[3] = m(method.lower(), key, iv, op)
+    else:
+        # context setup costs more than en/decrypting a small packet
+        cipher.reset(iv)
+    if getattr(cipher, 'AEAD', False):
+        try:
+            result.append(cipher.update_packet(data))
+        except DecryptError as e:
+            logging.warning('UDP: drop a packet, %s' % e)
+            return b''
+    else:
+        result.append(cipher.update(data))
     return b''.join(result)
 
 
@@ -157,6 +320,9 @@ CIPHERS_TO_TEST = [
     'salsa20',
     'chacha20',
     'table',
+    'aes-128-gcm',
+    'aes-256-gcm',
+    'chacha20-ietf-poly1305',
 ]
 
 
@@ -172,17 +338,90 @@ def test_encryptor():
         assert plain == plain2
 
 
+def test_encryptor_into():
+    from os import urandom
+    plain = urandom(10240)
+    for method in CIPHERS_TO_TEST:
+        if getattr(method_supported[method][2], 'AEAD', False):
+            continue    # length is changed, can't be done in place
+        logging.warn(method)
+        encryptor = Encryptor(b'key', method)
+        decryptor = Encryptor(b'key', method)
+        buf = bytearray(len(plain) + 16)
+        cipher = encryptor.encrypt(plain[:100], buf)
+        data = bytearray(cipher.tobytes() + plain[100:])
+        view = memoryview(data)
+        cipher2 = encryptor.encrypt(view[len(cipher):], view[len(cipher):])
+        assert len(cipher2) == len(plain) - 100
+        plain2 = decryptor.decrypt(view, view)
+        assert plain == plain2.tobytes()
+
+
 def test_encrypt_all():
     from os import urandom
     plain = urandom(10240)
     #plain = b'\x05\x00\x00\x01'
     for method in CIPHERS_TO_TEST:
         logging.warn(method)
-        cipher = encrypt_all(b'key', method, 1, plain)
-        plain2 = encrypt_all(b'key', method, 0, cipher)
-        assert plain == plain2
+        for _ in range(3):      # later packets go through a reset cipher
+            cipher = encrypt_all(b'key', method, 1, plain)
+            plain2 = encrypt_all(b'key', method, 0, cipher)
+            assert plain == plain2
+            # same as a cipher created for the packet
+            iv_len, key, m, _ = get_packet_cipher(b'key', method, 0)
+            fresh = m(method, key, cipher[:iv_len], 0)
+            if getattr(fresh, 'AEAD', False):
+                assert fresh.update_packet(cipher[iv_len:]) == plain
+            else:
+                assert fresh.update(cipher[iv_len:]) == plain
+
+
+def test_cached_keys():
+    key = EVP_BytesToKey(b'key', 32, 16)
+    assert cached_keys[(b'key', 32, 16)] == key
+    assert EVP_BytesToKey(b'key', 16, 16)[0] == key[0][:16]
+    for i in range(cached_keys._maxsize + 1):
+        EVP_BytesToKey(('key%d' % i).encode(), 32, 16)
+    assert (b'key', 32, 16) not in cached_keys
+    assert len(cached_keys._cache) == cached_keys._maxsize
+    init_key('key', 'aes-256-cfb')
+    assert (b'key', 32, 16) in cached_keys
+
+
+def test_packet_ciphers():
+    entry = get_packet_cipher(b'key', 'table', 1)
+    assert get_packet_cipher(b'key', 'table', 1) is entry
+    for i in range(packet_ciphers._maxsize):
+        get_packet_cipher(('key%d' % i).encode(), 'table', 1)
+    assert (b'key', 'table', 1) not in packet_ciphers
+    assert len(packet_ciphers._cache) == packet_ciphers._maxsize
+    # a reload with a new password drops ciphers of the old ones
+    init_key('key2', 'table')
+    assert len(packet_ciphers._cache) == 0
+
+
+def test_random_pool():
+    pool = RandomPool(64)
+    ivs = [pool.get(16) for _ in range(9)] + [pool.get(8) for _ in range(9)]
+    assert len(set(ivs)) == 18
+    assert sorted(set(len(iv) for iv in ivs)) == [8, 16]
+    assert len(pool.get(100)) == 100
+    # a child must not hand out what its parent does next
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(w, pool.get(16))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(r, 16) != pool.get(16)
+    os.close(r)
+    os.close(w)
 
 
 if __name__ == '__main__':
+    test_random_pool()
+    test_cached_keys()
+    test_packet_ciphers()
     test_encrypt_all()
     test_encryptor()
+    test_encryptor_into()
@@ -28,6 +28,8 @@ import select
 import errno
 import logging
 import threading
+import collections
+import heapq
 from collections import defaultdict
 from ss import utils
 from ss.settings import settings
@@ -132,9 +134,30 @@ class SelectLoop(object):
         pass
 
 
-class _Current(object):
+class Timer(object):
+    """
+    handle returned by `IOLoop.call_at` and friends, pass it to
+    `IOLoop.cancel` to drop the callback. `interval` is 0 for one-shot
+    timers.
+    """
+
+    __slots__ = ["deadline", "interval", "callback", "args", "cancelled"]
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return "<Timer %r at %.3f>" % (self.callback, self.deadline)
+
+
+class _Current(threading.local):
+    """io loop of current thread"""
     def __init__(self):
-        self._instance=None
+        self.instance = None
 
 
 class IOLoop(object):
@@ -152,15 +175,18 @@ class IOLoop(object):
     READ = _EPOLLIN
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP
+    EDGE = _EPOLLET
 
     _instance_lock = threading.Lock()
 
     _current = _Current()
 
-    def __init__(self):
+    def __init__(self, edge_triggered=False):
+        self.edge_triggered = False     # only available with epoll
         if hasattr(select, 'epoll'):
             self._impl = select.epoll()
-            model = 'epoll'
+            self.edge_triggered = edge_triggered
+            model = 'epoll(ET)' if edge_triggered else 'epoll'
         elif hasattr(select, 'kqueue'):
             self._impl = KqueueLoop()
             model = 'kqueue'
@@ -171,10 +197,15 @@ class IOLoop(object):
             raise Exception('can not find any available functions in select '
                             'package')
         self._fdmap = {}  # (f, handler)
-        self._last_time = time.time()
-        self._periodic_callbacks = []
+        self._timers = []               # heap of (deadline, seq, timer)
+        self._timer_seq = 0
+        self._cancelled_timers = 0
+        self._callbacks = []            # callbacks for next iteration
+        # callbacks from other threads, deque is safe to share with them
+        self._threadsafe_callbacks = collections.deque()
+        self._periodic_callbacks = {}   # {callback: timer}
         self._stopping = False
-        self._timeout = Timeout()
+        self._wheel = TimingWheel()
         print('using event model: %s' % model)
 
     @staticmethod
@@ -182,7 +213,8 @@ class IOLoop(object):
         if not hasattr(IOLoop, "_instance"):
             with IOLoop._instance_lock:
                 if not hasattr(IOLoop, "_instance"):
-                    IOLoop._instance = IOLoop()
+                    IOLoop._instance = IOLoop(
+                        settings.get("edge_triggered", False))
                     IOLoop._current.instance = IOLoop._instance
         return IOLoop._instance
 
@@ -193,6 +225,11 @@ class IOLoop(object):
             return IOLoop.instance()
         return current
 
+    def make_current(self):
+        """make this loop the one returned by `IOLoop.current` in
+        current thread, so that one process can run several loops"""
+        IOLoop._current.instance = self
+
     def poll(self, timeout=None):
         events = self._impl.poll(timeout)
         return [(self._fdmap[fd][0], fd, event) for fd, event in events]
@@ -201,6 +238,8 @@ class IOLoop(object):
         fd = f.fileno()
         self._fdmap[fd] = (f, handler)
         self._impl.register(fd, mode)
+        if not getattr(handler, "_keepalive", False):
+            self._wheel.add(fd, handler, time.time())
 
     def add(self, f, mode, handler):
         return self.register(f, mode, handler)
@@ -209,12 +248,105 @@ class IOLoop(object):
         fd = f.fileno()
         del self._fdmap[fd]
         self._impl.unregister(fd)
-
-    def add_periodic(self, callback):
-        self._periodic_callbacks.append(callback)
+        self._wheel.remove(fd)
+
+    def touch(self, f):
+        """mark `f` active, for handlers which go on without a new event"""
+        self._wheel.touch(f.fileno(), time.time())
+
+    def call_at(self, deadline, callback, *args):
+        """run `callback(*args)` once at timestamp `deadline`"""
+        timer = Timer(deadline, 0, callback, args)
+        self._push_timer(timer)
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """run `callback(*args)` once after `delay` seconds"""
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        """run `callback(*args)` in next iteration of loop"""
+        timer = Timer(0, 0, callback, args)
+        self._callbacks.append(timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        """like `call_soon`, but can be called from other threads. loop is
+        not woken up, so it may take `TIMEOUT_PRECISION` seconds to run"""
+        timer = Timer(0, 0, callback, args)
+        self._threadsafe_callbacks.append(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer is None or timer.cancelled:
+            return
+        timer.cancelled = True
+        timer.callback = timer.args = None     # release references
+        if timer.deadline:      # still in heap
+            self._cancelled_timers += 1
+            if self._cancelled_timers > 512 and \
+                    self._cancelled_timers > len(self._timers) >> 1:
+                self._timers = [t for t in self._timers if not t[2].cancelled]
+                heapq.heapify(self._timers)
+                self._cancelled_timers = 0
+
+    def add_periodic(self, callback, interval=TIMEOUT_PRECISION):
+        """run `callback()` every `interval` seconds. Deadlines are
+        computed from the previous deadline instead of the time callback
+        finished, so the period doesn't drift; missed runs are skipped."""
+        self.remove_periodic(callback)
+        timer = Timer(time.time() + interval, interval, callback, ())
+        self._periodic_callbacks[callback] = timer
+        self._push_timer(timer)
+        return timer
 
     def remove_periodic(self, callback):
-        self._periodic_callbacks.remove(callback)
+        self.cancel(self._periodic_callbacks.pop(callback, None))
+
+    def _push_timer(self, timer):
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (timer.deadline, self._timer_seq, timer))
+
+    def _run_timers(self, now):
+        timers = self._timers
+        due = []
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if timer.cancelled:
+                self._cancelled_timers -= 1
+                continue
+            if not timer.interval:
+                timer.deadline = 0      # not in heap any more
+            due.append(timer)
+        callbacks, self._callbacks = self._callbacks, []
+        threadsafe_callbacks = self._threadsafe_callbacks
+        while threadsafe_callbacks:
+            callbacks.append(threadsafe_callbacks.popleft())
+        for timer in due + callbacks:
+            if timer.cancelled:
+                continue
+            if timer.interval:
+                deadline = timer.deadline + timer.interval
+                if deadline <= now:     # fell behind, skip missed runs
+                    missed = (now - deadline) // timer.interval + 1
+                    deadline += missed * timer.interval
+                timer.deadline = deadline
+                self._push_timer(timer)
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logging.error("error in timer callback %r: %s" % (timer, e),
+                              exc_info=True)
+
+    def _poll_timeout(self, now):
+        if self._callbacks or self._wheel.pending:
+            return 0
+        timeout = TIMEOUT_PRECISION
+        if len(self._wheel):
+            timeout = min(timeout, self._wheel.next_tick() - now)
+        if self._timers:
+            timeout = min(timeout, self._timers[0][0] - now)
+        return max(timeout, 0)
 
     def modify(self, f, mode):
         fd = f.fileno()
@@ -226,16 +358,16 @@ class IOLoop(object):
     def run(self):
         self._stopping = False
         events = []
+        wheel = self._wheel
         while not self._stopping:
-            asap = False
             try:
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self.poll(self._poll_timeout(time.time()))
             except (OSError, IOError) as e:
                 if utils.errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
                     # EINTR: Happens when received a signal
                     # handles them as soon as possible
-                    asap = True
+                    events = []
                     print('poll:%s', e)
                 else:
                     print('poll:%s', e)
@@ -243,80 +375,300 @@ class IOLoop(object):
                     traceback.print_exc()
                     continue
 
+            now = time.time()
             for sock, fd, event in events:
                 handler = self._fdmap.get(fd, None)
                 if handler is not None:
                     handler = handler[1]
                     try:
-                        if not getattr(handler, "_keepalive", False):
-                            self._timeout.update_activity(fd, handler)
+                        wheel.touch(fd, now)
                         handler.handle_events(sock, fd, event)
                     except (OSError, IOError) as e:
                         print(e)
             now = time.time()
-            if asap or now - self._last_time >= TIMEOUT_PRECISION:
-                self._timeout.cleanup()
-                self._last_time = now
+            wheel.expire(now)
+            self._run_timers(now)
         print("proxy service stopped!!!")
 
     def __del__(self):
         self._impl.close()
 
 
-class Timeout(object):
+class TimingWheel(object):
+    """
+    hierarchical timing wheel which expires idle handlers.
 
-    QUEUE_MAXLEN = 1024
+    Level 0 has `SLOTS` buckets of one `TICK` each, and every higher level
+    covers `SLOTS` times the span of the level below, so three levels of
+    64 one-second buckets cover more than three days. A handler is armed
+    once when registered; I/O activity only stores the loop time in its
+    entry, and an entry is re-placed lazily when its bucket comes due.
+    So `touch` is O(1) without allocation, and `remove` is O(1).
+    """
 
-    FD_POS_IN_QUEUE = dict()
+    TICK = 1
+    SLOTS = 64
+    LEVELS = 3
+    MAX_EXPIRE_PER_TICK = 512   # bound the number of handlers destroyed per tick
 
-    FD_QUEUE = list()
+    # fields of an entry
+    HANDLER, LAST_ACTIVITY, LEVEL, SLOT, FD = 0, 1, 2, 3, 4
 
-    TIMEOUT_OFFSET = 0
-
-    FD_LASTACTIVITY = dict()
-
-    FD_HANDLERS = dict()
-
-    TIMEOUTS_CLEAN_SIZE = 512
-
-    def update_activity(self, fd, handler):
-        self.FD_LASTACTIVITY[fd] = time.time()
-        pos = self.FD_POS_IN_QUEUE.get(fd, -1)
-        if pos >= 0:
-            self.FD_QUEUE[pos] = None
-        l = len(self.FD_QUEUE)
-        self.FD_QUEUE.append(fd)
-        self.FD_POS_IN_QUEUE[fd] = l
-        self.FD_HANDLERS[fd] = handler
-
-    def cleanup(self):
-        """"""
-        if not self.FD_QUEUE:
+    def __init__(self, now=None):
+        if now is None:
+            now = time.time()
+        self._current = int(now // self.TICK)
+        self._wheels = [[set() for _ in range(self.SLOTS)]
+                        for _ in range(self.LEVELS)]
+        self._entries = {}                      # {fd: entry}
+        self._expired = collections.deque()     # entries waiting for destroy
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, fd):
+        return fd in self._entries
+
+    @property
+    def pending(self):
+        """whether there are expired handlers left over from last tick"""
+        return bool(self._expired)
+
+    def add(self, fd, handler, now):
+        self.remove(fd)
+        entry = [handler, now, -1, -1, fd]
+        self._entries[fd] = entry
+        self._place(entry)
+
+    def touch(self, fd, now):
+        entry = self._entries.get(fd)
+        if entry is not None:
+            entry[self.LAST_ACTIVITY] = now
+
+    def remove(self, fd):
+        entry = self._entries.pop(fd, None)
+        if entry is not None and entry[self.LEVEL] >= 0:
+            self._wheels[entry[self.LEVEL]][entry[self.SLOT]].discard(fd)
+
+    def _deadline(self, entry):
+        # round up, so that handler never expires before timeout
+        return int((entry[self.LAST_ACTIVITY] + settings.timeout) // self.TICK) + 1
+
+    def _place(self, entry):
+        deadline = self._deadline(entry)
+        delta = deadline - self._current
+        if delta <= 0:
+            entry[self.LEVEL] = entry[self.SLOT] = -1
+            self._expired.append(entry)
             return
-        now = time.time()
-        size = len(self.FD_QUEUE)
-        pos = self.TIMEOUT_OFFSET
-        while pos < size:
-            fd = self.FD_QUEUE[pos]
-            if fd:
-                if now - self.FD_LASTACTIVITY[fd] < settings.timeout:
+        level, span = 0, self.SLOTS
+        while delta >= span and level < self.LEVELS - 1:
+            level += 1
+            span *= self.SLOTS
+        if delta >= span:       # beyond the top level, cascade again later
+            deadline = self._current + span - 1
+        slot = (deadline // (span // self.SLOTS)) % self.SLOTS
+        entry[self.LEVEL] = level
+        entry[self.SLOT] = slot
+        self._wheels[level][slot].add(entry[self.FD])
+
+    def _cascade(self, level, slot):
+        bucket = self._wheels[level][slot]
+        if not bucket:
+            return
+        self._wheels[level][slot] = set()
+        entries = self._entries
+        for fd in bucket:
+            self._place(entries[fd])
+
+    def _rebuild(self):
+        for wheel in self._wheels:
+            for slot in range(self.SLOTS):
+                wheel[slot] = set()
+        for entry in self._entries.values():
+            if entry[self.LEVEL] >= 0:
+                self._place(entry)
+
+    def next_tick(self):
+        """timestamp at which `advance` has work to do again"""
+        return (self._current + 1) * self.TICK
+
+    def advance(self, now):
+        """move the wheel forward to `now`, collecting expired entries"""
+        target = int(now // self.TICK)
+        if target - self._current >= self.SLOTS ** self.LEVELS:
+            # clock jumped, re-place everything instead of walking each tick
+            self._current = target
+            self._rebuild()
+            return
+        while self._current < target:
+            self._current += 1
+            tick = self._current
+            span = 1
+            for level in range(1, self.LEVELS):
+                span *= self.SLOTS
+                if tick % span:
                     break
-                handler = self.FD_HANDLERS[fd]
-                logging.info("connect %s:%s timeout" % handler._addr)
+                self._cascade(level, (tick // span) % self.SLOTS)
+            self._cascade(0, tick % self.SLOTS)
+
+    def expire(self, now):
+        """destroy at most `MAX_EXPIRE_PER_TICK` idle handlers"""
+        self.advance(now)
+        expired = self._expired
+        count = 0
+        while expired and count < self.MAX_EXPIRE_PER_TICK:
+            entry = expired.popleft()
+            fd = entry[self.FD]
+            if self._entries.get(fd) is not entry:
+                continue        # removed or re-armed while waiting
+            if self._deadline(entry) > self._current:
+                self._place(entry)      # became active while waiting
+                continue
+            del self._entries[fd]
+            handler = entry[self.HANDLER]
+            count += 1
+            try:
+                logging.info("connect %s:%s timeout" % handler._addr[:2])
                 handler.destroy()
-                self.FD_QUEUE[pos] = None       # free memory
-                self.FD_HANDLERS.pop(fd)     # reduce ref
-                del self.FD_LASTACTIVITY[fd]
-                del self.FD_POS_IN_QUEUE[fd]
-                pos += 1
-            else:
-                pos += 1
-
-        if pos > self.TIMEOUTS_CLEAN_SIZE and pos > size >> 1:
-            self.FD_QUEUE = self.FD_QUEUE[pos:]
-            for key in self.FD_POS_IN_QUEUE:
-                self.FD_POS_IN_QUEUE[key] -= pos
-                
-            pos = 0
-        self.TIMEOUT_OFFSET = pos
-
+            except (OSError, IOError) as e:
+                logging.error(e)
+        return count
+
+
+def test_call_soon_threadsafe():
+    io_loop = IOLoop()
+    results = []
+
+    def work():
+        io_loop.call_soon_threadsafe(results.append, threading.current_thread())
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert not results      # not before loop runs
+    io_loop._run_timers(time.time())
+    assert results == [thread]
+
+
+class _IdleHandler(object):
+
+    def __init__(self, fd):
+        self._addr = ("127.0.0.1", fd)
+        self.destroyed = False
+
+    def destroy(self):
+        self.destroyed = True
+
+
+def _with_timeout(timeout, func):
+    old, settings.timeout = settings.timeout, timeout
+    try:
+        func()
+    finally:
+        settings.timeout = old
+
+
+def test_timing_wheel_cascade():
+    start = 1234567.5       # not on a slot boundary of any level
+    # deadline is `timeout + 1` ticks away, levels cover 64, 64**2 and
+    # 64**3 ticks, a longer one waits at top level and cascades again
+    for timeout, level in [(1, 0), (62, 0), (63, 1), (4094, 1), (4095, 2),
+                           (262142, 2), (262143, 2), (300000, 2)]:
+        def check():
+            wheel = TimingWheel(start)
+            handler = _IdleHandler(3)
+            wheel.add(3, handler, start)
+            assert wheel._entries[3][wheel.LEVEL] == level, timeout
+            wheel.expire(start + timeout + 0.4)    # tick before deadline
+            assert not handler.destroyed and 3 in wheel, timeout
+            assert wheel._entries[3][wheel.LEVEL] == 0, timeout
+            wheel.expire(start + timeout + 0.5)
+            assert handler.destroyed and 3 not in wheel, timeout
+        _with_timeout(timeout, check)
+
+
+def test_timing_wheel_touch():
+    def check():
+        start = 1000.0
+        wheel = TimingWheel(start)
+        handler = _IdleHandler(3)
+        wheel.add(3, handler, start)
+        wheel.expire(start + 50)
+        wheel.touch(3, start + 50)
+        # bucket of the old deadline comes due, entry is placed again
+        wheel.expire(start + 101)
+        assert not handler.destroyed and 3 in wheel
+        wheel.expire(start + 150)
+        assert not handler.destroyed
+        wheel.expire(start + 151)
+        assert handler.destroyed
+    _with_timeout(100, check)
+
+
+def test_timing_wheel_carry_over():
+    def check():
+        start = 1000.0
+        wheel = TimingWheel(start)
+        wheel.MAX_EXPIRE_PER_TICK = 3
+        handlers = [_IdleHandler(fd) for fd in range(7)]
+        for fd, handler in enumerate(handlers):
+            wheel.add(fd, handler, start)
+        now = start + 11
+        assert wheel.expire(now) == 3 and wheel.pending
+        # loop doesn't wait for next tick while some are left
+        io_loop = IOLoop()
+        io_loop._wheel = wheel
+        assert io_loop._poll_timeout(now) == 0
+        waiting = [fd for fd, h in enumerate(handlers) if not h.destroyed]
+        active, removed = waiting[:2]
+        wheel.touch(active, now)    # active while waiting, not destroyed
+        wheel.remove(removed)
+        assert wheel.expire(now) == 2 and not wheel.pending
+        assert [fd for fd, h in enumerate(handlers) if not h.destroyed] == \
+            [active, removed]
+        assert active in wheel and removed not in wheel
+        assert io_loop._poll_timeout(now) == wheel.next_tick() - now
+        wheel.expire(now + 11)
+        assert handlers[active].destroyed and not len(wheel)
+    _with_timeout(10, check)
+
+
+def test_timers():
+    now = 1000.0
+    io_loop = IOLoop()
+    io_loop._wheel = TimingWheel(now)
+    assert io_loop._poll_timeout(now) == TIMEOUT_PRECISION
+    called = []
+    late = io_loop.call_at(now + 2, called.append, "late")
+    early = io_loop.call_at(now + 1, lambda: (called.append("early"),
+                                              io_loop.cancel(late)))
+    assert io_loop._poll_timeout(now) == 1
+    io_loop._run_timers(now + 0.5)
+    assert not called
+    # `late` is due in the same run, but cancelled by `early`
+    io_loop._run_timers(now + 3)
+    assert called == ["early"] and not io_loop._timers
+    assert io_loop._cancelled_timers == 0
+
+    # periodic callback removes itself
+    def tick():
+        called.append("tick")
+        io_loop.remove_periodic(tick)
+    io_loop.add_periodic(tick, 5)
+    deadline = io_loop._timers[0][0]
+    io_loop._run_timers(deadline)
+    assert io_loop._cancelled_timers == 1   # still in heap, skipped later
+    io_loop._run_timers(deadline + 5)
+    assert called.count("tick") == 1
+    assert not io_loop._timers and io_loop._cancelled_timers == 0
+
+    # one shot cancelled before due is skipped, a call_soon one runs
+    timer = io_loop.call_at(now + 1, called.append, "cancelled")
+    io_loop.cancel(timer)
+    io_loop.cancel(timer)       # twice is fine
+    io_loop.call_soon(called.append, "soon")
+    assert io_loop._poll_timeout(now) == 0
+    io_loop._run_timers(now + 2)
+    assert called[-1] == "soon" and "cancelled" not in called
+    assert io_loop._poll_timeout(now + 2) == TIMEOUT_PRECISION
@@ -46,7 +46,10 @@ class LRUCache(object):
 
     def __setitem__(self, key, val):
         self._root, = self._nonlocal_root
-        if key in self._cache:
+        link = self._cache.get(key)
+        if link is not None:
+            # e.g. a dns answer refreshed after its ttl
+            link[RESULT] = val
             return
         elif len(self._cache) >= self._maxsize:
             oldroot = self._root
@@ -63,12 +66,14 @@ class LRUCache(object):
             link = [last, self._root, key, val]
             last[NEXT] = self._root[PREV] = self._cache[key] = link
 
-    def __del__(self):
+    def clear(self):
         self._cache.clear()
         self._root = self._nonlocal_root[0]
         self._root[:] = [self._root, self._root, None, None]
         self._stats[:] = [0, 0]
 
+    __del__ = clear
+
     def __repr__(self):
         return _CacheInfo(self._stats[HITS], self._stats[MISSES], 
                 self._maxsize, len(self._cache)).__repr__()
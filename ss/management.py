@@ -4,12 +4,15 @@ import sys
 import os
 import signal
 from functools import partial
-from ss import utils, cli, wrapper
+from ss import utils, cli, wrapper, encrypt, bench
 from ss.config import set_proxy_mode
 from ss.settings import settings
 from ss import watcher
 from ss.core import tcphandler, udphandler
 from ss.core.asyncdns import DNSResolver
+from ss.core.base import LocalMixin
+from ss.core.tunnelpool import TunnelPool
+from ss.core.cryptopool import CryptoExecutor
 from ss.ioloop import IOLoop
 
 def run(io_loop=None):
@@ -18,9 +21,16 @@ def run(io_loop=None):
     # if not io_loop:
     #     io_loop = IOLoop.current()
     subcmd = settings.get("subcmd")
-    handlers = {"local": run_local, "server": run_server}
+    handlers = {"local": run_local, "server": run_server, 
+                "bench": run_bench}
     return handlers[subcmd](io_loop)
 
+def run_bench(io_loop):
+    if settings["target"] == "crypto":
+        bench.run(settings)
+    elif settings["target"] == "dns":
+        bench.run_dns(settings)
+
 def run_local(io_loop):
     
     if not io_loop:
@@ -28,6 +38,8 @@ def run_local(io_loop):
     try:
         sa = settings['local_address'], settings['local_port']
         logging.info("starting local at %s:%d" % sa)
+        encrypt.init_backend(settings['method'], settings.get('crypto_backend'))
+        encrypt.init_key(settings['password'], settings['method'])
         dns_resolver = DNSResolver(io_loop)
         tcp_server = tcphandler.ListenHandler(io_loop, sa, 
             tcphandler.LocalConnHandler, dns_resolver)
@@ -42,6 +54,15 @@ def run_local(io_loop):
                 tcphandler.HttpLocalConnHandler, dns_resolver)
             servers.append(http_tunnel)
 
+        if settings.get("tunnel_pool"):
+            pool = TunnelPool(io_loop, (settings['server'], settings['server_port']),
+                dns_resolver, settings['tunnel_pool'], 
+                settings.get('tunnel_idle', 60), settings.get('fast_open', False))
+            LocalMixin.tunnel_pool = pool
+            servers.append(pool)
+
+        servers.extend(create_executor(io_loop))
+
         for server in servers:
             server.register()
             wrapper.onexit(server.destroy)
@@ -65,25 +86,47 @@ def on_master_exit(s, frame, children):
             pass
     sys.exit(0)
 
-def run_server(io_loop):
-    sa = settings['server'], settings['server_port']
-    logging.info("starting server at %s:%d" % sa)
+def create_executor(io_loop):
+    """threads are started in `register`, after workers are forked"""
+    if not settings.get("crypto_workers"):
+        return []
+    executor = CryptoExecutor(io_loop, settings["crypto_workers"])
+    tcphandler.ConnHandler.crypto_executor = executor
+    return [executor]
 
+def create_servers(io_loop, sa):
     dns_resolver = DNSResolver(io_loop)
     tcp_server = tcphandler.ListenHandler(io_loop, sa, 
         tcphandler.RemoteConnHandler, dns_resolver)
     udp_server = udphandler.ListenHandler(io_loop, sa, 
         udphandler.ConnHandler, 0, dns_resolver)
-    servers = [tcp_server, udp_server, dns_resolver]
+    return [tcp_server, udp_server, dns_resolver] + create_executor(io_loop)
+
+def run_server(io_loop):
+    sa = settings['server'], settings['server_port']
+    logging.info("starting server at %s:%d" % sa)
+    # before fork, workers inherit the choice
+    encrypt.init_backend(settings['method'], settings.get('crypto_backend'))
+    encrypt.init_key(settings['password'], settings['method'])
 
+    # with SO_REUSEPORT, listening sockets are created in each worker,
+    # otherwise all workers share the same listening sockets
+    servers = None if settings.get("reuse_port", False) \
+        else create_servers(io_loop, sa)
 
     def start():
         try:
-            for server in servers:
+            loop, worker_servers = io_loop, servers
+            if worker_servers is None:
+                # each worker owns its loop and listening sockets
+                loop = IOLoop(settings.get("edge_triggered", False))
+                loop.make_current()
+                worker_servers = create_servers(loop, sa)
+            for server in worker_servers:
                 server.register()
                 wrapper.onexit(server.destroy)
-            io_loop = IOLoop.current()
-            io_loop.run()
+            loop = loop or IOLoop.current()
+            loop.run()
         except Exception as e:
             logging.error(e, exc_info=True)
             sys.exit(1)
@@ -6,6 +6,7 @@ import socket
 import struct
 import logging
 import os
+import ctypes
 
 PY2 = sys.version_info[0] == 2
 if PY2:
@@ -91,6 +92,157 @@ def is_ip(address):
     return False
 
 
+PyBUF_SIMPLE, PyBUF_WRITABLE = 0, 1
+
+
+class Py_buffer(ctypes.Structure):
+    # only leading fields are used, the rest differs between python 2 and 3
+    _fields_ = [("buf", ctypes.c_void_p), ("obj", ctypes.c_void_p),
+                ("len", ctypes.c_ssize_t), ("_rest", ctypes.c_char * 128)]
+
+
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = (ctypes.py_object, ctypes.POINTER(Py_buffer),
+                        ctypes.c_int)
+_get_buffer.restype = ctypes.c_int
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = (ctypes.POINTER(Py_buffer), )
+_release_buffer.restype = None
+
+
+def get_buffer(obj, writable=False):
+    """
+    address and length of data in `obj`, which is bytes, bytearray or
+    memoryview, so that C functions can read or write it in place. return
+    `Py_buffer` which must be passed to `release_buffer` after use.
+    """
+    view = Py_buffer()
+    _get_buffer(obj, ctypes.byref(view),
+                PyBUF_WRITABLE if writable else PyBUF_SIMPLE)
+    return view
+
+
+def release_buffer(view):
+    _release_buffer(ctypes.byref(view))
+
+
+SPLICE_F_MOVE, SPLICE_F_NONBLOCK = 1, 2
+F_SETPIPE_SZ = 1031
+
+
+def _load_splice():
+    """return splice(fd_in, fd_out, count) which moves data between a pipe
+    and a socket inside kernel, or None if splice(2) is not available"""
+    if not sys.platform.startswith("linux"):
+        return None
+    flags = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+    if hasattr(os, "splice"):   # python 3.10+
+        return lambda fd_in, fd_out, count: \
+            os.splice(fd_in, fd_out, count, flags=flags)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.splice
+    except (OSError, AttributeError):
+        return None
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                     ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+
+    def _splice(fd_in, fd_out, count):
+        n = func(fd_in, None, fd_out, None, count, flags)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+    return _splice
+
+splice = _load_splice()
+
+
+def _iov_max():
+    try:
+        return os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        return 1024
+
+IOV_MAX = _iov_max()
+
+
+def _load_sendmsg():
+    """return sendmsg(sock, segments) which sends a list of (object, start,
+    length) in one syscall, or None if scatter-gather is not available"""
+    if hasattr(socket.socket, "sendmsg"):     # python 3.3+
+        def _sendmsg(sock, segments):
+            return sock.sendmsg([memoryview(obj)[start:start + length]
+                                 for obj, start, length in segments])
+        return _sendmsg
+    return _load_writev()
+
+
+def _load_writev():
+    """sendmsg on top of writev(2) by ctypes, for python 2"""
+    if os.name != "posix":
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.writev
+    except (OSError, AttributeError):
+        return None
+
+    class iovec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    func.restype = ctypes.c_ssize_t
+    func.argtypes = (ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int)
+
+    def _sendmsg(sock, segments):
+        iov = (iovec * len(segments))()
+        views = [get_buffer(obj) for obj, start, length in segments]
+        try:
+            for i, (obj, start, length) in enumerate(segments):
+                iov[i].iov_base = views[i].buf + start
+                iov[i].iov_len = length
+            n = func(sock.fileno(), iov, len(segments))
+        finally:
+            for view in views:
+                release_buffer(view)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise socket.error(err, os.strerror(err))
+        return n
+    return _sendmsg
+
+sendmsg = _load_sendmsg()
+
+
+def create_pipe(size):
+    """create a non-blocking pipe for splice, return read fd, write fd
+    and capacity of pipe"""
+    import fcntl
+    r, w = os.pipe()
+    for fd in (r, w):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    try:
+        size = fcntl.fcntl(w, F_SETPIPE_SZ, size)
+    except (OSError, IOError):
+        size = 65536    # default capacity on linux
+    return r, w, size
+
+
+def bytes_available(sock):
+    """number of bytes could be read from `sock` without blocking"""
+    import fcntl
+    import termios
+    buf = fcntl.ioctl(sock.fileno(), termios.FIONREAD, b"\0\0\0\0")
+    return struct.unpack("i", buf)[0]
+
+
+def reuse_port_supported():
+    return hasattr(socket, "SO_REUSEPORT")
+
+
 def patch_socket():
     if not hasattr(socket, 'inet_pton'):
         socket.inet_pton = inet_pton
@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
 import time
-import threading
-import sched
 import logging
-import heapq
 import sys
+import threading
+from functools import partial
 from ss.config import Switcher
+from ss.ioloop import IOLoop
 from ss.settings import settings
 from ss.wrapper import onstart
 
@@ -26,59 +26,65 @@ def add_metaclass(metaclass):
     return wrapper
 
 
-class Scheduler(sched.scheduler, threading.Thread):
+class Scheduler(object):
+    """
+    run watchers as periodic callbacks of io loop, so that watchers
+    and handlers never run concurrently. watchers only stat files there,
+    reading and applying them blocks, so it is done by `run_blocking`.
+    """
 
     watcher_list = []
 
     def __init__(self):
-        threading.Thread.__init__(self, name = "watcher")
-        sched.scheduler.__init__(self, time.time, time.sleep)
-        self.setDaemon(True)
         self.is_running = False
         self.intval_map = dict()
-        
-    def run(self):
-        self.add_to_loop()
-        logging.info("start watcher thread!")
+        self.io_loop = None
+
+    def start(self, io_loop=None):
+        if not io_loop:
+            io_loop = IOLoop.current()
+        self.io_loop = io_loop
+        for task_cls in self.watcher_list:
+            self.register(task_cls, io_loop)
         self.is_running = True
-        q = self._queue
-        delayfunc = self.delayfunc
-        timefunc = self.timefunc
-        pop = heapq.heappop
-        while q:
-            checked_event = q[0]
-            time, priority, action, argument = checked_event[:4]
-            now = timefunc()
-            if now < time:
-                delayfunc(time - now)
-            else:
-                event = pop(q)
-                # Verify that the event was not removed or altered
-                # by another thread after we last looked at q[0].
-                if event is checked_event:
-                    bt = timefunc()
-                    try:
-                        action(*argument)
-                        delayfunc(0)   # Let other threads run
-                    except Exception as e:
-                        logging.warn(
-                            "occur error when excute watcher %s: %s" % (action.func_name, e),
-                            exc_info=True)
-                        continue
-                    delta = timefunc() - bt # time cost in exec action
-                    self.enter(self.intval_map[action]-delta,
-                        priority, action, argument)
-                else:
-                    heapq.heappush(q, event)
-
-    def register(self, watchercls):
+        logging.info("start watchers!")
+
+    def run_task(self, action, argument):
+        try:
+            action(*argument)
+        except Exception as e:
+            logging.warn(
+                "occur error when excute watcher %s: %s" % (action.__name__, e),
+                exc_info=True)
+
+    def run_blocking(self, func, args, callback):
+        """
+        run `func(*args)` on a watcher thread, then `callback(result, error)`
+        on loop thread, see `IOLoop.call_soon_threadsafe`
+        """
+        io_loop = self.io_loop
+
+        def work():
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            io_loop.call_soon_threadsafe(callback, result, error)
+
+        thread = threading.Thread(target=work, name="watcher")
+        thread.daemon = True
+        thread.start()
+
+    def register(self, watchercls, io_loop):
         if self.is_running:
             logging.warn("cannot register task after scheduler start run!")
             return
         args = watchercls().fmt()
         if self.check_args(args):
-            self.enter(*args)
-            self.intval_map[args[2]] = args[0]
+            interval, priority, action, argument = args
+            io_loop.add_periodic(partial(self.run_task, action, argument),
+                                 interval)
+            self.intval_map[action] = interval
             logging.info("register task %s" % watchercls.__name__)
         else:
             logging.info("skip task %s" % watchercls.__name__)
@@ -97,10 +103,6 @@ class Scheduler(sched.scheduler, threading.Thread):
             logging.warn(e)
             return False
 
-    def add_to_loop(self):
-        for task_cls in self.watcher_list:
-            self.register(task_cls)
-
 class Register(type):
 
     def __new__(mcs, name, bases, attrs):
@@ -125,13 +127,22 @@ class Pac(Watcher):
     LastRead = time.time()
     inteval = 25
     priority = 1
+    loading = False
 
     def run(self):
+        if self.loading:
+            return
         pacfile = settings["pac"]
         last = os.path.getmtime(pacfile)
         if last > self.LastRead:
-            self.load()
-        
+            self.loading = True
+            scheduler.run_blocking(self.load, (), self.on_loaded)
+
+    def on_loaded(self, result, error):
+        self.loading = False
+        if error is not None:
+            logging.warn("can't reload pac file: %s" % error)
+
     @classmethod
     def load(cls):
         from ss.core.pac import ProxyAutoConfig
@@ -153,25 +164,44 @@ class CoinfigFile(Watcher):
                 "local_address", 
             ]
     NOT_SUPPORT_MSG = "`%s` changed! it wouldn't takce effect util you restart this service"
+    reloading = False
 
     def run(self):
-        from ss.cli import parse_cli
+        if self.reloading:
+            return
         path = settings["config_file"]
         last_mod = os.path.getmtime(path)
         if last_mod <= self.last_read:
             return
+        self.reloading = True
+        scheduler.run_blocking(self.reload, (), self.on_reloaded)
+
+    def reload(self):
+        """parse config file again and apply it, on watcher thread"""
+        from ss.cli import parse_cli
         old = settings.dict()
         try:
             parse_cli(sys.argv[1:])
-            logging.info("reload config file. \r\n%s" % settings)
-            self.last_read = time.time()
-            for key in self.not_support:
-                if settings[key] != old[key]:
-                    logging.warn(self.NOT_SUPPORT_MSG % key)
-            self.on_reload(old)
-        except SystemExit as e:
-            logging.error("config file error: %s" % e)
-        
+        except SystemExit as e:     # argparse exits on bad config
+            raise ValueError("config file error: %s" % e)
+        self.last_read = time.time()
+        self.on_reload(old)
+        return old
+
+    def on_reloaded(self, old, error):
+        """back on loop thread, drop what handlers cached from old config"""
+        self.reloading = False
+        if error is not None:
+            logging.error(error)
+            return
+        logging.info("reload config file. \r\n%s" % settings)
+        for key in self.not_support:
+            if settings[key] != old[key]:
+                logging.warn(self.NOT_SUPPORT_MSG % key)
+        if old.get("direct_hosts") != settings.get("direct_hosts"):
+            from ss.core.base import LocalMixin
+            LocalMixin._exclusive_host.cache_clear()
+
     def on_reload(self, old):
         change = lambda key: old.get(key) != settings.get(key)
         if change("pac"):
@@ -179,6 +209,9 @@ class CoinfigFile(Watcher):
         if change("proxy_mode"):
             from ss.config import set_proxy_mode
             set_proxy_mode()
+        if change("password") or change("method"):
+            from ss import encrypt
+            encrypt.init_key(settings["password"], settings["method"])
 
     def fmt(self):
         if not settings.get("config_file"):